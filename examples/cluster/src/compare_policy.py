@@ -2,6 +2,9 @@ import sys
 import dill as pickle
 from pathlib import Path
 
+from mouselab.policy_artifacts import PolicyArtifact, load_policy_artifact
+from mouselab.policy_diff import diff_policy_tables
+
 try:
     experiment_setting = sys.argv[1]
 except:
@@ -21,38 +24,41 @@ path_1 = (
     Path(__file__)
     .resolve()
     .parents[1]
-    .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_1}.pickle")
+    .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_1}")
 )
 
 path_2 = (
     Path(__file__)
     .resolve()
     .parents[1]
-    .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_2}.pickle")
+    .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_2}")
 )
 
-try:
-    with open(path_1, "rb") as f:
-        p1 = pickle.load(f)
-        if "pi_dictionary" in p1:
+
+def load_policy(path):
+    # policy artifacts behave like the pickled dictionaries
+    if path.is_dir():
+        return load_policy_artifact(path)
+
+    with open(f"{path}.pickle", "rb") as f:
+        p = pickle.load(f)
+        if "pi_dictionary" in p:
             key = "pi_dictionary"
         else:
             key = "q_dictionary"
-        dict1 = p1[key]
+        return p[key]
+
+
+try:
+    dict1 = load_policy(path_1)
 except:
     raise "File cannot be read: {}".format(path_1)
 
 
 try:
-    with open(path_2, "rb") as f:
-        p2 = pickle.load(f)
-        if "pi_dictionary" in p2:
-            key = "pi_dictionary"
-        else:
-            key = "q_dictionary"
-        dict2 = p2[key]
+    dict2 = load_policy(path_2)
 except:
-    raise "File cannot be read: {}".format(path_1)
+    raise "File cannot be read: {}".format(path_2)
 
 num_equal = 0
 num_diff = 0
@@ -62,48 +68,77 @@ diff_dict = {}
 sub_dict = {}
 int_dict = {}
 
-for state, outcomes_2 in dict2.items():
-    outcomes_1 = dict1[state]
-    actions_1 = outcomes_1["max_actions"]
-    actions_2 = outcomes_2["max_actions"]
-    if set(actions_1) == set(actions_2):
-        num_equal += 1
-    elif set(actions_2).issubset(set(actions_1)):
-        num_sub += 1
-        sub_dict[state] = {
-            "1": {
-                "max_actions": actions_1,
-                "q_values": outcomes_1["q_values"]
-            },
-            "2": {
-                "max_actions": actions_2,
-                "q_values": outcomes_2["q_values"]
+
+def outcomes_of(state):
+    return {"1": dict1[state], "2": dict2[state]}
+
+
+if isinstance(dict1, PolicyArtifact) and isinstance(dict2, PolicyArtifact):
+    # compare best action bitmasks of all states at once
+    diff = diff_policy_tables(dict1.table, dict2.table, dict1.tree)
+    counts = diff["counts"]
+    num_equal = counts["equal"]
+    num_sub = counts["subset"]
+    num_int = counts["superset"] + counts["intersecting"]
+    num_diff = counts["disjoint"]
+
+    encoder = dict1.encoder
+    for relation, relation_dict in [
+        ("subset", sub_dict),
+        ("superset", int_dict),
+        ("intersecting", int_dict),
+        ("disjoint", diff_dict),
+    ]:
+        for codes in encoder.unrank(diff["ranks"][relation]):
+            state = encoder.decode(codes)
+            relation_dict[state] = outcomes_of(state)
+
+    print("By number of revealed nodes:\n{}".format(diff["by_num_revealed"]))
+    print("By depth of deepest revealed node:\n{}".format(diff["by_depth"]))
+else:
+    for state, outcomes_2 in dict2.items():
+        outcomes_1 = dict1[state]
+        actions_1 = outcomes_1["max_actions"]
+        actions_2 = outcomes_2["max_actions"]
+        if set(actions_1) == set(actions_2):
+            num_equal += 1
+        elif set(actions_2).issubset(set(actions_1)):
+            num_sub += 1
+            sub_dict[state] = {
+                "1": {
+                    "max_actions": actions_1,
+                    "q_values": outcomes_1["q_values"]
+                },
+                "2": {
+                    "max_actions": actions_2,
+                    "q_values": outcomes_2["q_values"]
+                }
             }
-        }
-    elif len(set(actions_1).intersection(set(actions_2))):
-        num_int += 1
-        int_dict[state] = {
-            "1": {
-                "max_actions": actions_1,
-                "q_values": outcomes_1["q_values"]
-            },
-            "2": {
-                "max_actions": actions_2,
-                "q_values": outcomes_2["q_values"]
+        elif len(set(actions_1).intersection(set(actions_2))):
+            num_int += 1
+            int_dict[state] = {
+                "1": {
+                    "max_actions": actions_1,
+                    "q_values": outcomes_1["q_values"]
+                },
+                "2": {
+                    "max_actions": actions_2,
+                    "q_values": outcomes_2["q_values"]
+                }
             }
-        }
-    else:
-        num_diff += 1
-        diff_dict[state] = {
-            "1": {
-                "max_actions": actions_1,
-                "q_values": outcomes_1["q_values"]
-            },
-            "2": {
-                "max_actions": actions_2,
-                "q_values": outcomes_2["q_values"]
+        else:
+            num_diff += 1
+            diff_dict[state] = {
+                "1": {
+                    "max_actions": actions_1,
+                    "q_values": outcomes_1["q_values"]
+                },
+                "2": {
+                    "max_actions": actions_2,
+                    "q_values": outcomes_2["q_values"]
+                }
             }
-        }
+
 
 print("{} vs. {}".format(reward_pct_1, reward_pct_2))
 print("Length of dict 1: {}".format(len(dict1)))
@@ -1,11 +1,14 @@
 import sys
 from pathlib import Path
 
-import dill as pickle
-
-from mouselab.env_utils import get_ground_truths_from_json
-from mouselab.exact_utils import timed_solve_env
+from mouselab.env_utils import GroundTruthStates, get_ground_truths_from_json
+from mouselab.exact_utils import extract_on_policy_table, timed_solve_env
 from mouselab.mouselab import MouselabEnv
+from mouselab.policy_artifacts import (
+    save_policy_artifact,
+    write_pi_artifact,
+    write_q_artifact,
+)
 
 experiment_setting = sys.argv[1]
 try:
@@ -30,6 +33,12 @@ except:
     save_pi = True
     save_q = False
 
+try:
+    # only keep pi for the states visited when following the optimal policy
+    on_policy = sys.argv[5] == "on_policy"
+except:
+    on_policy = False
+
 print("Experiment setting: {}".format(experiment_setting))
 # make folder we need
 Path(__file__).resolve().parents[1].joinpath("output").mkdir(
@@ -42,16 +51,46 @@ else:
     states = None
 env_increasing = MouselabEnv.new_symmetric_registered(experiment_setting, cost=base_cost * percent_rewarded)
 env_increasing._pct_reward = percent_rewarded
-q, v, pi, info = timed_solve_env(env_increasing, save_pi=save_pi, save_q=save_q, ground_truths=states, verbose=True)
+# policies are streamed to a policy artifact, holding all states, the states
+# reachable for the given ground truths or only those visited on-policy
+q, v, pi, info = timed_solve_env(env_increasing, ground_truths=states, verbose=True)
 
-file_prefix = "q_dict" if save_q else "pi_dict"
+on_policy_table = None
+ranks = None
+if states is not None and on_policy and save_pi:
+    on_policy_table = extract_on_policy_table(pi, env_increasing, states)
+    print(
+        "{} on-policy states for {} ground truths".format(
+            len(on_policy_table["ranks"]), len(states)
+        )
+    )
+elif states is not None:
+    ground_truth_states = GroundTruthStates(env_increasing, states)
+    print(
+        "{} distinct states for {} ground truths ({} shared)".format(
+            ground_truth_states.num_distinct_states,
+            ground_truth_states.num_ground_truths,
+            ground_truth_states.num_shared_states,
+        )
+    )
+    ranks = ground_truth_states.ranks()
 
+file_prefix = "q" if save_q else "pi"
 path = (
     Path(__file__)
     .resolve()
     .parents[1]
-    .joinpath(f"output/{file_prefix}_{experiment_setting}_{percent_rewarded}.pickle")
+    .joinpath(f"output/{file_prefix}_dict_{experiment_setting}_{percent_rewarded}")
 )
-
-with open(path, "wb") as f:
-    pickle.dump(info, f)
+metadata = {
+    "experiment_setting": experiment_setting,
+    "percent_rewarded": percent_rewarded,
+    "ground_truth_file": ground_truth_file,
+    **info,
+}
+if on_policy_table is not None:
+    save_policy_artifact(path, on_policy_table, env_increasing, metadata=metadata)
+elif save_q:
+    write_q_artifact(path, q, env_increasing, ranks=ranks, metadata=metadata)
+else:
+    write_pi_artifact(path, pi, env_increasing, ranks=ranks, metadata=metadata)
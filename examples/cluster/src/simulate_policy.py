@@ -9,7 +9,9 @@ from mouselab.distributions import Categorical
 import math
 
 from mouselab.env_utils import get_ground_truths_from_json
-from mouselab.mouselab import MouselabEnv
+from mouselab.mouselab import EnvTemplate
+from mouselab.policy_artifacts import PolicyTable
+from mouselab.utils import paired_differences
 
 # --- Register test environments ---
 
@@ -140,6 +142,13 @@ trials_collected = {
     "unrewarded": unrewarded_trials
 }
 
+# Every policy plays trial i with the random stream seeded alike (common random
+# numbers), so tie-breaking and sampled term rewards are paired across policies
+trial_seeds = {
+    trial_type: [random.randrange(2 ** 32) for _ in trials]
+    for trial_type, trials in trials_collected.items()
+}
+
 # --- Policies to be simulated ---
 
 # Read the optimal policy for the given experiment_setting and environment
@@ -147,16 +156,22 @@ policy_file_name = (
     Path(__file__)
         .resolve()
         .parents[1]
-        .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_1}.pickle")
+        .joinpath(f"output/pi_dict_{experiment_setting}_{reward_pct_1}")
 )
 
-with open(policy_file_name, 'rb') as f:
-    opt_policy = pickle.load(f)["pi_dictionary"]
+if policy_file_name.is_dir():
+    # policy artifact, arrays are memory mapped rather than read
+    opt_policy = PolicyTable.from_artifact(policy_file_name)
+    best_actions = opt_policy.best_actions
+else:
+    with open(f"{policy_file_name}.pickle", 'rb') as f:
+        opt_policy = pickle.load(f)["pi_dictionary"]
+    best_actions = lambda state: opt_policy[state]["max_actions"]
 
 
 # Return the action of the optimal policy
 def optimal_policy(state):
-    possible_actions = opt_policy[state]["max_actions"]
+    possible_actions = best_actions(state)
     return random.choice(possible_actions)
 
 # Policy that clicks all the nodes at a given level in order and then terminates planning
@@ -188,16 +203,20 @@ save_click_sequences_of = ["optimal"]
 
 click_sequences = { policy: [] for policy in save_click_sequences_of }
 
+# Structure is shared by all trials, only the ground truth changes
+env_template = EnvTemplate.new_symmetric_registered(
+        experiment_setting, cost=base_cost * reward_pct_1,
+        term_belief=False, sample_term_reward=True
+)
+
 for policy in policies_to_simulate:
     print("Simulating policy: {}".format(policy))
     p_func = policy_functions[policy]
     for trial_type, trials in trials_collected.items():
         print("\t{}: {} trials".format(trial_type, len(trials)))
-        for trial in trials:
-            env = MouselabEnv.new_symmetric_registered(
-                    experiment_setting, ground_truth=trial, cost=base_cost * reward_pct_1,
-                    term_belief=False, sample_term_reward=True
-            )
+        for trial, trial_seed in zip(trials, trial_seeds[trial_type]):
+            random.seed(trial_seed)
+            env = env_template.instantiate(trial)
             clicks_made = []
             env._is_scarce = True if trial_type == "unrewarded" else False
             current_state = env.init
@@ -338,6 +357,28 @@ if len(overall_benefits) > 0:
     for policy, factor in overall_benefits.items():
         print("\t{0}: {1:0.4f}".format(policy, factor))
 
+if len(policies_to_simulate) > 1:
+    print("--- Paired score differences ---")
+    print("\n")
+    print("Score of each policy minus that of policy {}:\n".format(baseline_policy))
+    score_differences = paired_differences(
+        {
+            policy: combined_results[policy]["scores"]
+            for policy in policies_to_simulate
+        },
+        baseline_policy,
+    )
+    for policy, difference in score_differences.iterrows():
+        print(
+            "\t{0}: {1:0.3f} (SE {2:0.3f}, unpaired SE {3:0.3f})".format(
+                policy,
+                difference["mean_difference"],
+                difference["std_error"],
+                difference["unpaired_std_error"],
+            )
+        )
+    print("\n")
+
 if len(per_trial_benefits) > 0:
     print("--- Expected per trial Benefit ---")
     print("\n")
@@ -6,9 +6,12 @@ from abc import ABC
 from collections import defaultdict, deque
 from copy import deepcopy
 
+import joblib
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
+from mouselab.state_encoding import StateEncoder
 from mouselab.utils import clear_screen
 
 np.set_printoptions(precision=3, linewidth=200)
@@ -125,8 +128,38 @@ class Agent(ABC):
         self.i_episode += 1
         return dict(trace)
 
-    def run_many(self, num_episodes=None, pbar=True, track=(), **kwargs):
-        """Runs several episodes, returns a summary of results."""
+    def run_many(
+        self,
+        num_episodes=None,
+        pbar=True,
+        track=(),
+        n_jobs=None,
+        seed=None,
+        trace_buffer=None,
+        parallel=None,
+        **kwargs
+    ):
+        """
+        Runs several episodes, returns a summary of results
+        :param n_jobs: number of processes to shard the episodes across
+                    (as in joblib, -1 for all cores), by default episodes
+                    run in this process; only for agents that do not learn
+                    from episodes, as shards run on copies of the agent
+        :param parallel: joblib.Parallel to run the shards with (e.g. for
+                    its backend), by default one with n_jobs; episodes are
+                    sharded across its n_jobs unless n_jobs is given
+        :param seed: seed of the SeedSequence each episode gets a child of,
+                    seeding the rng of the policy and env (np.random and
+                    random are not reseeded); given a seed, results are
+                    identical for any n_jobs (a seed is drawn from np.random
+                    if n_jobs is given without one)
+        :param trace_buffer: TraceBuffer to add the episodes to instead of
+                    keeping every trace, e.g. TraceBuffer.from_env(env)
+        :return: dictionary of lists, one entry per episode and trace field,
+                    or trace_buffer if given
+        :raises ValueError: if episodes run in several jobs and the agent
+                    learns from them (see n_jobs)
+        """
         if not self.env:
             raise RegistrationError("No environment registered.")
         if not self.policy:
@@ -141,21 +174,85 @@ class Agent(ABC):
         elif isinstance(self.env, list):
             num_episodes = len(self.env)
 
-        data = defaultdict(list)
-        for episode_idx in tqdm(range(num_episodes), disable=not pbar):
-            if isinstance(self.env, list):
-                trace = self._run_specific_episode(
-                    self.env[episode_idx], self.policy, **kwargs
+        if parallel is not None and n_jobs is None:
+            n_jobs = parallel.n_jobs
+        if n_jobs is not None and joblib.effective_n_jobs(n_jobs) > 1:
+            if self._learns():
+                raise ValueError(
+                    "Agents that learn from episodes (memory, experience or "
+                    "finish_episode) can only run with n_jobs=1"
                 )
-            else:
-                trace = self._run_specific_episode(self.env, self.policy, **kwargs)
-
+        if seed is None and n_jobs is not None:
+            seed = np.random.randint(2 ** 32)
+        if seed is None:
+            seed_sequences = [None] * num_episodes
+        else:
+            seed_sequences = np.random.SeedSequence(seed).spawn(num_episodes)
+
+        if n_jobs is None or joblib.effective_n_jobs(n_jobs) == 1:
+            traces = _run_episodes(
+                self,
+                tqdm(range(num_episodes), disable=not pbar),
+                seed_sequences,
+                kwargs,
+                trace_buffer=trace_buffer,
+            )
+        else:
+            # each shard runs on a copy of this agent, starting at the episode
+            # count this agent would have reached serially
+            shards = np.array_split(
+                np.arange(num_episodes), joblib.effective_n_jobs(n_jobs)
+            )
+            if parallel is None:
+                parallel = joblib.Parallel(n_jobs=n_jobs)
+            shard_traces = parallel(
+                joblib.delayed(_run_episodes)(
+                    self,
+                    shard.tolist(),
+                    [seed_sequences[episode_idx] for episode_idx in shard],
+                    kwargs,
+                    start=self.i_episode + int(shard[0]),
+                    trace_buffer=None
+                    if trace_buffer is None
+                    else TraceBuffer(trace_buffer.encoder),
+                )
+                for shard in shards
+                if len(shard)
+            )
+            self.i_episode += num_episodes
+            if trace_buffer is not None:
+                for shard_buffer in shard_traces:
+                    trace_buffer.extend(shard_buffer)
+                return trace_buffer
+            traces = [trace for shard in shard_traces for trace in shard]
+
+        if trace_buffer is not None:
+            return trace_buffer
+        data = defaultdict(list)
+        for trace in traces:
             data["n_steps"].append(len(trace["states"]))
             for k, v in trace.items():
                 data[k].append(v)
 
         return dict(data)
 
+    def _learns(self):
+        """Whether episodes change the memory, policy or value functions."""
+        return self.memory is not None or any(
+            type(component).experience is not Component.experience
+            or type(component).finish_episode is not Component.finish_episode
+            for component in [self.policy, *self.value_functions]
+        )
+
+    def _seed_episode(self, seed_sequence, env):
+        """
+        Gives the policy and env of an episode random number generators of
+        their own, so the global ones (np.random, random) are left untouched
+        """
+        env_seed_sequence, = seed_sequence.spawn(1)
+        self.policy.rng = np.random.default_rng(seed_sequence)
+        env.rng = np.random.default_rng(env_seed_sequence)
+
     def _start_episode(self, state):
         self.policy.start_episode(state)
         for vf in self.value_functions:
@@ -191,6 +288,184 @@ class Agent(ABC):
             pass
 
 
+def _run_episodes(
+    agent, episode_indices, seed_sequences, kwargs, start=None, trace_buffer=None
+):
+    """
+    Runs the given episodes of Agent.run_many with agent, at module level so
+    that it can be sent to worker processes
+    :param start: episode count of the first episode of a shard, which then
+                runs on a copy of agent (shards may share memory, e.g. with
+                joblib's threading backend), by default agent runs from its
+                own count
+    :param trace_buffer: TraceBuffer to add the traces to and return,
+                by default the list of traces is returned
+    """
+    if start is not None:
+        agent = deepcopy(agent)
+        agent.i_episode = start
+    traces = []
+    for episode_idx, seed_sequence in zip(episode_indices, seed_sequences):
+        if isinstance(agent.env, list):
+            env = agent.env[episode_idx]
+        else:
+            env = agent.env
+        if seed_sequence is not None:
+            agent._seed_episode(seed_sequence, env)
+        trace = agent._run_specific_episode(env, agent.policy, **kwargs)
+        if trace_buffer is None:
+            traces.append(trace)
+        else:
+            trace_buffer.append(trace)
+    return traces if trace_buffer is None else trace_buffer
+
+
+class TraceBuffer(object):
+    """Steps of many episodes, stored column by column.
+
+    Each step is stored as the encoded belief state it was taken in (see
+    StateEncoder), its action, its reward and the index of its episode, and
+    episode_offsets holds the first step of each episode (and the total
+    number of steps). Columns are preallocated and grow geometrically, and
+    every property and export is a view of them, so nothing is copied.
+    """
+
+    def __init__(self, encoder, capacity=1024, growth=2):
+        """
+        :param encoder: StateEncoder of the environment the episodes run on
+        :param capacity: number of steps allocated up front
+        :param growth: factor capacity grows by once it is used up
+        """
+        self.encoder = encoder
+        self.growth = growth
+        # one contiguous row per node, so each node is a contiguous column
+        self._states = np.empty((encoder.num_nodes, capacity), dtype=encoder.dtype)
+        self._actions = np.empty(capacity, dtype=np.int64)
+        self._rewards = np.empty(capacity, dtype=np.float64)
+        self._episodes = np.empty(capacity, dtype=np.int64)
+        self._episode_offsets = np.zeros(max(capacity // 4, 1) + 1, dtype=np.int64)
+        self.num_steps = 0
+        self.num_episodes = 0
+
+    @classmethod
+    def from_env(cls, env, **kwargs):
+        return cls(StateEncoder.from_env(env), **kwargs)
+
+    def __len__(self):
+        return self.num_episodes
+
+    @property
+    def capacity(self):
+        return len(self._actions)
+
+    @property
+    def states(self):
+        """(number of steps, number of nodes) array of codes."""
+        return self._states[:, : self.num_steps].T
+
+    @property
+    def actions(self):
+        return self._actions[: self.num_steps]
+
+    @property
+    def rewards(self):
+        return self._rewards[: self.num_steps]
+
+    @property
+    def episodes(self):
+        """Index of the episode (i_episode of its trace) of each step."""
+        return self._episodes[: self.num_steps]
+
+    @property
+    def episode_offsets(self):
+        return self._episode_offsets[: self.num_episodes + 1]
+
+    def _grow(self, array, size):
+        capacity = array.shape[-1]
+        while capacity < size:
+            capacity = int(np.ceil(capacity * self.growth))
+        if capacity == array.shape[-1]:
+            return array
+        grown = np.empty((*array.shape[:-1], capacity), dtype=array.dtype)
+        grown[..., : array.shape[-1]] = array
+        return grown
+
+    def _reserve(self, num_steps, num_episodes):
+        size = self.num_steps + num_steps
+        self._states = self._grow(self._states, size)
+        self._actions = self._grow(self._actions, size)
+        self._rewards = self._grow(self._rewards, size)
+        self._episodes = self._grow(self._episodes, size)
+        self._episode_offsets = self._grow(
+            self._episode_offsets, self.num_episodes + num_episodes + 1
+        )
+
+    def append(self, trace):
+        """Adds an episode trace, as returned by Agent.run_episode."""
+        num_steps = len(trace["actions"])
+        self._reserve(num_steps, 1)
+        steps = slice(self.num_steps, self.num_steps + num_steps)
+        # the final (terminal) state has no action
+        self._states[:, steps] = self.encoder.encode_many(
+            trace["states"][:num_steps]
+        ).T
+        self._actions[steps] = trace["actions"]
+        self._rewards[steps] = trace["rewards"]
+        self._episodes[steps] = trace["i_episode"]
+        self.num_steps += num_steps
+        self.num_episodes += 1
+        self._episode_offsets[self.num_episodes] = self.num_steps
+
+    def extend(self, other):
+        """Adds the episodes of another TraceBuffer, after those of this one."""
+        self._reserve(other.num_steps, other.num_episodes)
+        steps = slice(self.num_steps, self.num_steps + other.num_steps)
+        self._states[:, steps] = other._states[:, : other.num_steps]
+        self._actions[steps] = other.actions
+        self._rewards[steps] = other.rewards
+        self._episodes[steps] = other.episodes
+        offsets = other.episode_offsets[1:] + self.num_steps
+        self._episode_offsets[self.num_episodes + 1 :][: len(offsets)] = offsets
+        self.num_steps += other.num_steps
+        self.num_episodes += other.num_episodes
+
+    def episode(self, idx):
+        """Columns of the steps of the idx-th episode in the buffer."""
+        steps = slice(self._episode_offsets[idx], self._episode_offsets[idx + 1])
+        return {
+            "states": self.states[steps],
+            "actions": self.actions[steps],
+            "rewards": self.rewards[steps],
+        }
+
+    def returns(self):
+        """Return of each episode."""
+        if not self.num_episodes:
+            return np.zeros(0)
+        # episodes have at least one step (terminating)
+        return np.add.reduceat(self.rewards, self.episode_offsets[:-1])
+
+    def _columns(self):
+        states = self._states[:, : self.num_steps]
+        return {
+            "episode": self.episodes,
+            "action": self.actions,
+            "reward": self.rewards,
+            **{f"node_{node}": states[node] for node in range(self.encoder.num_nodes)},
+        }
+
+    def to_pandas(self):
+        """DataFrame with one row per step, a column per node for states."""
+        return pd.DataFrame(self._columns(), copy=False)
+
+    def to_arrow(self):
+        """pyarrow Table with the columns of to_pandas (needs pyarrow)."""
+        import pyarrow as pa
+
+        columns = self._columns()
+        return pa.Table.from_arrays(list(columns.values()), names=list(columns))
+
+
 class Component(ABC):
     """A very abstract base class."""
 
@@ -268,46 +543,166 @@ class Component(ABC):
 
 
 class Memory(object):
-    """Remembers past experiences."""
+    """Remembers past experiences in a fixed size ring buffer of arrays.
+
+    Each step of an episode is stored with its state, action, reward, the
+    return from that step on, its episode and whether it ended the episode.
+    Once size steps are stored, the oldest steps are overwritten. Rows are
+    indexed directly (e.g. memory.returns[memory.batch(100)]) in O(1).
+    """
+
+    def __init__(self, size=100000, encoder=None):
+        """
+        :param size: maximum number of steps remembered
+        :param encoder: StateEncoder to store belief states as codes, by
+                    default that of the first state added if it is a belief
+                    state (the initial state) with categorical priors; other
+                    belief states are stored as objects, and any other
+                    states must be numeric arrays (e.g. features)
+        """
+        self.size = size
+        self.encoder = encoder
+        self._states = None
+        self._object_states = False
+        self._actions = np.empty(size, dtype=np.int64)
+        self._rewards = np.empty(size, dtype=np.float64)
+        self._returns = np.empty(size, dtype=np.float64)
+        self._episodes = np.empty(size, dtype=np.int64)
+        self._dones = np.empty(size, dtype=bool)
+        # index, first row and length of the last episodes, oldest first
+        self._episode_rows = deque(maxlen=size)
+        self._next_row = 0
+        self.num_steps = 0
+        self.num_episodes = 0
+
+    def __len__(self):
+        return self.num_steps
+
+    @property
+    def states(self):
+        return self._states[: self.num_steps]
+
+    @property
+    def actions(self):
+        return self._actions[: self.num_steps]
 
-    def __init__(self, size=100000):
-        self.states = deque(maxlen=size)
-        self.actions = deque(maxlen=size)
-        self.rewards = deque(maxlen=size)
-        self.returns = deque(maxlen=size)
+    @property
+    def rewards(self):
+        return self._rewards[: self.num_steps]
+
+    @property
+    def returns(self):
+        """Sum of the rewards from each step to the end of its episode."""
+        return self._returns[: self.num_steps]
+
+    @property
+    def episodes(self):
+        return self._episodes[: self.num_steps]
+
+    @property
+    def dones(self):
+        """Whether each step ended its episode."""
+        return self._dones[: self.num_steps]
+
+    def _encode(self, states):
+        if self._states is None and self.encoder is None:
+            if any(hasattr(entry, "sample") for entry in states[0]):
+                try:
+                    self.encoder = StateEncoder(states[0])
+                except ValueError:
+                    # e.g. Normal priors, belief states are stored as objects
+                    self._object_states = True
+        if self.encoder is not None:
+            return self.encoder.encode_many(states)
+        if self._object_states:
+            encoded = np.empty(len(states), dtype=object)
+            for idx, state in enumerate(states):
+                encoded[idx] = state
+            return encoded
+        return np.asarray(states, dtype=np.float64).reshape(len(states), -1)
 
     def add(self, trace):
-        self.states.extend(trace["states"])
-        self.actions.extend(trace["actions"])
-        self.actions.append(None)
-        self.rewards.extend(trace["rewards"])
-        self.rewards.append(0)
-        self.returns.extend(np.flip(np.cumsum(np.flip(trace["rewards"], 0)), 0))
-        self.returns.append(0)
-
-        # self.experiences.extend(
-        #     zip(
-        #         trace["states"][:-1],
-        #         trace["actions"],
-        #         # trace['states'][1:],
-        #         trace["rewards"],
-        #         np.flip(np.cumsum(np.flip(trace["rewards"], 0)), 0),
-        #     )
-        # )
-        # self.deque.append({"states": states, "rewards": rewards, "returns": returns})
-
-    # def episodes(self, size, n=1):
-    #     size = min(size, len(self.deque))
-    #     if not self.deque:
-    #         return
-    #     for _ in range(n):
-    #         yield np.random.choice(self.deque, size, replace=False)
-
-    def batch(self, size):
-        size = min(size, len(self.states))
-        idx = np.random.choice(len(self.states), size=size, replace=False)
+        """Adds the steps of an episode trace (the final state has no step)."""
+        rewards = np.asarray(trace["rewards"], dtype=np.float64)
+        num_steps = len(rewards)
+        states = self._encode(trace["states"][:num_steps])
+        if self._states is None:
+            self._states = np.empty((self.size, *states.shape[1:]), states.dtype)
+
+        returns = np.cumsum(rewards[::-1])[::-1]
+        dones = np.zeros(num_steps, dtype=bool)
+        dones[-1:] = True
+
+        # an episode longer than the memory only keeps its last steps
+        kept = slice(max(num_steps - self.size, 0), num_steps)
+        rows = (self._next_row + np.arange(kept.stop - kept.start)) % self.size
+        self._states[rows] = states[kept]
+        self._actions[rows] = np.asarray(trace["actions"])[kept]
+        self._rewards[rows] = rewards[kept]
+        self._returns[rows] = returns[kept]
+        self._episodes[rows] = self.num_episodes
+        self._dones[rows] = dones[kept]
+
+        self._episode_rows.append((self.num_episodes, self._next_row, len(rows)))
+        self._next_row = (self._next_row + len(rows)) % self.size
+        self.num_steps = min(self.num_steps + len(rows), self.size)
+        self.num_episodes += 1
+
+    def batch(self, size, rng=None):
+        """
+        Returns indices of up to size distinct random steps
+        :param rng: np.random.Generator to draw from, by default np.random
+        """
+        size = min(size, len(self))
+        idx = (np.random if rng is None else rng).choice(
+            len(self), size=size, replace=False
+        )
         return idx
-        # return (self.experiences[i] for i in idx)
+
+    def sample(self, size, rng=None):
+        """Gathers up to size random steps, as a dictionary of arrays."""
+        idx = self.batch(size, rng=rng)
+        return {
+            "states": self._states[idx],
+            "actions": self._actions[idx],
+            "rewards": self._rewards[idx],
+            "returns": self._returns[idx],
+            "dones": self._dones[idx],
+        }
+
+    def _complete_episodes(self):
+        # an episode is complete as long as its first step is not overwritten
+        return [
+            (first_row, num_steps)
+            for episode, first_row, num_steps in self._episode_rows
+            if self._episodes[first_row] == episode
+        ]
+
+    def _episode_steps(self, first_row, num_steps):
+        rows = (first_row + np.arange(num_steps)) % self.size
+        return {
+            "states": self._states[rows],
+            "actions": self._actions[rows],
+            "rewards": self._rewards[rows],
+            "returns": self._returns[rows],
+        }
+
+    def episode(self, idx=-1):
+        """Steps of the idx-th remembered episode (by default the last one)."""
+        return self._episode_steps(*self._complete_episodes()[idx])
+
+    def sample_episodes(self, n, rng=None):
+        """
+        Returns the steps of n random remembered episodes (with replacement)
+        :param rng: np.random.Generator to draw from, by default np.random
+        """
+        episodes = self._complete_episodes()
+        return [
+            self._episode_steps(*episodes[idx])
+            for idx in (np.random if rng is None else rng).choice(
+                len(episodes), size=n
+            )
+        ]
 
 
 # class Memory(object):
@@ -348,9 +743,18 @@ class Model(object):
     """Simulated environment"""
 
     def __init__(self, env):
-        self.env = deepcopy(env)
+        # envs with a successor function are not changed by planning
+        self.env = env if hasattr(env, "successor") else deepcopy(env)
 
-    def options(self, state):
+    def options(self, state, last_action=None):
+        """
+        Yields action, next state, reward and done for each action in state
+        :param last_action: action taken before state, for costs depending on it
+        """
+        if hasattr(self.env, "successor"):
+            for a in self.env.actions(state):
+                yield (a, *self.env.successor(state, a, last_action))
+            return
         for a in range(self.env.action_space.n):
             self.env._state = state
             obs, r, done, info = self.env.step(a)
@@ -1,7 +1,91 @@
-from itertools import chain
-
+import numpy as np
 from scipy.spatial import distance
 
+from mouselab.graph_utils import adjacency_list_from_graph
+
+
+def node_bitmask(nodes):
+    """
+    :param nodes: iterable of integer nodes
+    :return: integer with the bit of every node in nodes set
+    """
+    mask = 0
+    for node in nodes:
+        mask |= 1 << node
+    return mask
+
+
+def node_attribute(property_name, node, graph=None, context=None):
+    """
+    Reads node property from the columnar arrays in context if available,
+    otherwise from the networkx mdp_graph
+    """
+    if context is not None:
+        return context.node_attributes[property_name][node]
+    else:
+        return graph.nodes[node][property_name]
+
+
+class CostContext:
+    """
+    Bitset index of the revealed nodes of a MouselabEnv, together with
+    precomputed predecessor and successor bitmasks for every node.
+
+    The env updates the index whenever a node is revealed, so cost functions
+    compiled against it can answer "is this node next to a revealed node?"
+    with a single bitwise and instead of scanning the mdp graph.
+
+    Cost functions using the context set `uses_context` and declare which parts
+    of the episode history they read in `history` ("last_action", "revealed"),
+    so the exact solver can fold these into its state key.
+    """
+
+    def __init__(self, tree, revealed=(), node_attributes=None):
+        """
+        :param tree: adjacency list
+        :param revealed: nodes that start out revealed
+        :param node_attributes: columnar node properties (e.g. depth, cluster, layout)
+                    as from mouselab.graph_utils.node_attributes_from_adjacency_list
+        """
+        self.num_nodes = len(tree)
+        self.node_attributes = node_attributes if node_attributes is not None else {}
+
+        parents = [[] for _ in tree]
+        for node, children in enumerate(tree):
+            for child in children:
+                parents[child].append(node)
+
+        self.successor_masks = [node_bitmask(children) for children in tree]
+        self.predecessor_masks = [node_bitmask(nodes) for nodes in parents]
+        self.revealed = node_bitmask(revealed)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Builds context from mdp_graph as networkx DiGraph,
+        reading the revealed property of every node
+        """
+        revealed = [node for node, info in graph.nodes(data=True) if info["revealed"]]
+        return cls(adjacency_list_from_graph(graph), revealed=revealed)
+
+    def reveal(self, node):
+        self.revealed |= 1 << node
+
+    def is_revealed(self, node):
+        return bool(self.revealed >> node & 1)
+
+    def revealed_nodes(self):
+        return [node for node in range(self.num_nodes) if self.is_revealed(node)]
+
+    def revealed_array(self):
+        return np.array([self.is_revealed(node) for node in range(self.num_nodes)])
+
+    def copy(self):
+        """Copy sharing the (static) neighbor masks but not the revealed set"""
+        context = object.__new__(CostContext)
+        context.__dict__.update(self.__dict__)
+        return context
+
 
 def linear_depth(static_cost_weight, depth_cost_weight):
     """
@@ -13,11 +97,13 @@ def linear_depth(static_cost_weight, depth_cost_weight):
     """
 
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
-        depth = graph.nodes[node]["depth"]
+    def cost_function(node, last_action=None, graph=None, context=None):
+        depth = node_attribute("depth", node, graph=graph, context=context)
         # if depth is 0 it is initial node so we return 0
         return -(1 * static_cost_weight + depth * depth_cost_weight) if depth > 0 else 0
 
+    cost_function.uses_context = True
+    cost_function.history = ()
     return cost_function
 
 
@@ -34,15 +120,19 @@ def side_cost(given_cost, side_preferences):
     if abs(1.0 - sum(side_preferences.values())) > 0.001:
         raise ValueError("Side preferences array must sum to 1")
 
+    equitable_distribution = 1 / len(side_preferences)
+    adjusted_side_preferences = {
+        cluster: pref / equitable_distribution * given_cost
+        for cluster, pref in side_preferences.items()
+    }
+
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
-        equitable_distribution = 1 / len(side_preferences)
-        adjusted_side_preferences = {
-            cluster: pref / equitable_distribution * given_cost
-            for cluster, pref in side_preferences.items()
-        }
-        return -(adjusted_side_preferences[graph.nodes[node]["cluster"]])
+    def cost_function(node, last_action=None, graph=None, context=None):
+        cluster = node_attribute("cluster", node, graph=graph, context=context)
+        return -(adjusted_side_preferences[cluster])
 
+    cost_function.uses_context = True
+    cost_function.history = ()
     return cost_function
 
 
@@ -65,20 +155,24 @@ def distance_graph_cost(
     """
 
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
+    def cost_function(node, last_action=None, graph=None, context=None):
         """
         :param node: node that is clicked on
         :param last_action: action before this (can be non-revealing action if recorded)
+        :param context: CostContext of the env, graph is used if not provided
         """
 
         distance = distance_function(
-            graph.nodes[node]["layout"], graph.nodes[last_action]["layout"]
+            node_attribute("layout", node, graph=graph, context=context),
+            node_attribute("layout", last_action, graph=graph, context=context),
         )
         if max_penalty is None:
             return -(given_cost * 1 + distance_multiplier * distance)
         else:
             return -min((given_cost + distance_multiplier * distance), max_penalty)
 
+    cost_function.uses_context = True
+    cost_function.history = ("last_action",)
     return cost_function
 
 
@@ -96,26 +190,30 @@ def backward_search_cost(added_cost=1, inspection_cost=1, include_start=False):
         include_start = bool(include_start)
 
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
+    def cost_function(
+        node, last_action=None, graph=None, context=None, revealed=None
+    ):
         """
         :param node: node that is clicked on
         :param last_action: action before this (can be non-revealing action if recorded)
+        :param context: CostContext of the env, built from graph if not provided
+        :param revealed: bitmask of revealed nodes, overriding the one in context
         """
-
-        revealed_nodes = [
-            node for node, info in graph.nodes(data=True) if info["revealed"]
-        ]
-
+        if context is None:
+            context = CostContext.from_graph(graph)
+        if revealed is None:
+            revealed = context.revealed
         if not include_start:
-            revealed_nodes.remove(0)
-
-        predecessors = chain(*(graph.predecessors(state) for state in revealed_nodes))
+            revealed &= ~1
 
-        if node in predecessors:
+        # node is a predecessor of a revealed node iff a successor is revealed
+        if context.successor_masks[node] & revealed:
             return -(inspection_cost + added_cost)
         else:
             return -(inspection_cost)
 
+    cost_function.uses_context = True
+    cost_function.history = ("revealed",)
     return cost_function
 
 
@@ -133,25 +231,30 @@ def forward_search_cost(added_cost=1, inspection_cost=1, include_start=False):
         include_start = bool(include_start)
 
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
+    def cost_function(
+        node, last_action=None, graph=None, context=None, revealed=None
+    ):
         """
         :param node: node that is clicked on
         :param last_action: action before this (can be non-revealing action if recorded)
+        :param context: CostContext of the env, built from graph if not provided
+        :param revealed: bitmask of revealed nodes, overriding the one in context
         """
-        revealed_nodes = [
-            node for node, info in graph.nodes(data=True) if info["revealed"]
-        ]
-
+        if context is None:
+            context = CostContext.from_graph(graph)
+        if revealed is None:
+            revealed = context.revealed
         if not include_start:
-            revealed_nodes.remove(0)
-
-        successors = chain(*(graph.successors(state) for state in revealed_nodes))
+            revealed &= ~1
 
-        if node in successors:
+        # node is a successor of a revealed node iff a predecessor is revealed
+        if context.predecessor_masks[node] & revealed:
             return -(inspection_cost + added_cost)
         else:
             return -(inspection_cost)
 
+    cost_function.uses_context = True
+    cost_function.history = ("revealed",)
     return cost_function
 
 
@@ -169,23 +272,28 @@ def neighbor_search_cost(added_cost=1, inspection_cost=1, include_start=False):
         include_start = bool(include_start)
 
     # construct function, avoiding lambda for kwarg
-    def cost_function(node, last_action=None, graph=None):
+    def cost_function(
+        node, last_action=None, graph=None, context=None, revealed=None
+    ):
         """
         :param node: node that is clicked on
         :param last_action: action before this (can be non-revealing action if recorded)
+        :param context: CostContext of the env, built from graph if not provided
+        :param revealed: bitmask of revealed nodes, overriding the one in context
         """
-        revealed_nodes = [
-            node for node, info in graph.nodes(data=True) if info["revealed"]
-        ]
-
+        if context is None:
+            context = CostContext.from_graph(graph)
+        if revealed is None:
+            revealed = context.revealed
         if not include_start:
-            revealed_nodes.remove(0)
-
-        neighbors = chain(*(graph.neighbors(state) for state in revealed_nodes))
+            revealed &= ~1
 
-        if node in neighbors:
+        # neighbors in a DiGraph are successors, so same check as forward search
+        if context.predecessor_masks[node] & revealed:
             return -(inspection_cost + added_cost)
         else:
             return -(inspection_cost)
 
+    cost_function.uses_context = True
+    cost_function.history = ("revealed",)
     return cost_function
@@ -4,10 +4,11 @@ from itertools import product
 
 import dill as pickle
 import numpy as np
-from more_itertools import powerset
+from more_itertools import chunked, powerset
 
 from mouselab.distributions import Categorical
 from mouselab.mouselab import MouselabEnv
+from mouselab.state_encoding import CHUNK_SIZE, StateEncoder, deduplicate_codes
 
 
 def get_possible_states_for_ground_truth(ground_truth, unrevealed_state):
@@ -69,6 +70,105 @@ def get_all_possible_states_for_ground_truths_gen(categorical_gym_env, ground_tr
             yield state;
 
 
+class GroundTruthStates(object):
+    """Distinct belief states reachable for a list of ground truths.
+
+    The states of all ground truths are enumerated as one trie over the nodes:
+    at each node a state either leaves the node unrevealed, or reveals one of
+    the values the ground truths still consistent with the state take there.
+    States shared by several ground truths are therefore generated once.
+    Once a single ground truth is left, its remaining states are all subsets
+    of the remaining nodes, generated in one go.
+    """
+
+    def __init__(self, categorical_gym_env, ground_truths):
+        """
+        :param categorical_gym_env, instance of MouselabEnv
+                    with categorical or revealed states only
+        :param ground_truths: iterable of ground truths (values behind nodes)
+        """
+        self.encoder = StateEncoder.from_env(categorical_gym_env)
+        ground_truths = list(ground_truths)
+        self.num_ground_truths = len(ground_truths)
+        self.codes = np.unique(self.encoder.encode_many(ground_truths), axis=0)
+        self.clickable = self.encoder.radices > 1
+        # number of clickable nodes from each node on
+        self._remaining_clickable = np.cumsum(self.clickable[::-1])[::-1].tolist() + [0]
+        self._num_distinct_states = None
+
+    @property
+    def num_states(self):
+        """Number of states over all ground truths, counting shared states again."""
+        return self.num_ground_truths * 2 ** int(self.clickable.sum())
+
+    @property
+    def num_distinct_states(self):
+        if self._num_distinct_states is None:
+            self._num_distinct_states = self._count(0, np.arange(len(self.codes)))
+        return self._num_distinct_states
+
+    @property
+    def num_shared_states(self):
+        """Number of states not generated again thanks to sharing."""
+        return self.num_states - self.num_distinct_states
+
+    def _children(self, node, ground_truths):
+        """Ground truths consistent with each way of handling node."""
+        yield 0, ground_truths
+        if self.clickable[node]:
+            values = self.codes[ground_truths, node]
+            for value in np.unique(values):
+                yield value, ground_truths[values == value]
+
+    def _count(self, node, ground_truths):
+        if len(ground_truths) == 1:
+            return 2 ** self._remaining_clickable[node]
+        elif node == self.encoder.num_nodes:
+            return 1
+        return sum(
+            self._count(node + 1, consistent)
+            for _, consistent in self._children(node, ground_truths)
+        )
+
+    def _iter_blocks(self, node, prefix, ground_truths):
+        if len(ground_truths) == 1:
+            # all subsets of the remaining clickable nodes
+            nodes = np.flatnonzero(self.clickable[node:]) + node
+            subsets = np.arange(2 ** len(nodes))[:, None] >> np.arange(len(nodes)) & 1
+            block = np.zeros((len(subsets), self.encoder.num_nodes), self.encoder.dtype)
+            block[:, :node] = prefix
+            block[:, nodes] = subsets * self.codes[ground_truths[0], nodes]
+            yield block
+        elif node == self.encoder.num_nodes:
+            yield np.array([prefix], dtype=self.encoder.dtype)
+        else:
+            for value, consistent in self._children(node, ground_truths):
+                yield from self._iter_blocks(node + 1, prefix + [value], consistent)
+
+    def iter_codes(self, chunk_size=CHUNK_SIZE):
+        """Yields codes of the distinct states in chunks of at most chunk_size."""
+        blocks, num_rows = [], 0
+        for block in self._iter_blocks(0, [], np.arange(len(self.codes))):
+            blocks.append(block)
+            num_rows += len(block)
+            while num_rows >= chunk_size:
+                codes = np.concatenate(blocks)
+                yield codes[:chunk_size]
+                blocks, num_rows = [codes[chunk_size:]], len(codes) - chunk_size
+        if num_rows:
+            yield np.concatenate(blocks)
+
+    def iter_states(self, chunk_size=CHUNK_SIZE):
+        """Yields the distinct states as tuples."""
+        for codes in self.iter_codes(chunk_size=chunk_size):
+            yield from self.encoder.decode_many(codes)
+
+    def ranks(self):
+        """Sorted ranks of the distinct states (e.g. for partial policy tables)."""
+        ranks = [self.encoder.rank(codes) for codes in self.iter_codes()]
+        return np.sort(np.concatenate(ranks)) if ranks else np.array([], np.int64)
+
+
 def get_all_possible_states_for_ground_truths(categorical_gym_env, ground_truths):
     """
     Get all possible states for a list of ground truths
@@ -87,60 +187,63 @@ def get_all_possible_states_for_ground_truths(categorical_gym_env, ground_truths
 
     return all_states
 
-def get_all_possible_states_for_env_gen(categorical_gym_env):
+def get_all_possible_states_for_env_gen(categorical_gym_env, chunk_size=CHUNK_SIZE):
     """
-    Gets all possible states for a MouselabEnv
+    Yields all possible states for a MouselabEnv, walking the belief states
+    directly so that no duplicates are ever generated
     :param categorical_gym_env, instance of MouselabEnv
                 with categorical or revealed states only
-    :return: a list of all possible states
+    :param chunk_size: number of states decoded at once
+    :return: generator of all possible states as lists
                 (i.e. for all ground truths, all possibly uncovered nodes)
     """
-    possible_ground_truths = get_all_possible_ground_truths(categorical_gym_env)
+    encoder = StateEncoder.from_env(categorical_gym_env)
+    for state in encoder.iter_states(chunk_size=chunk_size):
+        yield list(state)
 
-    all_states = get_all_possible_states_for_ground_truths_gen(
-        categorical_gym_env, possible_ground_truths
-    )
 
-    return all_states
+def get_all_possible_encoded_states_for_env(
+    categorical_gym_env, chunk_size=CHUNK_SIZE
+):
+    """
+    Yields all possible states for a MouselabEnv as chunks of integer codes
+    (see mouselab.state_encoding), using memory bounded by chunk_size
+    :param categorical_gym_env, instance of MouselabEnv
+                with categorical or revealed states only
+    :return: generator of (chunk size, number of nodes) arrays
+    """
+    encoder = StateEncoder.from_env(categorical_gym_env)
+    yield from encoder.iter_codes(chunk_size=chunk_size)
+
 
 def get_all_possible_states_for_env(categorical_gym_env):
     """
     Gets all possible states for a MouselabEnv
     :param categorical_gym_env, instance of MouselabEnv
                 with categorical or revealed states only
-    :return: a list of all possible states
+    :return: a list of all possible states, without duplicates
                 (i.e. for all ground truths, all possibly uncovered nodes)
     """
-    possible_ground_truths = get_all_possible_ground_truths(categorical_gym_env)
-
-    all_states = get_all_possible_states_for_ground_truths(
-        categorical_gym_env, possible_ground_truths
-    )
-
-    return all_states
+    return list(get_all_possible_states_for_env_gen(categorical_gym_env))
 
 
 def deduplicate_states(complete_states, replacement_value=0, verbose=True):
     """
     Deduplicates states
     :param complete_states, a list of states
-    :param replacement_value, a value that is not possible
-                in any of the categorical distributions
+    :param replacement_value, unused, kept for backwards compatibility
+                (unrevealed nodes are now tracked separately from revealed values)
     :param verbose whether to print out resulting size of deduplication
     :return: list of deduplicated states
     """
     complete_states = np.asarray(complete_states)
-    # deduplicate states
-    states_to_deduplicate = complete_states.copy()
-    states_to_deduplicate[
-        np.where(
-            np.vectorize(lambda entry: isinstance(entry, Categorical))(
-                states_to_deduplicate
-            )
-        )
-    ] = replacement_value
+    # deduplicate on whether each node is revealed and on the revealed values
+    is_dist = np.vectorize(lambda entry: hasattr(entry, "sample"), otypes=[bool])(
+        complete_states
+    )
+    values = np.where(is_dist, 0, complete_states).astype(np.float64)
     states, indices = np.unique(
-        states_to_deduplicate.astype(np.float64), return_index=True, axis=0
+        np.hstack([is_dist, values]), return_index=True, axis=0
     )
 
     if verbose:
@@ -150,7 +253,35 @@ def deduplicate_states(complete_states, replacement_value=0, verbose=True):
             )
         )
 
-    return complete_states[indices, :]
+    return complete_states[np.sort(indices), :]
+
+
+def deduplicate_states_gen(
+    states,
+    categorical_gym_env,
+    chunk_size=CHUNK_SIZE,
+    spill_directory=None,
+    num_partitions=64,
+):
+    """
+    Deduplicates an iterable of states without holding all of them in memory
+    :param states: iterable of states
+    :param categorical_gym_env, instance of MouselabEnv
+                with categorical or revealed states only
+    :param chunk_size: number of states encoded at once
+    :param spill_directory: directory to spill partitioned states to
+                if the states seen do not fit in memory (see deduplicate_codes)
+    :return: generator of deduplicated states as lists
+    """
+    encoder = StateEncoder.from_env(categorical_gym_env)
+    chunks = (
+        encoder.encode_many(chunk) for chunk in chunked(states, chunk_size)
+    )
+    for codes in deduplicate_codes(
+        chunks, spill_directory=spill_directory, num_partitions=num_partitions
+    ):
+        for state in encoder.decode_many(codes):
+            yield list(state)
 
 
 def get_sa_pairs_from_states(states):
@@ -176,17 +307,14 @@ def get_all_possible_sa_pairs_for_env(
     Gets all possible (state, action) pairs for a Categorical gym environment
     :param categorical_gym_env, instance of MouselabEnv
                 with categorical or revealed states only
-    :param replacement_value, a value that is not possible
-                in any of the categorical distributions
-    :param verbose whether to print out resulting size of deduplication
+    :param replacement_value, unused, states are no longer deduplicated
+    :param verbose unused, states are no longer deduplicated
     :return: list of all state, action pairs as tuples
     """
-    all_states = get_all_possible_states_for_env(categorical_gym_env)
-    dedup_states = deduplicate_states(
-        all_states, replacement_value=replacement_value, verbose=verbose
-    )
+    # states are enumerated without duplicates, no need to deduplicate
+    all_states = get_all_possible_states_for_env_gen(categorical_gym_env)
 
-    all_sa_pairs = get_sa_pairs_from_states(dedup_states)
+    all_sa_pairs = get_sa_pairs_from_states(all_states)
 
     return all_sa_pairs
 
@@ -1,40 +1,28 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 from contexttimer import Timer
-from joblib import Parallel, delayed
-from skopt import gp_minimize
-from toolz import partition_all
+from joblib import Parallel, delayed, effective_n_jobs
+from skopt import Optimizer, gp_minimize
 
 from mouselab.agents import Agent
 from mouselab.exact import solve
 from mouselab.policies import FunctionPolicy, LiederPolicy, MaxQPolicy
-from mouselab.utils import cum_returns
+from mouselab.utils import cum_returns, paired_differences
 from mouselab.value_functions import LiederQ
 
-__ENVS = None
-__AGENT = Agent()
-__CHUNKS = None
-
-
-def eval_one(i):
-    __AGENT.register(__ENVS[i])
-    return __AGENT.run_episode()["return"]
-
-
-def eval_chunk(i, return_mean=True):
-    # Each process should start with a different random seed.
-    np.random.seed(np.random.randint(1000) + i)
-    returns = []
-    for env in __CHUNKS[i]:
-        __AGENT.register(env)
-        returns.append(__AGENT.run_episode()["return"])
-    if return_mean:
-        return np.mean(returns)
-    else:
-        return returns
 
-
-def get_util(policy, envs, parallel=None, return_mean=True):
+def get_util(policy, envs, parallel=None, return_mean=True, seed=None):
+    """
+    Returns of policy on envs (or their mean)
+    :param parallel: joblib.Parallel to run the episodes with, sharded across
+                its n_jobs
+    :param seed: seed of the episodes when run in parallel (see Agent.run_many),
+                results do not depend on the number of jobs given a seed
+    """
     if parallel is None:
         util = evaluate(policy, envs).util
         if return_mean:
@@ -42,17 +30,72 @@ def get_util(policy, envs, parallel=None, return_mean=True):
         else:
             return util
     else:
-        np.random.randint(1000)  # cycle the random number generator
-        global __CHUNKS
-        chunk_size = len(envs) // parallel.n_jobs
-        __CHUNKS = list(partition_all(chunk_size, envs))
-        __AGENT.register(policy)
-        jobs = (delayed(eval_chunk)(i, return_mean) for i in range(len(__CHUNKS)))
-        result = parallel(jobs)
+        agent = Agent()
+        agent.register(list(envs))
+        agent.register(policy)
+        returns = agent.run_many(pbar=False, parallel=parallel, seed=seed)["return"]
         if return_mean:
-            return np.mean(result)
+            return np.mean(returns)
         else:
-            return np.concatenate(result)
+            return np.array(returns)
+
+
+def evaluate_sequential(
+    policy,
+    envs,
+    target_std_error,
+    batch_size=100,
+    incumbent=None,
+    z=2.0,
+    parallel=None,
+    seed=None,
+):
+    """
+    Estimates the mean return of policy running episodes on envs in batches,
+    stopping early once the estimate is precise enough or the policy is
+    clearly worse than an incumbent
+    :param envs: envs to run episodes on, in order, at most all of them
+    :param target_std_error: standard error of the mean return to stop at
+    :param batch_size: number of episodes between checks
+    :param incumbent: mean return of the best policy so far; evaluation stops
+                once the mean return is z standard errors below it
+    :param parallel: joblib.Parallel to run the batches with (see get_util)
+    :return: dictionary with the mean return (util), its standard error,
+                the number of episodes run and why evaluation stopped
+                ("precision", "worse" or "envs" if all envs were used)
+    """
+    envs = list(envs)
+    returns = []
+    stopped = "envs"
+    for start in range(0, len(envs), batch_size):
+        batch_seed = None if seed is None else seed + start
+        returns.extend(
+            get_util(
+                policy,
+                envs[start:start + batch_size],
+                parallel,
+                return_mean=False,
+                seed=batch_seed,
+            )
+        )
+        if len(returns) < 2:
+            continue
+        util = np.mean(returns)
+        std_error = np.std(returns, ddof=1) / np.sqrt(len(returns))
+        if std_error <= target_std_error:
+            stopped = "precision"
+            break
+        if incumbent is not None and util + z * std_error < incumbent:
+            stopped = "worse"
+            break
+
+    std_error = np.std(returns, ddof=1) / np.sqrt(len(returns)) if returns else np.nan
+    return {
+        "util": np.mean(returns) if returns else np.nan,
+        "std_error": std_error,
+        "n_episodes": len(returns),
+        "stopped": stopped,
+    }
 
 
 def get_q_error(theta, envs, parallel=None):
@@ -85,6 +128,98 @@ def evaluate(policy, envs):
     return pd.DataFrame(run_env(policy, env) for env in envs)
 
 
+def _action_probabilities(policy, env, state, last_action):
+    if hasattr(policy, "action_distribution"):
+        probabilities = policy.action_distribution(state)
+        return [(a, p) for a, p in enumerate(probabilities) if p > 0]
+    # some policies read the state of the env rather than their argument
+    env._state = state
+    env.last_action = last_action
+    return [(policy.act(state), 1.0)]
+
+
+def evaluate_policy_exact(policy, env):
+    """
+    Computes the expected performance of a policy on env exactly, by
+    propagating the probability of reaching each belief state the policy can
+    reach, so that there is no sampling variance
+    (compare to evaluate(policy, envs).mean())
+    :param policy: policy acting on belief states only; policies with an
+                action_distribution method (e.g. SoftmaxPolicy, TablePolicy)
+                are weighted by it, otherwise act is assumed to be
+                deterministic and called once per belief state
+    :param env: MouselabEnv with only discrete distributions
+    :return: pd.Series with the expected score (util), number of clicks
+                (observations), total click cost (cost), term reward
+                (util = term_reward - cost) and the expected fraction of
+                nodes clicked at each depth (click_rate_depth_<depth>)
+    """
+    agent = Agent()
+    agent.register(env)
+    agent.register(policy)
+
+    depths = [len(env.path_to(node)) - 1 for node in range(len(env.tree))]
+    nodes_per_depth = np.bincount(depths)
+    clicks_per_depth = np.zeros(len(nodes_per_depth))
+    util = cost = term_reward = observations = 0.0
+
+    # as in exact.solve, the last action is part of the state for costs
+    # reading the episode history
+    cost_history = getattr(env, "cost_history", ())
+    initial_last_action = env.template.last_action if cost_history else None
+
+    # every click reveals one node, so states are visited layer by layer
+    # (by number of revealed nodes) once all paths to them are summed up
+    layer = defaultdict(float)
+    for state, probability in zip(
+        env.initial_states, env.initial_state_probabilities
+    ):
+        layer[state, initial_last_action] += probability
+    while layer:
+        next_layer = defaultdict(float)
+        for (state, last_action), state_probability in layer.items():
+            for action, action_probability in _action_probabilities(
+                policy, env, state, last_action
+            ):
+                probability = state_probability * action_probability
+                if cost_history:
+                    outcomes = env.results(state, action, last_action=last_action)
+                else:
+                    outcomes = env.results(state, action)
+
+                if action == env.term_action:
+                    for _, _, reward, reward_probability in outcomes:
+                        util += probability * reward_probability * reward
+                        term_reward += probability * reward_probability * reward
+                    continue
+
+                observations += probability
+                clicks_per_depth[depths[action]] += probability
+                for outcome_probability, next_state, reward, _ in outcomes:
+                    util += probability * outcome_probability * reward
+                    cost -= probability * outcome_probability * reward
+                    next_layer[next_state, action if cost_history else None] += (
+                        probability * outcome_probability
+                    )
+        layer = next_layer
+    env.reset()
+
+    click_rates = clicks_per_depth / nodes_per_depth
+    return pd.Series(
+        {
+            "util": util,
+            "observations": observations,
+            "cost": cost,
+            "term_reward": term_reward,
+            **{
+                f"click_rate_depth_{depth}": click_rate
+                for depth, click_rate in enumerate(click_rates)
+                if depth > 0
+            },
+        }
+    )
+
+
 def x2theta(x, normalize_voi):
     assert len(x) == 4
     cost_weight = x[0]
@@ -104,12 +239,24 @@ def bo_policy(
     return_result=False,
     n_jobs=None,
     q_learning=False,
+    target_std_error=None,
+    batch_size=100,
     **kwargs
 ):
+    """
+    Optimizes the weights of a LiederPolicy on envs by Bayesian optimization
+    :param target_std_error: if given, candidates are evaluated sequentially
+                (see evaluate_sequential), stopping once the mean return is
+                this precise or clearly worse than the best candidate so far;
+                by default every candidate runs on all envs
+    :param batch_size: number of episodes between checks of sequential evaluation
+    """
     if n_jobs is not None:
         parallel = Parallel(n_jobs=n_jobs)
     else:
         parallel = None
+    n_episodes = []
+    best_util = None
 
     if q_learning:
 
@@ -127,13 +274,36 @@ def bo_policy(
     else:
 
         def objective(x):
+            nonlocal best_util
             theta = x2theta(x, normalize_voi)
 
             with Timer() as t:
-                util = get_util(LiederPolicy(theta), envs, parallel)
+                if target_std_error is None:
+                    util = get_util(LiederPolicy(theta), envs, parallel)
+                    n_episodes.append(len(envs))
+                else:
+                    evaluation = evaluate_sequential(
+                        LiederPolicy(theta),
+                        envs,
+                        target_std_error,
+                        batch_size=batch_size,
+                        incumbent=best_util,
+                        parallel=parallel,
+                    )
+                    util = evaluation["util"]
+                    n_episodes.append(evaluation["n_episodes"])
+                    if evaluation["stopped"] != "worse":
+                        best_util = util if best_util is None else max(best_util, util)
             if verbose:
                 print(
-                    theta.round(3), "->", round(util, 3), "in", round(t.elapsed), "sec"
+                    theta.round(3),
+                    "->",
+                    round(util, 3),
+                    "in",
+                    round(t.elapsed),
+                    "sec,",
+                    n_episodes[-1],
+                    "episodes",
                 )
             return -util
 
@@ -150,6 +320,109 @@ def bo_policy(
     theta = np.array(x2theta(result.x, normalize_voi))
     util = -result.fun
 
+    print("BO:", theta.round(3), "->", round(util, 3), "in", round(t.elapsed), "sec")
+    # number of episodes each evaluation of the objective ran
+    result.n_episodes = n_episodes
+    if return_result:
+        return LiederPolicy(theta), result
+    else:
+        return LiederPolicy(theta)
+
+
+def _theta_util(theta, envs):
+    return get_util(LiederPolicy(theta), envs)
+
+
+def bo_policy_batched(
+    envs,
+    max_cost=10.0,
+    normalize_voi=True,
+    n_calls=60,
+    n_points=None,
+    n_jobs=-1,
+    history_file=None,
+    decimals=3,
+    verbose=False,
+    return_result=False,
+    random_state=0,
+    **kwargs
+):
+    """
+    Optimizes the weights of a LiederPolicy on envs like bo_policy, but
+    proposes n_points candidates per round and evaluates them concurrently
+    :param n_points: candidates per round, by default the number of jobs
+    :param n_jobs: number of processes evaluating candidates
+    :param history_file: JSON lines file of evaluated candidates, which are
+                read back (and count towards n_calls) to resume a run
+    :param decimals: candidates whose weights are equal once rounded to
+                decimals are only evaluated once
+    :param kwargs: passed to skopt.Optimizer
+    """
+    bounds = [(1.0, max_cost)] + [(0.0, 1.0)] * 3
+    optimizer = Optimizer(bounds, random_state=random_state, **kwargs)
+    parallel = Parallel(n_jobs=n_jobs)
+    if n_points is None:
+        n_points = effective_n_jobs(n_jobs)
+
+    cache = {}
+
+    def key(theta):
+        return tuple(np.round(theta, decimals))
+
+    if history_file is not None and Path(history_file).exists():
+        with open(history_file) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+        for record in history:
+            cache[key(record["theta"])] = record["util"]
+        if history:
+            optimizer.tell(
+                [record["x"] for record in history],
+                [-record["util"] for record in history],
+            )
+        if verbose:
+            print("Resumed", len(history), "evaluations from", history_file)
+
+    with Timer() as t:
+        while len(optimizer.yi) < n_calls:
+            xs = optimizer.ask(n_points=min(n_points, n_calls - len(optimizer.yi)))
+            thetas = [x2theta(x, normalize_voi) for x in xs]
+            new_thetas = {
+                key(theta): theta for theta in thetas if key(theta) not in cache
+            }
+
+            with Timer() as t_round:
+                utils = parallel(
+                    delayed(_theta_util)(theta, envs) for theta in new_thetas.values()
+                )
+            cache.update(zip(new_thetas, utils))
+
+            if history_file is not None:
+                with open(history_file, "a") as f:
+                    for x, theta in zip(xs, thetas):
+                        record = {
+                            "x": [float(value) for value in x],
+                            "theta": [float(value) for value in theta],
+                            "util": float(cache[key(theta)]),
+                        }
+                        f.write(json.dumps(record) + "\n")
+
+            optimizer.tell(
+                [list(x) for x in xs], [-cache[key(theta)] for theta in thetas]
+            )
+            if verbose:
+                for theta in thetas:
+                    print(theta.round(3), "->", round(cache[key(theta)], 3))
+                print(
+                    len(new_thetas),
+                    "new candidates in",
+                    round(t_round.elapsed),
+                    "sec",
+                )
+
+    result = optimizer.get_result()
+    theta = np.array(x2theta(result.x, normalize_voi))
+    util = -result.fun
+
     print("BO:", theta.round(3), "->", round(util, 3), "in", round(t.elapsed), "sec")
     if return_result:
         return LiederPolicy(theta), result
@@ -199,6 +472,48 @@ def blinkered_policy(env, kind="standard", verbose=False):
     return policy
 
 
+def evaluate_paired(policies, envs, baseline=None, seed=None):
+    """
+    Evaluates policies with common random numbers: episode i of every policy
+    runs on envs[i] with random number generators seeded alike (see
+    Agent.run_many), so ground truths, tie-breaking and sampled rewards are
+    shared and differences between policies have lower variance
+    :param policies: dictionary of policies by name
+    :param baseline: name of the policy the others are compared to,
+                by default the first one
+    :param seed: seed shared by all policies, drawn from np.random if None
+    :return: DataFrame of the util and observations of each policy (agent)
+                in each episode, and DataFrame of the paired differences in
+                util to the baseline (see paired_differences)
+    """
+    envs = list(envs)
+    if seed is None:
+        seed = np.random.randint(2 ** 32)
+    if baseline is None:
+        baseline = next(iter(policies))
+
+    def dfs():
+        for name, policy in policies.items():
+            agent = Agent()
+            agent.register(envs)
+            agent.register(policy)
+            data = agent.run_many(pbar=False, seed=seed)
+            yield pd.DataFrame(
+                {
+                    "util": data["return"],
+                    "observations": [len(actions) - 1 for actions in data["actions"]],
+                    "agent": name,
+                    "episode": np.arange(len(envs)),
+                }
+            )
+
+    results = pd.concat(dfs(), ignore_index=True)
+    utils = {
+        name: results.util[results.agent == name].to_numpy() for name in policies
+    }
+    return results, paired_differences(utils, baseline)
+
+
 def evaluate_many(policies, envs):
     def dfs():
         for name, policy in policies.items():
@@ -36,7 +36,17 @@ def solve(env, hash_state=None, actions=None, blinkered=None):
     """Returns Q, V, pi, and computation data for an mdp environment."""
     info = {"q": 0, "v": 0}  # track number of times each function is called
 
-    if hash_state is None:
+    # Costs that read the episode history are solved over states augmented with
+    # the last action; the revealed set is already determined by the state.
+    cost_history = getattr(env, "cost_history", ())
+    track_last_action = "last_action" in cost_history
+    if cost_history:
+        initial_last_action = env.template.last_action
+
+    if hash_state is None and track_last_action:
+        # layout dependent costs break the symmetry hash_tree relies on
+        hash_state = lambda state: state
+    elif hash_state is None:
         if hasattr(env, "n_arm"):
             hash_state = lambda state: tuple(sorted(state))
         elif hasattr(env, "tree"):
@@ -82,7 +92,7 @@ def solve(env, hash_state=None, actions=None, blinkered=None):
             if state is None:
                 return state
             else:
-                if kwargs:
+                if kwargs.get("action_subset") is not None:
                     # Blinkered approximation. Hash key is insensitive
                     # to states that can't be acted on, except for the
                     # best expected value
@@ -92,30 +102,47 @@ def solve(env, hash_state=None, actions=None, blinkered=None):
                     for a in action_subset:
                         mask[a] = 1
                     state = tuple(zip(state, mask))
+                if track_last_action:
+                    if len(args) > 2:
+                        last_action = args[2]
+                    else:
+                        last_action = kwargs.get("last_action")
+                    if last_action is None:
+                        last_action = initial_last_action
+                    return (hash_state(state), last_action)
                 return hash_state(state)
 
     else:
         hash_key = None
 
-    def Q(s, a):
+    def Q(s, a, last_action=None):
         info["q"] += 1
         action_subset = subset_actions(a)
+        if cost_history:
+            if last_action is None:
+                last_action = initial_last_action
+            outcomes = env.results(s, a, last_action=last_action)
+            # taking a makes it the last action of the next state
+            value = sum(
+                sp * (rp * r + V(s1, action_subset, a)) for sp, s1, r, rp in outcomes
+            )
+            return round(value, 8)
         return round(sum(sp * (rp * r + V(s1, action_subset)) for sp, s1, r, rp in env.results(s, a)), 8)
 
     @memoize(key=hash_key)
-    def V(s, action_subset=None):
+    def V(s, action_subset=None, last_action=None):
         if s is None:
             return 0
         info["v"] += 1
         acts = actions(s)
         if action_subset is not None:
             acts = tuple(a for a in acts if a in action_subset)
-        return max((Q(s, a) for a in acts), default=0)
+        return max((Q(s, a, last_action) for a in acts), default=0)
 
     # Returns set of actions that yield the highest Q-value when in a given state
-    def pi(s, print_Qs=False):
+    def pi(s, print_Qs=False, last_action=None):
         diff_threshold = 0.0000001
-        action_vals = {a: Q(s, a) for a in actions(s)}
+        action_vals = {a: Q(s, a, last_action) for a in actions(s)}
         if print_Qs:
             print(action_vals)
         max_action_val = max(action_vals.values())
@@ -1,23 +1,37 @@
+import numpy as np
 from contexttimer import Timer
 
 from mouselab.env_utils import (
+    GroundTruthStates,
     get_all_possible_sa_pairs_for_env,
-    get_all_possible_states_for_ground_truths,
     get_sa_pairs_from_states,
-    get_all_possible_states_for_env,
-    deduplicate_states
+    get_all_possible_states_for_env_gen,
 )
 from mouselab.exact import solve
+from mouselab.state_encoding import CHUNK_SIZE, StateEncoder, SymmetricStateEncoder
 
-import gc
 
 def timed_solve_env(
-    env, verbose=True, save_q=False, save_pi=False, ground_truths=None, **solve_kwargs
+    env,
+    verbose=True,
+    save_q=False,
+    save_pi=False,
+    ground_truths=None,
+    dense=False,
+    symmetric=False,
+    on_policy=False,
+    **solve_kwargs
 ):
     """
     Solves environment, saves elapsed time and optionally prints value and elapsed time
     :param env: MouselabEnv with only discrete distribution (must not be too big)
     :param verbose: Whether or not to print out solve information once done
+    :param dense: whether to save the full Q or pi function as dense tables
+                indexed by state rank (see construct_pi_table) instead of dictionaries
+    :param symmetric: whether dense tables only hold one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :param on_policy: whether to only save pi for the states visited when following
+                the optimal policy for the ground truths (see extract_on_policy_table)
     :return: Q, V, pi, info
              Q, V, pi are all recursive functions
              info contains the number of times Q and V were called
@@ -42,14 +56,35 @@ def timed_solve_env(
         #  Save Q function or Pi function
         if ground_truths is not None:
             # In some cases, it is too costly to save whole Q function
-            if save_q:
+            if on_policy and save_pi:
+                print("Getting on-policy pi")
+                info["pi_table"] = extract_on_policy_table(
+                    pi, env, ground_truths, symmetric=symmetric
+                )
+                if verbose:
+                    print(
+                        "{} on-policy states for {} ground truths".format(
+                            len(info["pi_table"]["ranks"]), len(ground_truths)
+                        )
+                    )
+            elif save_q:
                 print("Getting partial Q")
-                info["q_dictionary"] = construct_partial_q_dictionary(Q, env, ground_truths)
+                info["q_dictionary"] = construct_partial_q_dictionary(
+                    Q, env, ground_truths, verbose=verbose
+                )
             elif save_pi:
                 print("Getting partial pi")
-                info["pi_dictionary"] = construct_partial_pi_dictionary(pi, env, ground_truths)
+                info["pi_dictionary"] = construct_partial_pi_dictionary(
+                    pi, env, ground_truths, verbose=verbose
+                )
         else:
-            if save_q:
+            if dense and save_q:
+                print("Getting full Q table")
+                info["q_table"] = construct_q_table(Q, env, symmetric=symmetric)
+            elif dense and save_pi:
+                print("Getting full pi table")
+                info["pi_table"] = construct_pi_table(pi, env, symmetric=symmetric)
+            elif save_q:
                 print("Getting full Q")
                 info["q_dictionary"] = construct_q_dictionary(Q, env, verbose)
             elif save_pi:
@@ -58,30 +93,286 @@ def timed_solve_env(
 
     return Q, V, pi, info
 
+
 def construct_pi_dictionary(pi, env, verbose=False):
     """
-    Construct pi dictionary for env, given environment is solved 
+    Construct pi dictionary for env, given environment is solved
     """
-    all_states = get_all_possible_states_for_env(env)
-    dedup_states = deduplicate_states(
-        all_states, verbose=verbose
-    )
-    states_gen = (s for s in dedup_states)
-
-    print("States size: {}, Length: {}".format(dedup_states.__sizeof__(), len(dedup_states)));
-    print("Generator size: {}".format(states_gen.__sizeof__()));
-    del dedup_states
-    gc.collect()
     pi_dictionary = {}
-    for state in states_gen:
+    # states are streamed without duplicates, so no list of states is built
+    for state in get_all_possible_states_for_env_gen(env):
         max_actions, q_values = pi(tuple(state))
         pi_dictionary[tuple(state)] = {
             "max_actions": max_actions,
             "q_values": q_values
         }
-    print("Pi Dict size: {}".format(pi_dictionary.__sizeof__()));
+    if verbose:
+        print("Pi dictionary constructed for {} states".format(len(pi_dictionary)))
     return pi_dictionary
 
+
+def _check_cost_history(env):
+    if "last_action" in getattr(env, "cost_history", ()):
+        raise ValueError(
+            "Tables are indexed by belief state only, so costs can not depend "
+            "on the last action"
+        )
+
+
+def _check_symmetric_costs(env, encoder):
+    # the states with one revealed node cover the swaps of every pair of
+    # isomorphic siblings, whose costs must then agree
+    last_action = env.template.last_action
+    for node, values in enumerate(encoder.values):
+        for value in values:
+            state = env.init[:node] + (value,) + env.init[node + 1:]
+            codes, permutation = encoder.canonicalize(encoder.encode(state))
+            canonical_state = encoder.decode_many(codes[None])[0]
+            for action in env.actions(state):
+                if action == env.term_action:
+                    continue
+                cost = env.state_cost(state, action, last_action)
+                canonical_cost = env.state_cost(
+                    canonical_state, int(permutation[action]), last_action
+                )
+                if not np.isclose(cost, canonical_cost):
+                    raise ValueError(
+                        "Symmetric tables need costs that are invariant under "
+                        "swapping isomorphic subtrees"
+                    )
+
+
+def table_encoder(env, symmetric=False):
+    """
+    State encoder of the dense tables of env
+    :param symmetric: whether to only rank one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :raises ValueError: if costs depend on the last action, or if symmetric
+                and costs change when swapping isomorphic subtrees
+    """
+    _check_cost_history(env)
+    if symmetric:
+        encoder = SymmetricStateEncoder.from_env(env)
+        _check_symmetric_costs(env, encoder)
+        return encoder
+    return StateEncoder.from_env(env)
+
+
+def _rank_chunks(encoder, ranks=None, chunk_size=CHUNK_SIZE):
+    if ranks is None:
+        for start in range(0, encoder.n_states, chunk_size):
+            yield np.arange(start, min(start + chunk_size, encoder.n_states))
+    else:
+        ranks = np.asarray(ranks, dtype=np.int64)
+        for start in range(0, len(ranks), chunk_size):
+            yield ranks[start:start + chunk_size]
+
+
+def iter_q_table(Q, env, encoder, ranks=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the Q table for env (see construct_q_table) in chunks of states,
+    so that memory is bounded by the chunk size
+    :param encoder: state encoder of the table
+    :param ranks: ranks of the states to evaluate, by default all states
+    :return: generator of dictionaries with the ranks, codes and Q values
+                of the states in each chunk
+    """
+    _check_cost_history(env)
+    for chunk_ranks in _rank_chunks(encoder, ranks=ranks, chunk_size=chunk_size):
+        codes = encoder.unrank(chunk_ranks)
+        q_values = np.full((len(codes), env.term_action + 1), np.nan)
+        for row, state in enumerate(encoder.decode_many(codes)):
+            for action in env.actions(state):
+                q_values[row, action] = Q(state, action)
+        yield {"ranks": chunk_ranks, "codes": codes, "q_values": q_values}
+
+
+def iter_pi_table(pi, env, encoder, ranks=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the pi table for env (see construct_pi_table) in chunks of states,
+    so that memory is bounded by the chunk size
+    :param encoder: state encoder of the table
+    :param ranks: ranks of the states to evaluate, by default all states
+    :return: generator of dictionaries with the ranks, codes, Q values
+                and best action bitmasks of the states in each chunk
+    """
+    if env.term_action >= 64:
+        raise ValueError("Best actions can only be stored for up to 64 actions")
+    _check_cost_history(env)
+    for chunk_ranks in _rank_chunks(encoder, ranks=ranks, chunk_size=chunk_size):
+        codes = encoder.unrank(chunk_ranks)
+        q_values = np.full((len(codes), env.term_action + 1), np.nan)
+        max_actions = np.zeros(len(codes), dtype=np.uint64)
+        for row, state in enumerate(encoder.decode_many(codes)):
+            best_actions, action_values = pi(state)
+            q_values[row, list(action_values)] = list(action_values.values())
+            max_actions[row] = sum(1 << action for action in best_actions)
+        yield {
+            "ranks": chunk_ranks,
+            "codes": codes,
+            "q_values": q_values,
+            "max_actions": max_actions,
+        }
+
+
+def _collect_table(encoder, chunks, columns, num_rows=None):
+    table = {"encoder": encoder}
+    num_rows = encoder.n_states if num_rows is None else num_rows
+    start = 0
+    for chunk in chunks:
+        for column in columns:
+            if column not in table:
+                table[column] = np.empty(
+                    (num_rows, *chunk[column].shape[1:]),
+                    dtype=chunk[column].dtype,
+                )
+            table[column][start:start + len(chunk[column])] = chunk[column]
+        start += len(chunk["ranks"])
+    return table
+
+
+def construct_q_table(Q, env, symmetric=False, chunk_size=CHUNK_SIZE):
+    """
+    Construct dense Q table for env, given environment is solved
+    :param symmetric: whether to only store one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :return: dictionary with the state encoder and a
+                (number of states, number of actions) array of Q values,
+                indexed by state rank, NaN for actions not available in a state
+    :raises ValueError: see table_encoder
+    """
+    encoder = table_encoder(env, symmetric=symmetric)
+    chunks = iter_q_table(Q, env, encoder, chunk_size=chunk_size)
+    return _collect_table(encoder, chunks, ["q_values"])
+
+
+def construct_pi_table(pi, env, symmetric=False, chunk_size=CHUNK_SIZE):
+    """
+    Construct dense pi table for env, given environment is solved
+    :param symmetric: whether to only store one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :return: dictionary with the state encoder, an array of Q values
+                (as in construct_q_table) and an array of the best actions
+                in each state, as bitmasks (bit a set if action a is optimal)
+    :raises ValueError: see table_encoder
+    """
+    encoder = table_encoder(env, symmetric=symmetric)
+    chunks = iter_pi_table(pi, env, encoder, chunk_size=chunk_size)
+    return _collect_table(encoder, chunks, ["q_values", "max_actions"])
+
+
+def on_policy_states(pi, env, ground_truths=None):
+    """
+    Finds the states visited when following pi from the initial state,
+    branching over tied best actions and over the values clicks reveal
+    :param pi: pi function of the solved env (see exact.solve)
+    :param ground_truths: iterable of ground truths the revealed values are
+                taken from, by default any value a node can take
+    :return: set of visited states, as tuples
+    """
+    if ground_truths is not None:
+        ground_truths = [tuple(ground_truth) for ground_truth in ground_truths]
+    # costs depending on the last action change the best actions in a state
+    track_last_action = "last_action" in getattr(env, "cost_history", ())
+    # the ground truths consistent with a state only depend on the state,
+    # so each state is expanded once per last action, whichever path led to it
+    visited = set()
+    states = set()
+    stack = [(env.init, None, ground_truths)]
+    while stack:
+        state, last_action, consistent = stack.pop()
+        if (state, last_action) in visited:
+            continue
+        visited.add((state, last_action))
+        states.add(state)
+
+        best_actions, _ = pi(state, last_action=last_action)
+        for action in best_actions:
+            if action == env.term_action:
+                continue
+            if consistent is None:
+                values = {value: None for value, _ in state[action]}
+            else:
+                values = {}
+                for ground_truth in consistent:
+                    values.setdefault(ground_truth[action], []).append(ground_truth)
+            next_last_action = action if track_last_action else None
+            for value, consistent_with_value in values.items():
+                next_state = state[:action] + (value,) + state[action + 1:]
+                stack.append((next_state, next_last_action, consistent_with_value))
+    return states
+
+
+def extract_on_policy_table(
+    pi, env, ground_truths=None, symmetric=False, chunk_size=CHUNK_SIZE
+):
+    """
+    Construct a partial pi table holding only the states visited when
+    following pi (see on_policy_states), which is all that is needed to
+    simulate the policy, instead of every subset of revealed nodes
+    :param ground_truths: iterable of ground truths, by default the states
+                visited for any ground truth are kept
+    :param symmetric: whether to only store one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :return: table as in construct_pi_table, with the sorted ranks of its rows
+    :raises ValueError: as table_encoder, e.g. if costs depend on the last action
+    """
+    encoder = table_encoder(env, symmetric=symmetric)
+    states = on_policy_states(pi, env, ground_truths=ground_truths)
+    ranks = np.unique(encoder.rank(encoder.encode_many(list(states))))
+    chunks = iter_pi_table(pi, env, encoder, ranks=ranks, chunk_size=chunk_size)
+    table = _collect_table(
+        encoder, chunks, ["q_values", "max_actions"], num_rows=len(ranks)
+    )
+    table["ranks"] = ranks
+    return table
+
+
+def table_row(table, state):
+    """
+    Finds the row of a state in a table from construct_q_table or
+    construct_pi_table (or a partial table, which also holds the sorted
+    ranks of its rows)
+    :return: row and the permutation mapping actions on the state
+                to actions on the state stored in the row
+    """
+    encoder = table["encoder"]
+    codes, permutation = encoder.canonicalize(encoder.encode(state))
+    rank = encoder.rank(codes)
+    if "ranks" not in table:
+        return rank, permutation
+
+    row = np.searchsorted(table["ranks"], rank)
+    if row == len(table["ranks"]) or table["ranks"][row] != rank:
+        raise KeyError(state)
+    return row, permutation
+
+
+def lookup_table(table, state):
+    """
+    Looks up a state in a table from construct_q_table or construct_pi_table
+    :return: the best actions (if in the table) and a dictionary of Q values
+                for the actions available in the state,
+                in the same format as pi returns
+    """
+    row, permutation = table_row(table, state)
+
+    q_values = table["q_values"][row][permutation]
+    action_values = {
+        action: q_value
+        for action, q_value in enumerate(q_values.tolist())
+        if not np.isnan(q_value)
+    }
+    if "max_actions" not in table:
+        return None, action_values
+
+    mask = int(table["max_actions"][row])
+    best_actions = [
+        action for action in action_values if mask >> int(permutation[action]) & 1
+    ]
+    return best_actions, action_values
+
+
 def construct_q_dictionary(Q, env, verbose=False):
     """
     Construct q dictionary for env, given environment is solved
@@ -92,28 +383,41 @@ def construct_q_dictionary(Q, env, verbose=False):
     return q_dictionary
 
 
-def construct_partial_q_dictionary(Q, env, selected_ground_truths):
+def _ground_truth_states(env, selected_ground_truths, verbose=False):
+    states = GroundTruthStates(env, selected_ground_truths)
+    if verbose:
+        print(
+            "{} states for {} ground truths, {} distinct ({} shared)".format(
+                states.num_states,
+                states.num_ground_truths,
+                states.num_distinct_states,
+                states.num_shared_states,
+            )
+        )
+    return states
+
+
+def construct_partial_q_dictionary(Q, env, selected_ground_truths, verbose=False):
     """
     Construct q dictionary for only specified ground truth values
+    (states shared between ground truths are only evaluated once)
     """
-    all_possible_states = get_all_possible_states_for_ground_truths(
-        env, selected_ground_truths
-    )
-    sa = get_sa_pairs_from_states(all_possible_states)
+    states = _ground_truth_states(env, selected_ground_truths, verbose=verbose)
+    sa = get_sa_pairs_from_states(states.iter_states())
     q_dictionary = {pair: Q(*pair) for pair in sa}
     return q_dictionary
 
-def construct_partial_pi_dictionary(pi, env, selected_ground_truths):
+
+def construct_partial_pi_dictionary(pi, env, selected_ground_truths, verbose=False):
     """
     Construct pi dictionary for only specified ground truth values
+    (states shared between ground truths are only evaluated once)
     """
-    all_possible_states = get_all_possible_states_for_ground_truths(
-        env, selected_ground_truths
-    )
+    states = _ground_truth_states(env, selected_ground_truths, verbose=verbose)
     pi_dictionary = {}
-    for state in all_possible_states:
-        max_actions, q_values = pi(tuple(state))
-        pi_dictionary[tuple(state)] = {
+    for state in states.iter_states():
+        max_actions, q_values = pi(state)
+        pi_dictionary[state] = {
             "max_actions": max_actions,
             "q_values": q_values
         }
@@ -1,4 +1,7 @@
+from collections import deque
+
 import networkx as nx
+import numpy as np
 
 # ========================================================================================
 #
@@ -71,6 +74,83 @@ def annotate_mdp_graph(env_graph, additional_graph_properties={}):
     return env_graph
 
 
+def node_attributes_from_adjacency_list(adjacency_list, additional_graph_properties={}):
+    """
+    Compiles the node properties added by annotate_mdp_graph into columnar arrays,
+    without building a networkx graph
+    :param: adjacency_list, adjacency list of the MDP
+    :param: additional_graph_properties, dictionary of node attributes
+            in the form of {property_name: {1: property_val, ....}}
+    :return: dictionary of {property_name: array with one entry per node},
+             depth (unless given) and cluster are always included,
+             layout is a float array with one row of coordinates per node
+    """
+    num_nodes = len(adjacency_list)
+    additional_graph_properties = dict(additional_graph_properties)
+    initial_node = additional_graph_properties.pop("initial", 0)
+
+    node_attributes = {}
+    for property_name, property_dict in additional_graph_properties.items():
+        if set(property_dict.keys()) != set(range(num_nodes)):
+            raise ValueError("Dictionary keys and graph nodes must match exactly")
+        if property_name == "layout":
+            values = np.array([property_dict[node] for node in range(num_nodes)])
+            node_attributes[property_name] = values.astype(np.float64)
+        else:
+            values = np.empty(num_nodes, dtype=object)
+            values[:] = [property_dict[node] for node in range(num_nodes)]
+            node_attributes[property_name] = values
+
+    # breadth first search gives shortest path length from initial node,
+    # unless the depth is given as a property
+    if "depth" not in node_attributes:
+        depth = np.full(num_nodes, -1, dtype=np.int64)
+        depth[initial_node] = 0
+        queue = deque([initial_node])
+        while queue:
+            node = queue.popleft()
+            for child in adjacency_list[node]:
+                if depth[child] == -1:
+                    depth[child] = depth[node] + 1
+                    queue.append(child)
+        node_attributes["depth"] = depth
+
+    # create cluster with side / direction or numbered if button not available
+    cluster = np.empty(num_nodes, dtype=object)
+    cluster[initial_node] = 0
+    for cluster_idx, node in enumerate(adjacency_list[initial_node]):
+        if "resulting_key" in node_attributes:
+            cluster_value = node_attributes["resulting_key"][node]
+        else:
+            cluster_value = cluster_idx + 1
+
+        stack = [node]
+        while stack:
+            desc = stack.pop()
+            cluster[desc] = cluster_value
+            stack.extend(adjacency_list[desc])
+    node_attributes["cluster"] = cluster
+
+    return node_attributes
+
+
+def graph_from_node_attributes(adjacency_list, node_attributes):
+    """
+    Builds mdp_graph as networkx DiGraph with node properties from columnar arrays
+    :param: adjacency_list, adjacency list of the MDP
+    :param: node_attributes, dictionary of {property_name: array},
+            as from node_attributes_from_adjacency_list
+    :return: mdp graph annotated with all properties
+    """
+    env_graph = graph_from_adjacency_list(adjacency_list)
+    for property_name, values in node_attributes.items():
+        values = values.tolist()
+        env_graph = add_property_to_graph(
+            env_graph, property_name, dict(enumerate(values))
+        )
+    return env_graph
+
+
 def get_structure_properties(structure):
     """
     From dictionary from JSON file provided in experiment,
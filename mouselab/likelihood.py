@@ -0,0 +1,199 @@
+"""Likelihood of observed choices (e.g. human clicks) under softmax policies.
+
+The features of every action are computed once per distinct belief state,
+so the log likelihood of a linear softmax policy (and its gradient) can be
+evaluated for any weights with a few array operations, e.g. to fit the
+weights of MouselabPolicy to participants' clicks.
+"""
+
+import numpy as np
+from scipy.optimize import minimize
+
+from mouselab.mouselab_policy import FEATURES, features
+from mouselab.utils import masked_softmax
+
+
+def mouselab_features(env, state, action):
+    """Features of MouselabPolicy, without its dummy feature."""
+    return features(env, state, action)[: len(FEATURES)]
+
+
+def structure_state_key(env, state):
+    """
+    Key of choices that share their mouselab_features, which only depend on
+    the tree (not e.g. the cost or ground truth) and the belief state
+    """
+    return env.structure, state
+
+
+def env_state_key(env, state):
+    """Key of choices in the same belief state of the same env object."""
+    return id(env), state
+
+
+class ChoiceData(object):
+    """Features of the actions available in the belief states of choices.
+
+    Choices with the same key (by default the same belief state of envs with
+    the same tree) share their features, so the likelihood only depends on
+    how often each action was chosen in each distinct state.
+    """
+
+    def __init__(self, features, mask, counts, feature_names=FEATURES):
+        """
+        :param features: (number of states, number of actions, number of
+                    features) array of the features of each action
+        :param mask: (number of states, number of actions) array, true for
+                    the actions available in each state
+        :param counts: (number of states, number of actions) array of how
+                    often each action was chosen in each state
+        """
+        self.features = features
+        self.mask = mask
+        self.counts = counts
+        self.feature_names = tuple(feature_names)
+
+    @property
+    def num_states(self):
+        return len(self.counts)
+
+    @property
+    def num_choices(self):
+        return int(self.counts.sum())
+
+    @classmethod
+    def from_choices(
+        cls,
+        envs,
+        states,
+        actions,
+        feature_function=mouselab_features,
+        key=None,
+        **kwargs
+    ):
+        """
+        Computes the features of the belief states choices were made in
+        :param envs: env of each choice
+        :param states: belief state of each choice
+        :param actions: action chosen in each choice
+        :param feature_function: features(env, state, action) of an action,
+                    which may not depend on the history of the episode (e.g.
+                    env.last_action), as choices are not replayed
+        :param key: key(env, state) of choices whose features are computed
+                    once, so feature_function may only depend on what the key
+                    does; by default structure_state_key for
+                    mouselab_features and env_state_key (choices in the same
+                    env, e.g. with its cost and ground truth) otherwise
+        :param kwargs: passed to ChoiceData, e.g. feature_names
+        """
+        if key is None:
+            if feature_function is mouselab_features:
+                key = structure_state_key
+            else:
+                key = env_state_key
+        state_ids = {}
+        distinct_states = []
+        state_index = []
+        for env, state in zip(envs, states):
+            state_key = key(env, state)
+            if state_key not in state_ids:
+                state_ids[state_key] = len(distinct_states)
+                distinct_states.append((env, state))
+            state_index.append(state_ids[state_key])
+
+        num_actions = {env.action_space.n for env, _ in distinct_states}
+        if len(num_actions) != 1:
+            raise ValueError("All envs need the same number of actions")
+        num_actions = num_actions.pop()
+
+        feature_array = None
+        mask = np.zeros((len(distinct_states), num_actions), dtype=bool)
+        for state_id, (env, state) in enumerate(distinct_states):
+            for action in env.actions(state):
+                action_features = feature_function(env, state, action)
+                if feature_array is None:
+                    feature_array = np.zeros(
+                        (len(distinct_states), num_actions, len(action_features))
+                    )
+                feature_array[state_id, action] = action_features
+                mask[state_id, action] = True
+
+        counts = np.zeros(mask.shape)
+        np.add.at(counts, (np.array(state_index), np.array(actions)), 1)
+        if np.any(counts[~mask]):
+            raise ValueError("Some chosen actions are not available")
+        return cls(feature_array, mask, counts, **kwargs)
+
+    @classmethod
+    def from_unrolled(cls, unrolled, **kwargs):
+        """
+        :param unrolled: DataFrame with env, state and action columns, e.g.
+                    the unrolled data of model_utils.fetch_data
+        """
+        return cls.from_choices(
+            unrolled.env, unrolled.state, unrolled.action, **kwargs
+        )
+
+    def preferences(self, theta, temp=1):
+        """Preferences of a linear policy with weights theta, NaN if unavailable."""
+        preferences = self.features @ np.asarray(theta, dtype=np.float64) / temp
+        preferences[~self.mask] = np.nan
+        return preferences
+
+    def action_probabilities(self, theta, temp=1):
+        """(number of states, number of actions) array of softmax probabilities."""
+        return masked_softmax(self.preferences(theta, temp), self.mask)
+
+    def log_likelihood(self, theta, temp=1):
+        return self.log_likelihood_and_gradient(theta, temp)[0]
+
+    def gradient(self, theta, temp=1):
+        return self.log_likelihood_and_gradient(theta, temp)[1]
+
+    def log_likelihood_and_gradient(self, theta, temp=1):
+        """
+        Log likelihood of the choices under a softmax over features @ theta / temp
+        :return: log likelihood, its gradient with respect to theta
+        """
+        preferences = np.where(self.mask, self.preferences(theta, temp), -np.inf)
+        max_preferences = preferences.max(axis=1, keepdims=True)
+        exp_preferences = np.exp(preferences - max_preferences)
+        normalizer = exp_preferences.sum(axis=1, keepdims=True)
+        log_probabilities = preferences - max_preferences - np.log(normalizer)
+
+        chosen = self.counts > 0
+        log_likelihood = np.sum(self.counts[chosen] * log_probabilities[chosen])
+
+        # observed minus expected features, weighted by the choices per state
+        probabilities = exp_preferences / normalizer
+        weights = self.counts - self.counts.sum(axis=1, keepdims=True) * probabilities
+        gradient = np.einsum("sa,saf->f", weights, self.features) / temp
+        return log_likelihood, gradient
+
+    def fit(self, theta0=None, fixed=None, temp=1, **kwargs):
+        """
+        Finds the maximum likelihood weights
+        :param theta0: initial weights, by default all 0
+        :param fixed: dictionary of weights to keep at a value, by feature
+                    index or name (e.g. {"is_term": 0})
+        :param kwargs: passed to scipy.optimize.minimize
+        :return: weights, scipy's OptimizeResult
+        """
+        num_features = self.features.shape[2]
+        theta = np.zeros(num_features) if theta0 is None else np.array(theta0, float)
+        fixed = {
+            self.feature_names.index(k) if isinstance(k, str) else k: v
+            for k, v in (fixed or {}).items()
+        }
+        free = np.array([i not in fixed for i in range(num_features)])
+        theta[list(fixed)] = list(fixed.values())
+
+        def objective(x):
+            theta[free] = x
+            log_likelihood, gradient = self.log_likelihood_and_gradient(theta, temp)
+            return -log_likelihood, -gradient[free]
+
+        kwargs.setdefault("method", "L-BFGS-B")
+        result = minimize(objective, theta[free], jac=True, **kwargs)
+        theta[free] = result.x
+        return theta, result
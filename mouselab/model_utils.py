@@ -50,7 +50,8 @@ def fetch_data(exp, version=None):
 
         participants: one row for each participant
         trials: one row for each test trial
-        unrolled: one row for each meta-action (clicking or terminating)
+        unrolled: one row for each meta-action (clicking or terminating), see
+            likelihood.ChoiceData.from_unrolled
 
     Participants are excluded if either (1) they did not click any nodes
     during the block which explicitly asks them to click or (2) they answered
@@ -136,6 +137,7 @@ def fetch_data(exp, version=None):
                     "pid": pid,
                     "trial_index": row.trial_index,
                     "trial_id": row.trial_id,
+                    "env": env,
                     "state": env._state,
                     "action": a,
                 }
@@ -4,14 +4,15 @@ import gym
 import numpy as np
 from gym import spaces
 from pydantic import NonNegativeFloat
-from toolz import get, memoize
+from toolz import get
 
+from mouselab.cost_functions import CostContext
 from mouselab.distributions import PointMass, cmax, expectation, sample, smax
 from mouselab.envs.registry import registry
 from mouselab.graph_utils import (
     add_property_to_graph,
-    annotate_mdp_graph,
-    graph_from_adjacency_list,
+    graph_from_node_attributes,
+    node_attributes_from_adjacency_list,
 )
 
 NO_CACHE = False
@@ -55,27 +56,48 @@ class MouselabEnv(gym.Env):
         :param mdp_graph_properties: properties to add to mdp graph,
                     as dictionary of {attribute : dictionary of {node : value}}
         """
-        self.tree = tree
-        mdp_graph = graph_from_adjacency_list(self.tree)
-        # add properties to mdp_graph for cost function and possible calculating returns
-        mdp_graph = annotate_mdp_graph(mdp_graph, mdp_graph_properties)
-        # add clicked property to the graph
-        self.mdp_graph = add_property_to_graph(
-            mdp_graph, "revealed", {node: False for node in mdp_graph.nodes}
+        template = EnvTemplate(
+            tree,
+            init,
+            cost=cost,
+            term_belief=term_belief,
+            sample_term_reward=sample_term_reward,
+            last_action=last_action,
+            mdp_graph_properties=mdp_graph_properties,
         )
+        self._attach_template(template, ground_truth)
 
-        self.init = (0, *init[1:])
+    def _attach_template(self, template, ground_truth=None):
+        """Sets up env for one ground truth, sharing all structure in template."""
+        self.template = template
+        self.tree = template.tree
+        # node properties for cost function and possible calculating returns,
+        # networkx mdp_graph is only built from these if requested
+        self.node_attributes = template.node_attributes
+        self._mdp_graph = None
+
+        self.init = template.init
 
         if ground_truth is not None:
-            if len(ground_truth) != len(init):
+            if len(ground_truth) != len(self.init):
                 raise ValueError("len(ground_truth) != len(init)")
             self.ground_truth = np.array(ground_truth)
             self.ground_truth[0] = 0.0
         else:
-            self.ground_truth = np.array(list(map(sample, init)))
+            self.ground_truth = np.array(list(map(sample, template.prior)))
             self.ground_truth[0] = 0.0
 
-        if hasattr(cost, "__call__"):
+        # index of revealed nodes for cost functions compiled against it
+        self.cost_context = template.cost_context.copy()
+
+        cost = template.cost
+        self.cost_history = template.cost_history
+        if getattr(cost, "uses_context", False):
+            # reads revealed nodes from the context and last action
+            self.cost = lambda node: cost(
+                node, last_action=self.last_action, context=self.cost_context
+            )
+        elif hasattr(cost, "__call__"):
             # reads in all graph attributes and last action
             self.cost = lambda node: cost(
                 node, last_action=self.last_action, graph=self.mdp_graph
@@ -85,15 +107,16 @@ class MouselabEnv(gym.Env):
             self.cost = lambda node: -abs(cost)
 
         # in Val's experiments participants must click on node 0 to begin
-        self.last_action = last_action
-        self.mdp_graph.nodes[last_action]["revealed"] = True
+        self.last_action = template.last_action
 
-        self.term_belief = term_belief
-        self.sample_term_reward = sample_term_reward
-        self.term_action = len(self.init)
+        self.term_belief = template.term_belief
+        self.sample_term_reward = template.sample_term_reward
+        # np.random.Generator for sampled term rewards, random if None
+        self.rng = None
+        self.term_action = template.term_action
 
         # Required for gym.Env API.
-        self.action_space = spaces.Discrete(len(self.init) + 1)
+        self.action_space = template.action_space
         # self.observation_space = spaces.Box(-np.inf, np.inf, shape=len(self.init))
 
         self.initial_states = [self.init]
@@ -101,12 +124,13 @@ class MouselabEnv(gym.Env):
 
         self.exact = True  # TODO
 
-        self.subtree = self._get_subtree()
-        self.subtree_slices = self._get_subtree_slices()
-        self.paths = self.get_paths(0)
+        self.structure = template.structure
+        self.subtree = template.subtree
+        self.subtree_slices = template.subtree_slices
+        self.paths = template.paths
         self.reset()
 
-        self._hash = hash((str(self.tree), self.init, str(list(self.ground_truth))))
+        self._hash = hash((template.tree_str, self.init, str(list(self.ground_truth))))
 
         # Scarcity parameter
         self._pct_reward = 1
@@ -117,6 +141,19 @@ class MouselabEnv(gym.Env):
     def __hash__(self):
         return self._hash
 
+    @property
+    def mdp_graph(self):
+        """networkx DiGraph of the MDP with node properties, built on first access"""
+        if self._mdp_graph is None:
+            mdp_graph = graph_from_node_attributes(self.tree, self.node_attributes)
+            # add clicked property to the graph
+            self._mdp_graph = add_property_to_graph(
+                mdp_graph,
+                "revealed",
+                dict(enumerate(self.cost_context.revealed_array().tolist())),
+            )
+        return self._mdp_graph
+
     def reset(self):
         return self._reset()
 
@@ -126,6 +163,10 @@ class MouselabEnv(gym.Env):
                 self.initial_states, p=self.initial_state_probabilities
             )
         self._state = self.init
+        # history read by cost functions starts over with the episode
+        self.last_action = self.template.last_action
+        self.cost_context.revealed = self.template.cost_context.revealed
+        self._mdp_graph = None
         return self._state
 
     def step(self, action):
@@ -150,12 +191,17 @@ class MouselabEnv(gym.Env):
         self.last_action = action
         return self._state, reward, done, {}
 
-    def _term_reward(self):
+    def _term_reward(self, state=None):
+        state = state if state is not None else self._state
         if self.term_belief:
-            return self.expected_term_reward(self._state)
+            return self.expected_term_reward(state)
 
-        returns = [self.ground_truth[list(path)].sum() for path in self.optimal_paths()]
+        returns = [
+            self.ground_truth[list(path)].sum() for path in self.optimal_paths(state)
+        ]
         if self.sample_term_reward:
+            if self.rng is not None:
+                return returns[self.rng.integers(len(returns))]
             return random.choice(returns)
         else:
             return np.mean(returns)
@@ -167,9 +213,36 @@ class MouselabEnv(gym.Env):
             result = self.ground_truth[action]
         s = list(self._state)
         s[action] = result
-        self.mdp_graph.nodes[action]["revealed"] = True
+        self.cost_context.reveal(action)
+        if self._mdp_graph is not None:
+            self._mdp_graph.nodes[action]["revealed"] = True
         return tuple(s)
 
+    def successor(self, state, action, last_action=None):
+        """Returns the next state, reward and whether the episode is done.
+
+        Unlike step, this does not change the env (e.g. to plan with
+        agents.Model): observed nodes take their ground truth value and the
+        cost is computed from state and last_action (see state_cost).
+        If last_action is None, action is the first action of an episode.
+        """
+        if state is self.term_state:
+            raise ValueError("state is terminal")
+        if action == self.term_action:
+            reward = self._term_reward(state) if not self._is_scarce else 0
+            return self.term_state, reward, True
+        if not hasattr(state[action], "sample"):
+            raise ValueError(f"node {action} is already observed")
+        if last_action is None:
+            last_action = self.template.last_action
+
+        s1 = list(state)
+        if self.ground_truth is None:
+            s1[action] = state[action].sample()
+        else:
+            s1[action] = self.ground_truth[action]
+        return tuple(s1), self.state_cost(state, action, last_action), False
+
     def actions(self, state):
         """Yields actions that can be taken in the given state.
 
@@ -182,18 +255,46 @@ class MouselabEnv(gym.Env):
                 yield i
         yield self.term_action
 
-    def results(self, state, action):
+    def results(self, state, action, last_action=None):
         """Returns a list of possible results of taking action in state.
 
         Each outcome is (next state probability, next_state, reward, reward probability).
+        If last_action is given, the cost is computed from state and last_action
+        (see state_cost) rather than from the history this env last stepped through.
         """
         if action == self.term_action:
             yield (1, self.term_state, self.expected_term_reward(state), self._pct_reward)
         else:
+            if last_action is None:
+                cost = self.cost(action)
+            else:
+                cost = self.state_cost(state, action, last_action)
             for r, p in state[action]:
                 s1 = list(state)
                 s1[action] = r
-                yield (p, tuple(s1), self.cost(action), 1)
+                yield (p, tuple(s1), cost, 1)
+
+    def revealed_mask(self, state):
+        """Bitmask of nodes already observed in state."""
+        mask = 0
+        for i, v in enumerate(state):
+            if not hasattr(v, "sample"):
+                mask |= 1 << i
+        return mask
+
+    def state_cost(self, state, action, last_action):
+        """Cost of observing action in state, after last_action was taken.
+
+        Unlike cost, this is a pure function of its arguments: the revealed set
+        is read from state instead of the nodes this env has revealed so far.
+        """
+        if not self.cost_history:
+            return self.cost(action)
+        kwargs = {"last_action": last_action, "context": self.cost_context}
+        if "revealed" in self.cost_history:
+            # cost is evaluated once the node is revealed, as in step
+            kwargs["revealed"] = self.revealed_mask(state) | 1 << action
+        return self.template.cost(action, **kwargs)
 
     def action_features(self, action, state=None):
         state = state if state is not None else self._state
@@ -233,18 +334,14 @@ class MouselabEnv(gym.Env):
 
         yield from rec((0,))
 
-    @lru_cache(CACHE_SIZE)
     def expected_term_reward(self, state):
-        return self.term_reward(state).expectation()
+        # cached per tree structure, so shared by all envs with the same tree
+        return expected_term_reward(self.structure, state)
 
     def node_value(self, node, state=None):
         """A distribution over total rewards of the best step taken from the given node."""
         state = state if state is not None else self._state
-        return max(
-            (self.node_value(n1, state) + state[n1] for n1 in self.tree[node]),
-            default=ZERO,
-            key=expectation,
-        )
+        return node_value(self.tree, node, state)
 
     def node_value_to(self, node, state=None):
         """A distribution over rewards up to and including the given node."""
@@ -257,27 +354,33 @@ class MouselabEnv(gym.Env):
         state = state if state is not None else self._state
         return self.node_value_to(node, state) + self.node_value(node, state)
 
-    # @lru_cache(CACHE_SIZE)
     def myopic_voc(self, action, state) -> NonNegativeFloat:
+        if self.exact:
+            return observation_value(self.structure, (action,), state)
         return self.node_value_after_observe(
             (action,), 0, state
         ).expectation() - self.expected_term_reward(state)
 
-    # @lru_cache(CACHE_SIZE)
     def vpi_branch(self, action, state) -> NonNegativeFloat:
         obs = self._relevant_subtree(action)
+        if self.exact:
+            return observation_value(self.structure, obs, state)
         return self.node_value_after_observe(
             obs, 0, state
         ).expectation() - self.expected_term_reward(state)
 
     def vpi_action(self, action, state) -> NonNegativeFloat:
-        obs = (*self.subtree[action][1:], *self.path_to(action)[1:])
+        obs = self.structure.vpi_action_obs[action]
+        if self.exact:
+            return observation_value(self.structure, obs, state)
         return self.node_value_after_observe(
             obs, 0, state
         ).expectation() - self.expected_term_reward(state)
 
     def vpi(self, state) -> NonNegativeFloat:
         obs = self.subtree[0]
+        if self.exact:
+            return observation_value(self.structure, obs, state)
         return self.node_value_after_observe(
             obs, 0, state
         ).expectation() - self.expected_term_reward(state)
@@ -311,27 +414,13 @@ class MouselabEnv(gym.Env):
         return r
 
     def get_paths(self, node):
-        if self.tree[node] == []:
-            return [[]]
-        paths = []
-        for n in self.tree[node]:
-            new_paths = self.get_paths(n)
-            for path in new_paths:
-                path.insert(0, n)
-                paths.append(path)
-        return paths
-
-    @lru_cache(None)
+        return get_paths(self.tree, node)
+
     def _relevant_subtree(self, node):
-        trees = [self.subtree[n1] for n1 in self.tree[0]]
-        for t in trees:
-            if node in t:
-                return tuple(t)
-        assert False
+        return self.template.relevant_subtrees[node]
 
-    @lru_cache(None)
     def leaves(self):
-        return [path[-1] for path in self.all_paths()]
+        return self.template.leaves
 
     def path_values(self, state):
         return [self.node_quality(node, state) for node in self.leaves()]
@@ -347,78 +436,28 @@ class MouselabEnv(gym.Env):
         else:
             return node_value_after_observe(obs_tree)
 
-    @memoize
     def path_to(self, node, start=0):
-        path = [start]
-        if node == start:
-            return path
-        for _ in range(10000):
-            children = self.tree[path[-1]]
-            for i, child in enumerate(children):
-                if child == node:
-                    path.append(node)
-                    return path
-                if child > node:
-                    path.append(children[i - 1])
-                    break
-            else:
-                path.append(child)
-        assert False
+        if start == 0:
+            return self.template.paths_to[node]
+        return path_to(self.tree, node, start=start)
 
-    @memoize
     def all_paths(self, start=0):
-        def rec(path):
-            children = self.tree[path[-1]]
-            if children:
-                for child in children:
-                    yield from rec(path + [child])
-            else:
-                yield path
-
-        return list(rec([start]))
+        if start == 0:
+            return self.template.all_paths
+        return all_paths(self.tree, start=start)
 
     def _get_subtree_slices(self):
-        slices = [0] * len(self.tree)
-
-        def get_end(n):
-            end = max((get_end(n1) for n1 in self.tree[n]), default=n + 1)
-            slices[n] = slice(n, end)
-            return end
-
-        get_end(0)
-        return slices
+        return get_subtree_slices(self.tree)
 
     def _get_subtree(self):
-        def gen(n):
-            yield n
-            for n1 in self.tree[n]:
-                yield from gen(n1)
-
-        return [tuple(gen(n)) for n in range(len(self.tree))]
+        return get_subtree(self.tree)
 
     @classmethod
     def new_symmetric(cls, branching, reward, seed=None, **kwargs):
         """Returns a MouselabEnv with a symmetric structure."""
         if seed is not None:
             np.random.seed(seed)
-        if not callable(reward):
-            r = reward
-            reward = lambda depth: r
-
-        init = []
-        tree = []
-
-        def expand(d):
-            my_idx = len(init)
-            init.append(reward(d))
-            children = []
-            tree.append(children)
-            for _ in range(get(d, branching, 0)):
-                child_idx = expand(d + 1)
-                children.append(child_idx)
-            return my_idx
-
-        expand(0)
+        tree, init = symmetric_tree(branching, reward)
         return cls(tree, init, **kwargs)
 
     @classmethod
@@ -451,14 +490,253 @@ class MouselabEnv(gym.Env):
         return dot
 
     def to_obs_tree(self, state, node, obs=(), sort=True):
-        maybe_sort = sorted if sort else lambda x: x
+        return to_obs_tree(self.tree, state, node, obs=obs, sort=sort)
+
 
-        def rec(n):
-            subjective_reward = state[n] if n in obs else expectation(state[n])
-            children = tuple(maybe_sort(rec(c) for c in self.tree[n]))
-            return (subjective_reward, children)
+class TreeStructure(object):
+    """Tables that depend only on the shape of the tree.
+
+    Instances are interned by tree (use TreeStructure.get), so every env with
+    the same tree shares one structure, and its integer id makes it a cheap
+    key for the module-level term reward and VOC caches.
+    """
+
+    _instances = {}
+
+    def __init__(self, tree, structure_id):
+        self.tree = tree
+        self.structure_id = structure_id
+
+        self.subtree = get_subtree(tree)
+        self.subtree_slices = get_subtree_slices(tree)
+        self.paths = get_paths(tree, 0)
+        self.paths_to = [path_to(tree, node) for node in range(len(tree))]
+        self.all_paths = all_paths(tree)
+        self.leaves = [path[-1] for path in self.all_paths]
+        # subtree of the root's child that each node belongs to
+        self.relevant_subtrees = [None] * len(tree)
+        for child in tree[0]:
+            for node in self.subtree[child]:
+                self.relevant_subtrees[node] = self.subtree[child]
+        self.vpi_action_obs = [
+            (*self.subtree[node][1:], *self.paths_to[node][1:])
+            for node in range(len(tree))
+        ]
+
+    @classmethod
+    def get(cls, tree):
+        key = tuple(map(tuple, tree))
+        if key not in cls._instances:
+            cls._instances[key] = cls(tree, len(cls._instances))
+        return cls._instances[key]
+
+    def __hash__(self):
+        return self.structure_id
+
+    def __reduce__(self):
+        # unpickled structures are interned in the receiving process
+        return (TreeStructure.get, (self.tree,))
+
+
+class EnvTemplate(object):
+    """Shape- and distribution-dependent structure shared by MouselabEnvs.
+
+    Building a MouselabEnv compiles node attributes, subtree tables and path
+    lists from the tree, which is wasted work when only the ground truth
+    differs between trials. A template does this once; instantiate then
+    returns an env sharing that structure for each ground truth.
+    """
 
-        return rec(node)
+    def __init__(
+        self,
+        tree,
+        init,
+        cost=0,
+        term_belief=True,
+        sample_term_reward=False,
+        last_action=0,
+        mdp_graph_properties={},
+    ):
+        """
+        Takes the same parameters as MouselabEnv, except for ground_truth
+        """
+        self.tree = tree
+        self.tree_str = str(tree)
+        self.prior = tuple(init)
+        self.init = (0, *init[1:])
+        self.cost = cost
+        self.term_belief = term_belief
+        self.sample_term_reward = sample_term_reward
+        self.last_action = last_action
+        self.term_action = len(self.init)
+        self.action_space = spaces.Discrete(len(self.init) + 1)
+        # parts of the episode history (besides the belief state) the cost reads
+        self.cost_history = tuple(getattr(cost, "history", ()))
+
+        self.node_attributes = node_attributes_from_adjacency_list(
+            tree, mdp_graph_properties
+        )
+        # revealed set is copied for each env
+        self.cost_context = CostContext(
+            tree, revealed=(last_action,), node_attributes=self.node_attributes
+        )
+
+        self.structure = TreeStructure.get(tree)
+        self.subtree = self.structure.subtree
+        self.subtree_slices = self.structure.subtree_slices
+        self.paths = self.structure.paths
+        self.paths_to = self.structure.paths_to
+        self.all_paths = self.structure.all_paths
+        self.leaves = self.structure.leaves
+        self.relevant_subtrees = self.structure.relevant_subtrees
+
+    def instantiate(self, ground_truth=None):
+        """Returns a MouselabEnv for ground_truth (sampled if None)."""
+        env = MouselabEnv.__new__(MouselabEnv)
+        env._attach_template(self, ground_truth)
+        return env
+
+    def instantiate_many(self, ground_truths):
+        """Returns a list of MouselabEnvs, one for each ground truth."""
+        return [self.instantiate(ground_truth) for ground_truth in ground_truths]
+
+    @classmethod
+    def new_symmetric(cls, branching, reward, **kwargs):
+        """Returns an EnvTemplate with a symmetric structure."""
+        tree, init = symmetric_tree(branching, reward)
+        return cls(tree, init, **kwargs)
+
+    @classmethod
+    def new_symmetric_registered(cls, experiment_setting, **kwargs):
+        branching = registry(experiment_setting).branching
+        reward = registry(experiment_setting).reward_function
+
+        return cls.new_symmetric(branching, reward, **kwargs)
+
+
+def symmetric_tree(branching, reward):
+    """Returns adjacency list and node distributions of a symmetric tree."""
+    if not callable(reward):
+        r = reward
+        reward = lambda depth: r
+
+    init = []
+    tree = []
+
+    def expand(d):
+        my_idx = len(init)
+        init.append(reward(d))
+        children = []
+        tree.append(children)
+        for _ in range(get(d, branching, 0)):
+            child_idx = expand(d + 1)
+            children.append(child_idx)
+        return my_idx
+
+    expand(0)
+    return tree, init
+
+
+def get_paths(tree, node):
+    if tree[node] == []:
+        return [[]]
+    paths = []
+    for n in tree[node]:
+        new_paths = get_paths(tree, n)
+        for path in new_paths:
+            path.insert(0, n)
+            paths.append(path)
+    return paths
+
+
+def path_to(tree, node, start=0):
+    path = [start]
+    if node == start:
+        return path
+    for _ in range(10000):
+        children = tree[path[-1]]
+        for i, child in enumerate(children):
+            if child == node:
+                path.append(node)
+                return path
+            if child > node:
+                path.append(children[i - 1])
+                break
+        else:
+            path.append(child)
+    assert False
+
+
+def all_paths(tree, start=0):
+    def rec(path):
+        children = tree[path[-1]]
+        if children:
+            for child in children:
+                yield from rec(path + [child])
+        else:
+            yield path
+
+    return list(rec([start]))
+
+
+def get_subtree_slices(tree):
+    slices = [0] * len(tree)
+
+    def get_end(n):
+        end = max((get_end(n1) for n1 in tree[n]), default=n + 1)
+        slices[n] = slice(n, end)
+        return end
+
+    get_end(0)
+    return slices
+
+
+def get_subtree(tree):
+    def gen(n):
+        yield n
+        for n1 in tree[n]:
+            yield from gen(n1)
+
+    return [tuple(gen(n)) for n in range(len(tree))]
+
+
+def node_value(tree, node, state):
+    """A distribution over total rewards of the best step taken from the given node."""
+    return max(
+        (node_value(tree, n1, state) + state[n1] for n1 in tree[node]),
+        default=ZERO,
+        key=expectation,
+    )
+
+
+def to_obs_tree(tree, state, node, obs=(), sort=True):
+    maybe_sort = sorted if sort else lambda x: x
+
+    def rec(n):
+        subjective_reward = state[n] if n in obs else expectation(state[n])
+        children = tuple(maybe_sort(rec(c) for c in tree[n]))
+        return (subjective_reward, children)
+
+    return rec(node)
+
+
+@lru_cache(CACHE_SIZE)
+def expected_term_reward(structure, state):
+    """Expected term reward in state, shared by all envs with the same structure."""
+    return node_value(structure.tree, 0, state).expectation()
+
+
+@lru_cache(CACHE_SIZE)
+def observation_value(structure, obs, state):
+    """Expected increase in term reward from observing the nodes in obs.
+
+    This is the myopic VOC for a single node, or the VPI for a set of nodes,
+    shared by all envs with the same structure.
+    """
+    obs_tree = to_obs_tree(structure.tree, state, 0, obs)
+    return exact_node_value_after_observe(
+        obs_tree
+    ).expectation() - expected_term_reward(structure, state)
 
 
 @lru_cache(SMALL_CACHE_SIZE)
@@ -1,7 +1,91 @@
 from collections import OrderedDict
 
 import numpy as np
-from policies import SoftmaxPolicy
+from mouselab.policies import SoftmaxPolicy
+
+
+# features of MouselabPolicy, its theta has one more (dummy) coefficient
+FEATURES = (
+    "is_term",
+    "term_reward",
+    "voi_myopic",
+    "vpi_action",
+    "vpi_full",
+    "quality_ev",
+    "quality_std",
+    "depth",
+)
+
+
+def features(env, state, action, theta=None):
+    """
+    Features of taking action in state (see MouselabPolicy)
+    :param theta: if given, features with a weight of 0 are not computed
+    :return: array of the FEATURES of action and the dummy feature
+    """
+    compute_all = theta is None
+    x = np.zeros(len(FEATURES) + 1)
+    if action == env.term_action:
+        x[0] = 1
+        x[1] = env.expected_term_reward(state)
+        # if etr > self.satisficing_threshold:
+        #     x[8] = 1e100
+        return x
+    else:
+        if not hasattr(state[action], "sample"):
+            # already clicked this node
+            x[8] = -1e100
+            return x
+        # Value of information
+        # the `theta[i] and` trick skips computing if feature won't be used
+        x[2] = (compute_all or theta[2]) and env.myopic_voc(action, state)
+        x[3] = (compute_all or theta[3]) and env.vpi_action(action, state)
+        x[4] = (compute_all or theta[4]) and env.vpi(state)
+
+        # Value of best path through the node (given current knowledge)
+        if compute_all or any(theta[5:7]):
+            quality = env.node_quality(action, state)
+            x[5] = quality.expectation()
+            x[6] = quality.std()
+
+        # Structural
+        x[7] = len(env.path_to(action)) - 1  # depth
+        # TODO: same_branch_as_last
+
+    return x
+
+
+def features_all(env, state, theta=None):
+    """
+    Features of every action in state, computing the features that are the
+    same for all clicks (vpi_full) once
+    :param theta: if given, features with a weight of 0 are not computed
+    :return: (number of actions, number of features + 1) array, rows like
+             features, NaN for the actions that are not possible
+    """
+    compute_all = theta is None
+    x = np.full((env.action_space.n, len(FEATURES) + 1), np.nan)
+    x[env.term_action] = features(env, state, env.term_action)
+    clicks = [action for action in env.actions(state) if action != env.term_action]
+    if not clicks:
+        return x
+    x[clicks] = 0
+    # Value of information
+    for action in clicks:
+        x[action, 2] = (compute_all or theta[2]) and env.myopic_voc(action, state)
+        x[action, 3] = (compute_all or theta[3]) and env.vpi_action(action, state)
+    x[clicks, 4] = (compute_all or theta[4]) and env.vpi(state)
+
+    # Value of best path through the node (given current knowledge)
+    if compute_all or any(theta[5:7]):
+        for action in clicks:
+            quality = env.node_quality(action, state)
+            x[action, 5] = quality.expectation()
+            x[action, 6] = quality.std()
+
+    # Structural
+    x[clicks, 7] = [len(env.path_to(action)) - 1 for action in clicks]  # depth
+    return x
 
 
 class MouselabPolicy(SoftmaxPolicy):
@@ -9,16 +93,8 @@ class MouselabPolicy(SoftmaxPolicy):
 
     def __init__(self, weights, **kwargs):
         super().__init__(**kwargs)
-        self.weights = OrderedDict(
-            is_term=0,
-            term_reward=1,
-            voi_myopic=0,
-            vpi_action=0,
-            vpi_full=0,
-            quality_ev=0,
-            quality_std=0,
-            depth=0,
-        )
+        self.weights = OrderedDict((feature, 0) for feature in FEATURES)
+        self.weights["term_reward"] = 1
         for k in weights:
             if k not in self.weights:
                 raise ValueError(f'No parameter named "{k}"')
@@ -33,34 +109,11 @@ class MouselabPolicy(SoftmaxPolicy):
         #     return 1e9 if action == self.env.term_action else -1e9
         return np.dot(self.theta, self.phi(state, action))
 
-    def phi(self, state, action, compute_all=False):
-        env, theta = self.env, self.theta
-        x = np.zeros(len(theta))
-        if action == env.term_action:
-            x[0] = 1
-            x[1] = env.expected_term_reward(state)
-            # if etr > self.satisficing_threshold:
-            #     x[8] = 1e100
-            return x
-        else:
-            if not hasattr(state[action], "sample"):
-                # already clicked this node
-                x[8] = -1e100
-                return x
-            # Value of information
-            # the `self.theta[i] and` trick skips computing if feature won't be used
-            x[2] = (compute_all or theta[2]) and env.myopic_voc(action, state)
-            x[3] = (compute_all or theta[3]) and env.vpi_action(action, state)
-            x[4] = (compute_all or theta[4]) and env.vpi(state)
-
-            # Value of best path through the node (given current knowledge)
-            if compute_all or any(theta[5:7]):
-                quality = env.node_quality(action, state)
-                x[5] = quality.expectation()
-                x[6] = quality.std()
-
-            # Structural
-            x[7] = len(env.path_to(action)) - 1  # depth
-            # TODO: same_branch_as_last
+    def preferences_all(self, state):
+        """Preferences of all actions, one product of their feature matrix."""
+        return features_all(self.env, state, theta=self.theta) @ self.theta
 
-        return x
+    def phi(self, state, action, compute_all=False):
+        return features(
+            self.env, state, action, theta=None if compute_all else self.theta
+        )
@@ -1,11 +1,9 @@
-import joblib
 import numpy as np
 import pandas as pd
-from toolz import partition_all
 
 from mouselab.agents import Agent
 from mouselab.envs.registry import registry
-from mouselab.mouselab import MouselabEnv
+from mouselab.mouselab import EnvTemplate, MouselabEnv
 
 def make_envs(cost=1.00, n=100, seed=None, env_type="constant_high"):
     if seed is not None:
@@ -14,13 +12,11 @@ def make_envs(cost=1.00, n=100, seed=None, env_type="constant_high"):
     # get env details
     env_details = registry(env_type)
 
-    # construct lst of envs using env details
-    envs = [
-        MouselabEnv.new_symmetric(
-            env_details.branching, env_details.reward_function, cost=cost
-        )
-        for _ in range(n)
-    ]
+    # construct lst of envs using env details, sharing structure between them
+    template = EnvTemplate.new_symmetric(
+        env_details.branching, env_details.reward_function, cost=cost
+    )
+    envs = [template.instantiate() for _ in range(n)]
 
     return envs
 
@@ -53,25 +49,14 @@ def evaluate(policy, envs):
     return pd.DataFrame(run_env(policy, env) for env in envs)
 
 
-__ENVS = None
-__AGENT = Agent()
-__CHUNKS = None
-
-
-def eval_chunk(i, return_mean=True):
-    # Each process should start with a different random seed.
-    np.random.seed(np.random.randint(1000) + i)
-    returns = []
-    for env in __CHUNKS[i]:
-        __AGENT.register(env)
-        returns.append(__AGENT.run_episode()["return"])
-    if return_mean:
-        return np.mean(returns)
-    else:
-        return returns
-
-
-def get_util(policy, envs, parallel=None, return_mean=True):
+def get_util(policy, envs, parallel=None, return_mean=True, seed=None):
+    """
+    Returns of policy on envs (or their mean)
+    :param parallel: joblib.Parallel to run the episodes with, sharded across
+                its n_jobs
+    :param seed: seed of the episodes when run in parallel (see Agent.run_many),
+                results do not depend on the number of jobs given a seed
+    """
     if parallel is None:
         util = evaluate(policy, envs).util
         if return_mean:
@@ -79,16 +64,11 @@ def get_util(policy, envs, parallel=None, return_mean=True):
         else:
             return util
     else:
-        np.random.randint(1000)  # cycle the random number generator
-        global __CHUNKS
-        chunk_size = len(envs) // parallel.n_jobs
-        __CHUNKS = list(partition_all(chunk_size, envs))
-        __AGENT.register(policy)
-        jobs = (
-            joblib.delayed(eval_chunk)(i, return_mean) for i in range(len(__CHUNKS))
-        )
-        result = parallel(jobs)
+        agent = Agent()
+        agent.register(list(envs))
+        agent.register(policy)
+        returns = agent.run_many(pbar=False, parallel=parallel, seed=seed)["return"]
         if return_mean:
-            return np.mean(result)
+            return np.mean(returns)
         else:
-            return np.concatenate(result)
+            return np.array(returns)
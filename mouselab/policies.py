@@ -1,22 +1,23 @@
-import random
 from abc import abstractmethod
-from collections import Counter, defaultdict, deque, namedtuple
+from collections import Counter, defaultdict, namedtuple
 
 import numpy as np
 from numpy.random import default_rng
 from toolz import memoize
 
-from mouselab.agents import Component, Model
-from mouselab.utils import PriorityQueue, softmax
+from mouselab.agents import Component, Memory, Model
+from mouselab.utils import PriorityQueue, masked_argmax, masked_softmax
 
 np.set_printoptions(precision=3, linewidth=200)
 
 
 class Policy(Component):
-    """Chooses actions."""
+    """Chooses actions, drawing random numbers from self.rng."""
 
     def __init__(self):
         super().__init__()
+        # replaced by a generator of the episode's seed in Agent.run_many
+        self.rng = default_rng()
 
     @abstractmethod
     def act(self, state):
@@ -38,6 +39,29 @@ class FunctionPolicy(Policy):
         return self.policy(state)
 
 
+class TablePolicy(Policy):
+    """Chooses uniformly between the best actions of a policy table.
+
+    The table needs a best_actions(state) method, e.g. PolicyTable or
+    PolicyArtifact from mouselab.policy_artifacts.
+    """
+
+    def __init__(self, table, seed=None):
+        super().__init__()
+        self.table = table
+        self.rng = default_rng(seed)
+
+    def act(self, state):
+        best_actions = self.table.best_actions(state)
+        return best_actions[self.rng.integers(len(best_actions))]
+
+    def action_distribution(self, state):
+        best_actions = self.table.best_actions(state)
+        action_probabilities = np.zeros(self.n_action)
+        action_probabilities[best_actions] = 1.0 / len(best_actions)
+        return action_probabilities
+
+
 class RandomPolicy(Policy):
     """Chooses actions randomly."""
 
@@ -61,10 +85,10 @@ class RandomPolicy(Policy):
         return action_probabilities
 
 
-class SoftmaxPolicy(Policy):
-    """Samples actions from a softmax over preferences."""
+class PreferencePolicy(Policy):
+    """Chooses actions by their preference (e.g. Q value) in a state."""
 
-    def __init__(self, preference=None, temp=1e-9, noise=1e-9, seed=None):
+    def __init__(self, preference=None, seed=None):
         super().__init__()
         if preference is None:
             assert hasattr(self, "preference")
@@ -72,35 +96,52 @@ class SoftmaxPolicy(Policy):
             self.preference = lambda state, action: preference[(state, action)]
         else:
             self.preference = preference
-        self.temp = temp
-        self.noise = noise
         self.rng = default_rng(seed)
 
     def act(self, state):
         probs = self.action_distribution(state)
-        probs += self.rng.random(len(probs)) * self.noise
-        probs /= probs.sum()
         return self.rng.choice(len(probs), p=probs)
 
+    @abstractmethod
+    def distributions(self, preferences):
+        """
+        Action distributions given preferences_all of one or more states
+        :param preferences: array with NaN for actions that are not possible
+        :return: array of action probabilities like preferences
+        """
+        pass
+
     def action_distribution(self, state):
         """
-        Finds the action distribution given a softmax
-        :param state:
-        :return:
+        Finds the action distribution in a state
+        :param state: state of interest
+        :return: array of probabilities of each action
+        """
+        return self.distributions(self.preferences_all(state))
+
+    def action_distributions(self, states):
         """
-        q, possible_actions = self.preferences(state)
-        softmax_actions = softmax(q, self.temp)
-        # mostly for readability, not efficiency
-        softmax_dict = dict(zip(possible_actions, softmax_actions))
-
-        action_probs = np.fromiter(
-            (
-                0 if action not in possible_actions else softmax_dict[action]
-                for action in range(self.n_action)
-            ),
-            dtype=np.float64,
+        Finds the action distributions in many states at once
+        :param states: iterable of states
+        :return: (number of states, number of actions) array of probabilities
+        """
+        return self.distributions(
+            np.array([self.preferences_all(state) for state in states]).reshape(
+                -1, self.n_action
+            )
         )
-        return action_probs
+
+    def preferences_all(self, state):
+        """
+        Finds the preferences for all actions in a state, override to compute
+        them together
+        :param state: state of interest
+        :return: array of preferences of each action, NaN if not possible
+        """
+        preferences = np.full(self.n_action, np.nan)
+        for action in self.env.actions(state):
+            preferences[action] = self.preference(state, action)
+        return preferences
 
     def preferences(self, state):
         """
@@ -108,66 +149,34 @@ class SoftmaxPolicy(Policy):
         :param state: state of interest
         :return: q values, respective possible_actions
         """
-        # need to first only do softmax over possible actions
-        possible_actions = np.fromiter(self.env.actions(state), dtype=int)
-        q = np.fromiter(
-            (self.preference(state, a) for a in possible_actions), dtype=np.float64
-        )
-        return q, possible_actions
+        preferences = self.preferences_all(state)
+        possible_actions = np.flatnonzero(~np.isnan(preferences))
+        return preferences[possible_actions], possible_actions
 
 
-class OptimalQ(Policy):
-    """Samples from optimal preferences in a state."""
+class SoftmaxPolicy(PreferencePolicy):
+    """Samples actions from a softmax over preferences."""
 
-    def __init__(self, preference=None, seed=None):
-        super().__init__()
-        if preference is None:
-            assert hasattr(self, "preference")
-        elif isinstance(preference, dict):
-            self.preference = lambda state, action: preference[(state, action)]
-        else:
-            self.preference = preference
-        self.rng = default_rng(seed)
+    def __init__(self, preference=None, temp=1e-9, noise=1e-9, seed=None):
+        super().__init__(preference=preference, seed=seed)
+        self.temp = temp
+        self.noise = noise
 
     def act(self, state):
         probs = self.action_distribution(state)
+        probs += self.rng.random(len(probs)) * self.noise
+        probs /= probs.sum()
         return self.rng.choice(len(probs), p=probs)
 
-    def action_distribution(self, state):
-        """
-        Finds the actions with max Q
-        :param state:
-        :return:
-        """
-        q, possible_actions = self.preferences(state)
-        max_q = np.amax(q)
-        max_actions = [
-            curr_action
-            for curr_q, curr_action in zip(q, possible_actions)
-            if np.abs(max_q - curr_q) < np.finfo(np.float).eps
-        ]
+    def distributions(self, preferences):
+        return masked_softmax(preferences, temp=self.temp)
 
-        action_probs = np.fromiter(
-            (
-                0 if action not in max_actions else 1.0 / len(max_actions)
-                for action in range(self.n_action)
-            ),
-            dtype=np.float64,
-        )
-        return action_probs
 
-    def preferences(self, state):
-        """
-        Finds the Q values for possible actions in a state
-        :param state: state of interest
-        :return: q values, respective possible_actions
-        """
-        # need to first only do softmax over possible actions
-        possible_actions = np.fromiter(self.env.actions(state), dtype=int)
-        q = np.fromiter(
-            (self.preference(state, a) for a in possible_actions), dtype=np.float64
-        )
-        return q, possible_actions
+class OptimalQ(PreferencePolicy):
+    """Samples from optimal preferences in a state."""
+
+    def distributions(self, preferences):
+        return masked_argmax(preferences)
 
 
 class RandomTreePolicy(Policy):
@@ -178,7 +187,7 @@ class RandomTreePolicy(Policy):
 
     def act(self, state):
         actions = list(self.env.actions(self.env._state))
-        return random.choice(actions)
+        return actions[self.rng.integers(len(actions))]
 
 
 class MaxQPolicy(Policy):
@@ -193,10 +202,10 @@ class MaxQPolicy(Policy):
     def act(self, state, anneal_step=0):
         q = self.Q.predict(state)
         epsilon = self.epsilon * self.anneal ** anneal_step
-        if np.random.rand() < epsilon:
-            noise = np.random.random(q.shape) * 1000
+        if self.rng.random() < epsilon:
+            noise = self.rng.random(q.shape) * 1000
         else:
-            noise = np.random.random(q.shape) * 0.001
+            noise = self.rng.random(q.shape) * 0.001
         return np.argmax(q + noise)
 
 
@@ -230,7 +239,7 @@ class MaxQSamplePolicy(Policy):
     def act(self, state):
         q, var = self.Q.predict(state, return_var=True)
         sigma = var ** 0.5
-        q_samples = q + np.random.randn() * sigma
+        q_samples = q + self.rng.standard_normal() * sigma
         a = np.argmax(q_samples)
         if self.save_regret:
             q = q.flat
@@ -240,21 +249,57 @@ class MaxQSamplePolicy(Policy):
         return a
 
 
+def _advantage_targets(policy, value, action, reward):
+    """
+    Advantages and value targets of the steps of one episode
+    :param policy: ActorCritic or GeneralizedAdvantageEstimation
+    :param value: value of each state of the episode, 0 for the final state
+    :param action: action of each step
+    :param reward: reward of each step
+    :return: (steps, actions) advantages, (steps, 1) value targets
+    """
+    n_step = len(reward)
+    # See Schulman et al. 2016 ICLR paper
+    delta = reward + policy.discount * value[1:] - value[:-1]  # pg. 4
+    advantage = np.zeros((n_step, policy.n_action))
+    value_target = np.zeros((n_step, 1))
+
+    for i in range(n_step):
+        adv = np.sum(delta[i:] * policy._actor_discount[: n_step - i])
+        advantage[i, action[i]] = adv
+        val_error = np.sum(delta[i:] * policy._critic_discount[: n_step - i])
+        value_target[i, 0] = value[i] + val_error
+        # value_target[i, 0] = reward[i] + self.discount * value[i+1]
+    return advantage, value_target
+
+
 class ActorCritic(Policy):
     """docstring for ActorCritic"""
 
-    def __init__(self, critic, actor_lr=0.001, discount=0.99, actor_lambda=1, **kwargs):
+    def __init__(
+        self,
+        critic,
+        actor_lr=0.001,
+        discount=0.99,
+        actor_lambda=1,
+        critic_lambda=1,
+        **kwargs
+    ):
         super().__init__()
         self.critic = critic
         self.discount = discount
         self.actor_lambda = actor_lambda
+        self.critic_lambda = critic_lambda
         self.actor_lr = actor_lr
 
         self._actor_discount = np.array(
             [(self.discount * self.actor_lambda) ** i for i in range(5000)]
         )
+        self._critic_discount = np.array(
+            [(self.discount * self.critic_lambda) ** i for i in range(5000)]
+        )
 
-        self.memory = deque(maxlen=100)
+        self._memory = Memory(size=10000)
         self.batch_size = 20
 
     def attach(self, agent):
@@ -287,35 +332,29 @@ class ActorCritic(Policy):
 
     def act(self, state):
         policy = self.actor.predict(state.reshape(1, -1)).flatten()
-        return np.random.choice(self.n_action, 1, p=policy)[0]
+        return self.rng.choice(self.n_action, p=policy)
 
     # update networks every episode
     def finish_episode(self, trace):
-        if len(self.memory) >= self.batch_size:
-            batch = np.random.choice(self.memory, self.batch_size)
-            batch.append(trace)
+        self._memory.add(trace)
+        if self._memory.num_episodes > self.batch_size:
+            batch = self._memory.sample_episodes(self.batch_size, rng=self.rng)
+            batch.append(self._memory.episode())
             self.train_batch(batch)
 
-    def train_batch(self, traces):
-        def data():
-            for trace in traces:
-                yield trace["states"][:-1], trace["actions"], trace["rewards"]
-
-        state, action, reward = map(np.concatenate, zip(*data()))
-        n_step = len(state)
-        # See Schulman et al. 2016 ICLR paper
-        value = np.r_[self.critic.predict(state).flat, 0]  # final state value
-        delta = reward + self.discount * value[1:] - value[:-1]  # pg. 4
-        advantage = np.zeros((n_step, self.n_action))
-        value_target = np.zeros((n_step, 1))
-
-        for i in range(n_step):
-            adv = np.sum(delta[i:] * self._actor_discount[: n_step - i])
-            advantage[i, action[i]] = adv
-            val_error = np.sum(delta[i:] * self._critic_discount[: n_step - i])
-            value_target[i, 0] = value[i] + val_error
-            # value_target[i, 0] = reward[i] + self.discount * value[i+1]
-
+    def train_batch(self, episodes):
+        # advantages are discounted within each episode, never across episodes
+        targets = [
+            _advantage_targets(
+                self,
+                np.r_[self.critic.predict(episode["states"]).flat, 0],
+                episode["actions"],
+                episode["rewards"],
+            )
+            for episode in episodes
+        ]
+        state = np.concatenate([episode["states"] for episode in episodes])
+        advantage, value_target = map(np.concatenate, zip(*targets))
         self.actor.fit(state, advantage, epochs=1, verbose=0)
         self.critic.fit(state, value_target, epochs=1, verbose=0)
 
@@ -323,21 +362,8 @@ class ActorCritic(Policy):
         state = np.stack(trace["states"][:-1])  # ignore final state
         action = trace["actions"]
         reward = trace["rewards"]
-        n_step = len(state)
-
-        # See Schulman et al. 2016 ICLR paper
         value = np.r_[self.critic.predict(state).flat, 0]  # final state value
-        delta = reward + self.discount * value[1:] - value[:-1]  # pg. 4
-        advantage = np.zeros((n_step, self.n_action))
-        value_target = np.zeros((n_step, 1))
-
-        for i in range(n_step):
-            adv = np.sum(delta[i:] * self._actor_discount[: n_step - i])
-            advantage[i, action[i]] = adv
-            val_error = np.sum(delta[i:] * self._critic_discount[: n_step - i])
-            value_target[i, 0] = value[i] + val_error
-            # value_target[i, 0] = reward[i] + self.discount * value[i+1]
-
+        advantage, value_target = _advantage_targets(self, value, action, reward)
         self.actor.fit(state, advantage, epochs=1, verbose=0)
         self.critic.fit(state, value_target, epochs=1, verbose=0)
 
@@ -371,7 +397,7 @@ class GeneralizedAdvantageEstimation(Policy):
             [(self.discount * self.critic_lambda) ** i for i in range(5000)]
         )
 
-        self._memory = deque(maxlen=100)
+        self._memory = Memory(size=10000)
         self.batch_size = 20
 
     def attach(self, agent):
@@ -428,38 +454,32 @@ class GeneralizedAdvantageEstimation(Policy):
 
     def act(self, state):
         policy = self.actor.predict(state.reshape(1, -1)).flatten()
-        return np.random.choice(self.n_action, 1, p=policy)[0]
+        return self.rng.choice(self.n_action, p=policy)
 
     # update networks every episode
     def finish_episode(self, trace):
-        if len(self._memory) >= self.batch_size:
-            batch = np.random.choice(self._memory, self.batch_size)
-            batch.append(trace)
+        self._memory.add(trace)
+        if self._memory.num_episodes > self.batch_size:
+            batch = self._memory.sample_episodes(self.batch_size, rng=self.rng)
+            batch.append(self._memory.episode())
             self.train_batch(batch)
         else:
             self.train(trace)
 
-    def train_batch(self, traces):
-        def data():
-            for trace in traces:
-                yield trace["states"][:-1], trace["actions"], trace["rewards"]
-
-        state, action, reward = map(np.concatenate, zip(*data()))
-        n_step = len(state)
-        # See Schulman et al. 2016 ICLR paper
-        # value = np.r_[self.critic.predict(state).flat, 0]  # final state value
-        value = np.r_[state.sum(1), 0]
-        delta = reward + self.discount * value[1:] - value[:-1]  # pg. 4
-        advantage = np.zeros((n_step, self.n_action))
-        value_target = np.zeros((n_step, 1))
-
-        for i in range(n_step):
-            adv = np.sum(delta[i:] * self._actor_discount[: n_step - i])
-            advantage[i, action[i]] = adv
-            val_error = np.sum(delta[i:] * self._critic_discount[: n_step - i])
-            value_target[i, 0] = value[i] + val_error
-            # value_target[i, 0] = reward[i] + self.discount * value[i+1]
-
+    def train_batch(self, episodes):
+        # advantages are discounted within each episode, never across episodes
+        targets = [
+            _advantage_targets(
+                self,
+                # np.r_[self.critic.predict(episode["states"]).flat, 0]
+                np.r_[episode["states"].sum(1), 0],
+                episode["actions"],
+                episode["rewards"],
+            )
+            for episode in episodes
+        ]
+        state = np.concatenate([episode["states"] for episode in episodes])
+        advantage, value_target = map(np.concatenate, zip(*targets))
         self.actor.fit(state, advantage, epochs=1, verbose=0)
         self.critic.fit(state, value_target, epochs=1, verbose=0)
 
@@ -467,21 +487,8 @@ class GeneralizedAdvantageEstimation(Policy):
         state = np.stack(trace["states"][:-1])  # ignore final state
         action = trace["actions"]
         reward = trace["rewards"]
-        n_step = len(state)
-
-        # See Schulman et al. 2016 ICLR paper
         value = np.r_[self.critic.predict(state).flat, 0]  # final state value
-        delta = reward + self.discount * value[1:] - value[:-1]  # pg. 4
-        advantage = np.zeros((n_step, self.n_action))
-        value_target = np.zeros((n_step, 1))
-
-        for i in range(n_step):
-            adv = np.sum(delta[i:] * self._actor_discount[: n_step - i])
-            advantage[i, action[i]] = adv
-            val_error = np.sum(delta[i:] * self._critic_discount[: n_step - i])
-            value_target[i, 0] = value[i] + val_error
-            # value_target[i, 0] = reward[i] + self.discount * value[i+1]
-
+        advantage, value_target = _advantage_targets(self, value, action, reward)
         self.actor.fit(state, advantage, epochs=1, verbose=0)
         self.critic.fit(state, value_target, epochs=1, verbose=0)
 
@@ -550,7 +557,7 @@ class ValSearchPolicy(Policy):
                 return np.inf  # the empty plan has infinite cost
             obs = env._observe(node.state)
             noise = (
-                np.random.rand() * (self.noise * self.anneal ** self.i_episode)
+                self.rng.random() * (self.noise * self.anneal ** self.i_episode)
                 if noisy
                 else 0
             )
@@ -570,7 +577,8 @@ class ValSearchPolicy(Policy):
             nonlocal best_finished
             best_finished = min((best_finished, node), key=eval_node)
             s0, p0, r0, _ = node
-            for a, s1, r, done in self.model.options(s0):
+            last_action = p0[-1] if p0 else getattr(env, "last_action", None)
+            for a, s1, r, done in self.model.options(s0, last_action):
                 node1 = Node(s1, p0 + [a], r0 + r, done)
                 if node1.reward <= reward_to_state[s1]:
                     continue  # cannot be better than an existing node
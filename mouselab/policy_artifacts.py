@@ -0,0 +1,565 @@
+"""On-disk format for solved policies.
+
+A policy artifact is a directory holding one .npy file per column (encoded
+states, Q values, best actions) and a JSON header describing the environment
+the policy was solved for. Arrays are loaded memory-mapped, so opening an
+artifact is instant and processes reading the same artifact share pages.
+
+Rows of the arrays are indexed by state rank (see mouselab.state_encoding).
+Artifacts of partial tables also store the (sorted) ranks of their rows.
+"""
+
+import json
+import shutil
+import tempfile
+import weakref
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+from mouselab.distributions import Categorical
+from mouselab.exact_utils import (
+    iter_pi_table,
+    iter_q_table,
+    lookup_table,
+    table_encoder,
+    table_row,
+)
+from mouselab.q_storage import HEADER_FILE as Q_HEADER_FILE
+from mouselab.q_storage import QuantizedQValues
+from mouselab.state_encoding import CHUNK_SIZE, StateEncoder, SymmetricStateEncoder
+
+FORMAT_VERSION = 2
+HEADER_FILE = "header.json"
+
+
+def _to_json_value(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def node_to_json(node):
+    """Serializes an entry of env.init (a categorical prior or a fixed value)."""
+    if isinstance(node, Categorical):
+        return {
+            "vals": [_to_json_value(val) for val in node.vals],
+            "probs": [_to_json_value(prob) for prob in node.probs],
+        }
+    elif hasattr(node, "sample"):
+        raise ValueError("Only categorical distributions can be saved")
+    return _to_json_value(node)
+
+
+def node_from_json(node):
+    if isinstance(node, dict):
+        return Categorical(node["vals"], node["probs"])
+    return node
+
+
+class _ArrayAppender(object):
+    """Appends rows to a .npy file, which stays loadable after each append."""
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.num_rows = 0
+        self.file = open(self.path, "wb+")
+        self._write_header()
+        self.data_offset = self.file.tell()
+
+    def _write_header(self):
+        # numpy pads headers so the first dimension can grow in place
+        self.file.seek(0)
+        np.lib.format.write_array_header_1_0(
+            self.file,
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.num_rows, *self.row_shape),
+            },
+        )
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError(
+                "Rows of shape {} can't be appended to {}".format(
+                    rows.shape[1:], self.path
+                )
+            )
+        self.file.seek(0, 2)
+        self.file.write(rows.tobytes())
+        self.num_rows += len(rows)
+        self._write_header()
+        if self.file.tell() != self.data_offset:
+            raise RuntimeError(f"Header of {self.path} outgrew its padding")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PolicyArtifactWriter(object):
+    """Writes a policy artifact chunk by chunk.
+
+    Chunks (as yielded by iter_pi_table or iter_q_table) are appended to
+    the arrays on disk as they come in, so memory is bounded by the chunk
+    size, and the rows written so far can be loaded while the job runs.
+    """
+
+    def __init__(
+        self, path, env, encoder, kind="pi", partial=False, metadata=None
+    ):
+        """
+        :param path: directory to save the artifact in (created if needed)
+        :param env: environment the policy was solved for
+        :param encoder: state encoder of the table
+        :param kind: "pi" to store best actions along with Q values, or "q"
+        :param partial: whether only some states are written, in which case
+                    their ranks are stored (chunks must come in order of rank)
+        :param metadata: extra JSON serializable information to store
+                    in the header (e.g. experiment setting)
+        """
+        if kind not in ("pi", "q"):
+            raise ValueError(f"Unknown policy artifact kind {kind}")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.encoder = encoder
+        self.partial = partial
+        self.num_rows = 0
+        self._last_rank = -1
+
+        num_actions = env.term_action + 1
+        columns = {
+            "codes": (encoder.dtype, (encoder.num_nodes,)),
+            "q_values": (np.float64, (num_actions,)),
+        }
+        if kind == "pi":
+            columns["max_actions"] = (np.uint64, ())
+        if partial:
+            columns["ranks"] = (np.int64, ())
+        self.columns = {
+            name: _ArrayAppender(self.path.joinpath(f"{name}.npy"), dtype, row_shape)
+            for name, (dtype, row_shape) in columns.items()
+        }
+
+        cost = env.template.cost
+        self.header = {
+            "format_version": FORMAT_VERSION,
+            "kind": kind,
+            "symmetric": isinstance(encoder, SymmetricStateEncoder),
+            "complete": False,
+            "n_states": int(encoder.n_states),
+            "num_actions": num_actions,
+            "tree": [list(map(int, children)) for children in env.tree],
+            "init": [node_to_json(node) for node in env.init],
+            # cost functions are only recorded by name
+            "cost": _to_json_value(cost) if np.isscalar(cost) else repr(cost),
+            "pct_reward": _to_json_value(getattr(env, "_pct_reward", 1)),
+            "arrays": {},
+            "metadata": metadata or {},
+        }
+        self._write_header()
+
+    def _write_header(self):
+        self.header["arrays"] = {
+            name: {
+                "dtype": column.dtype.name,
+                "shape": [column.num_rows, *column.row_shape],
+            }
+            for name, column in self.columns.items()
+        }
+        with open(self.path.joinpath(HEADER_FILE), "w") as f:
+            json.dump(self.header, f, indent=2)
+
+    def append(self, chunk):
+        """
+        Appends a chunk of rows
+        :param chunk: dictionary with the ranks of the states in the chunk
+                    and a value for each column (codes, q_values, max_actions)
+        """
+        ranks = np.asarray(chunk["ranks"], dtype=np.int64)
+        if len(ranks) == 0:
+            return
+        if self.partial:
+            if ranks[0] <= self._last_rank or np.any(np.diff(ranks) <= 0):
+                raise ValueError("Partial tables must be written in order of rank")
+        elif not np.array_equal(
+            ranks, np.arange(self.num_rows, self.num_rows + len(ranks))
+        ):
+            raise ValueError("Tables must be written in order of rank")
+
+        for name, column in self.columns.items():
+            column.append(ranks if name == "ranks" else chunk[name])
+        self.num_rows += len(ranks)
+        self._last_rank = ranks[-1]
+        self._write_header()
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        self.header["complete"] = self.partial or self.num_rows == self.encoder.n_states
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def save_policy_artifact(path, table, env, metadata=None, chunk_size=CHUNK_SIZE):
+    """
+    Saves a table from construct_q_table or construct_pi_table as an artifact
+    :param path: directory to save the artifact in (created if needed)
+    :param table: dictionary with an encoder, q_values and optionally
+                max_actions and ranks (of the rows, if not all states are saved)
+    :param env: environment the table was solved for
+    :param metadata: extra JSON serializable information to store in the header
+                (e.g. experiment setting)
+    :return: path of the artifact
+    """
+    encoder = table["encoder"]
+    num_rows = len(table["q_values"])
+    with PolicyArtifactWriter(
+        path,
+        env,
+        encoder,
+        kind="pi" if "max_actions" in table else "q",
+        partial="ranks" in table,
+        metadata=metadata,
+    ) as writer:
+        for start in range(0, num_rows, chunk_size):
+            stop = min(start + chunk_size, num_rows)
+            if "ranks" in table:
+                ranks = np.asarray(table["ranks"][start:stop])
+            else:
+                ranks = np.arange(start, stop)
+            chunk = {
+                name: table[name][start:stop]
+                for name in ("q_values", "max_actions")
+                if name in table
+            }
+            writer.append({"ranks": ranks, "codes": encoder.unrank(ranks), **chunk})
+    return Path(path)
+
+
+def write_pi_artifact(
+    path, pi, env, symmetric=False, ranks=None, metadata=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Evaluates pi for all states (or the states with the given ranks) chunk
+    by chunk, writing each chunk to a policy artifact as it is done
+    :param pi: pi function of the solved env (see exact.solve)
+    :param symmetric: whether to only store one state per set of states
+                equivalent up to swapping isomorphic subtrees
+    :param ranks: sorted ranks of the states to write, by default all states
+    :return: path of the artifact
+    """
+    encoder = table_encoder(env, symmetric=symmetric)
+    with PolicyArtifactWriter(
+        path, env, encoder, kind="pi", partial=ranks is not None, metadata=metadata
+    ) as writer:
+        for chunk in iter_pi_table(
+            pi, env, encoder, ranks=ranks, chunk_size=chunk_size
+        ):
+            writer.append(chunk)
+    return Path(path)
+
+
+def write_q_artifact(
+    path, Q, env, symmetric=False, ranks=None, metadata=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Evaluates Q for all states (or the states with the given ranks) chunk
+    by chunk, writing each chunk to a policy artifact as it is done
+    (see write_pi_artifact)
+    """
+    encoder = table_encoder(env, symmetric=symmetric)
+    with PolicyArtifactWriter(
+        path, env, encoder, kind="q", partial=ranks is not None, metadata=metadata
+    ) as writer:
+        for chunk in iter_q_table(Q, env, encoder, ranks=ranks, chunk_size=chunk_size):
+            writer.append(chunk)
+    return Path(path)
+
+
+def quantize_policy_artifact(
+    path,
+    encoding="float32",
+    delta_from_max=True,
+    codec=None,
+    level=None,
+    allow_argmax_changes=False,
+):
+    """
+    Replaces the float64 Q values of an artifact with a compact encoding
+    (see mouselab.q_storage)
+    :param encoding: one of q_storage.ENCODINGS
+    :param delta_from_max: whether to store differences to the best Q value
+    :param codec: block compression, None, "zlib", "zstd" or "lz4"
+    :param allow_argmax_changes: if False, raises a ValueError rather than
+                saving Q values whose best actions differ from the artifact's
+    :return: the QuantizedQValues saved, with their maximum absolute error
+    """
+    artifact = load_policy_artifact(path)
+    if "q_storage" in artifact.header:
+        raise ValueError(f"Q values of {path} are already quantized")
+
+    quantized = QuantizedQValues.quantize(
+        artifact.q_values,
+        encoding=encoding,
+        delta_from_max=delta_from_max,
+        max_actions=artifact.max_actions,
+    )
+    if quantized.argmax_changes and not allow_argmax_changes:
+        raise ValueError(
+            "Encoding {} changes the best actions of {} states "
+            "(maximum absolute error {})".format(
+                encoding, quantized.argmax_changes, quantized.max_abs_error
+            )
+        )
+    if codec is not None:
+        quantized = quantized.compress(codec, level=level)
+    quantized.save(artifact.path)
+
+    header = artifact.header
+    header["format_version"] = FORMAT_VERSION
+    header["q_storage"] = {
+        "encoding": encoding,
+        "delta_from_max": delta_from_max,
+        "codec": codec,
+        "max_abs_error": quantized.max_abs_error,
+        "argmax_changes": quantized.argmax_changes,
+    }
+    del header["arrays"]["q_values"]
+    with open(artifact.path.joinpath(HEADER_FILE), "w") as f:
+        json.dump(header, f, indent=2)
+
+    # release the memory map before deleting the file
+    del artifact
+    Path(path).joinpath("q_values.npy").unlink()
+    return quantized
+
+
+def _load_array(directory, name, mmap_mode="r"):
+    directory = Path(directory)
+    if name == "q_values" and directory.joinpath(Q_HEADER_FILE).exists():
+        return QuantizedQValues.load(directory, mmap_mode=mmap_mode)
+    return np.load(directory.joinpath(f"{name}.npy"), mmap_mode=mmap_mode)
+
+
+def load_policy_artifact(path, mmap_mode="r"):
+    """
+    Loads a policy artifact
+    :param path: directory of the artifact
+    :param mmap_mode: passed to np.load, None to read arrays into memory
+    :return: PolicyArtifact
+    """
+    return PolicyArtifact(path, mmap_mode=mmap_mode)
+
+
+class PolicyArtifact(Mapping):
+    """Read-only view of a saved policy.
+
+    Behaves like the dictionaries from construct_pi_dictionary: indexing
+    with a state returns a dictionary with max_actions (for pi artifacts)
+    and q_values, and iterating yields the (encoded) states stored.
+    """
+
+    def __init__(self, path, mmap_mode="r"):
+        self.path = Path(path)
+        with open(self.path.joinpath(HEADER_FILE)) as f:
+            self.header = json.load(f)
+        if self.header["format_version"] > FORMAT_VERSION:
+            raise ValueError(
+                "Policy artifact format version {} is newer than supported {}".format(
+                    self.header["format_version"], FORMAT_VERSION
+                )
+            )
+
+        self.init = tuple(node_from_json(node) for node in self.header["init"])
+        self.tree = self.header["tree"]
+        if self.header["symmetric"]:
+            self.encoder = SymmetricStateEncoder(self.init, self.tree)
+        else:
+            self.encoder = StateEncoder(self.init)
+
+        names = list(self.header["arrays"])
+        if "q_storage" in self.header:
+            names.append("q_values")
+        self.arrays = {
+            name: _load_array(self.path, name, mmap_mode=mmap_mode) for name in names
+        }
+        self.codes = self.arrays["codes"]
+        self.q_values = self.arrays["q_values"]
+        self.max_actions = self.arrays.get("max_actions")
+        self.ranks = self.arrays.get("ranks")
+
+    @property
+    def complete(self):
+        """Whether all rows have been written (False while still being written)."""
+        return self.header["complete"]
+
+    @property
+    def metadata(self):
+        return self.header["metadata"]
+
+    @property
+    def table(self):
+        """Table as returned by construct_q_table or construct_pi_table."""
+        return {"encoder": self.encoder, **self.arrays}
+
+    def lookup(self, state):
+        """Returns best actions (None for Q artifacts) and Q values of a state."""
+        return lookup_table(self.table, state)
+
+    def best_actions(self, state):
+        return self.lookup(state)[0]
+
+    def __getitem__(self, state):
+        best_actions, q_values = self.lookup(state)
+        if best_actions is None:
+            return {"q_values": q_values}
+        return {"max_actions": best_actions, "q_values": q_values}
+
+    def __contains__(self, state):
+        try:
+            table_row(self.table, state)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        for start in range(0, len(self.codes), CHUNK_SIZE):
+            yield from self.encoder.decode_many(self.codes[start:start + CHUNK_SIZE])
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def _shared_directory():
+    # RAM backed on Linux, so mapped tables never touch the disk
+    shm = Path("/dev/shm")
+    return tempfile.mkdtemp(prefix="policy_table_", dir=shm if shm.is_dir() else None)
+
+
+class PolicyTable(object):
+    """Policy lookup table that processes share instead of copying.
+
+    Arrays are memory-mapped .npy files (a policy artifact, or a temporary
+    directory for tables built in memory), and pickling a PolicyTable only
+    sends the state encoder and the location of the arrays, so any number of
+    worker processes can attach to the same pages. Looking up a state only
+    computes its rank, then indexes the arrays.
+    """
+
+    def __init__(self, encoder, directory, names, owner=False):
+        """
+        :param encoder: state encoder of the table
+        :param directory: directory holding a .npy file per array
+        :param names: names of the arrays
+        :param owner: whether to delete directory on close (or once the
+                    table is garbage collected, if it is never closed)
+        """
+        self.encoder = encoder
+        self.directory = Path(directory)
+        self.names = tuple(names)
+        self.owner = owner
+        self._finalizer = None
+        if owner:
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, str(self.directory), True
+            )
+        self.arrays = {name: _load_array(self.directory, name) for name in self.names}
+        self.q_values = self.arrays["q_values"]
+        self.max_actions = self.arrays.get("max_actions")
+
+    @classmethod
+    def from_artifact(cls, path):
+        """Attaches to the arrays of a policy artifact."""
+        artifact = load_policy_artifact(path)
+        return cls(artifact.encoder, artifact.path, artifact.arrays)
+
+    @classmethod
+    def from_table(cls, table, directory=None):
+        """
+        Moves a table from construct_pi_table or construct_q_table out of
+        process memory, into memory-mapped files
+        :param directory: directory to save the arrays in, by default a
+                    temporary directory deleted on close (use the table as a
+                    context manager)
+        """
+        owner = directory is None
+        directory = Path(_shared_directory() if owner else directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        names = [name for name in table if name != "encoder"]
+        for name in names:
+            np.save(directory.joinpath(f"{name}.npy"), table[name])
+        return cls(table["encoder"], directory, names, owner=owner)
+
+    def __reduce__(self):
+        # other processes attach to the arrays, only the owner deletes them
+        return (type(self), (self.encoder, self.directory, self.names))
+
+    @property
+    def table(self):
+        return {"encoder": self.encoder, **self.arrays}
+
+    def row(self, state):
+        """Row of a state, and the permutation mapping its actions to the row's."""
+        return table_row(self.table, state)
+
+    def lookup(self, state):
+        """Returns best actions (None for Q tables) and Q values of a state."""
+        return lookup_table(self.table, state)
+
+    def max_actions_mask(self, state):
+        """Bitmask of the best actions in a state (bit a set if a is optimal)."""
+        row, permutation = self.row(state)
+        mask = int(self.max_actions[row])
+        return sum(
+            1 << action
+            for action, table_action in enumerate(permutation.tolist())
+            if mask >> table_action & 1
+        )
+
+    def best_actions(self, state):
+        mask = self.max_actions_mask(state)
+        return [action for action in range(mask.bit_length()) if mask >> action & 1]
+
+    def q_row(self, state):
+        """Q values of all actions in a state, NaN for unavailable actions."""
+        row, permutation = self.row(state)
+        return self.q_values[row][permutation]
+
+    def rows_for_codes(self, codes):
+        """
+        Rows of an array of encoded states, computed in one go
+        (only for tables which are not symmetric, where the actions of
+        the rows are the actions of the states)
+        """
+        if isinstance(self.encoder, SymmetricStateEncoder):
+            raise ValueError("Rows of symmetric tables need the states' permutation")
+        ranks = self.encoder.rank(codes)
+        if "ranks" not in self.arrays:
+            return ranks
+        rows = np.searchsorted(self.arrays["ranks"], ranks)
+        stored = self.arrays["ranks"][np.minimum(rows, len(self.arrays["ranks"]) - 1)]
+        if np.any(stored != ranks):
+            raise KeyError("Some states are not in the table")
+        return rows
+
+    def close(self):
+        self.arrays = {}
+        self.q_values = self.max_actions = None
+        if self.owner:
+            self._finalizer()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,160 @@
+"""Vectorized comparison of two policy tables over the same states.
+
+Tables are the dictionaries from construct_pi_table (or the table of a
+PolicyArtifact / PolicyTable), e.g. the optimal policies of the same
+environment at two scarcity levels. The best actions of each state are
+compared as bitmasks, so millions of states are compared with a handful of
+array operations per chunk.
+"""
+
+import numpy as np
+import pandas as pd
+
+from mouselab.state_encoding import CHUNK_SIZE
+
+# relation of the best actions of table 2 to those of table 1
+RELATIONS = ("equal", "subset", "superset", "intersecting", "disjoint")
+EQUAL, SUBSET, SUPERSET, INTERSECTING, DISJOINT = range(len(RELATIONS))
+
+
+def node_depths(tree):
+    """Depth of each node of a tree given as adjacency list."""
+    depths = np.zeros(len(tree), dtype=np.int64)
+    for node, children in enumerate(tree):
+        for child in children:
+            depths[child] = depths[node] + 1
+    return depths
+
+
+def classify_best_actions(max_actions_1, max_actions_2):
+    """
+    Relation of two arrays of best action bitmasks, as indices into RELATIONS
+    (e.g. SUBSET if the best actions of 2 are a strict subset of those of 1)
+    """
+    max_actions_1 = np.asarray(max_actions_1, dtype=np.uint64)
+    max_actions_2 = np.asarray(max_actions_2, dtype=np.uint64)
+    shared = max_actions_1 & max_actions_2
+
+    relation = np.full(max_actions_1.shape, INTERSECTING, dtype=np.int8)
+    relation[shared == 0] = DISJOINT
+    relation[shared == max_actions_1] = SUPERSET
+    relation[shared == max_actions_2] = SUBSET
+    relation[max_actions_1 == max_actions_2] = EQUAL
+    return relation
+
+
+def _aligned_rows(table_1, table_2):
+    """Rows of the states both tables hold, and the ranks of these states."""
+    if "ranks" not in table_1 and "ranks" not in table_2:
+        ranks = np.arange(len(table_1["q_values"]))
+        return ranks, ranks, ranks
+
+    def ranks_of(table):
+        return table.get("ranks", np.arange(len(table["q_values"])))
+
+    ranks, rows_1, rows_2 = np.intersect1d(
+        ranks_of(table_1), ranks_of(table_2), assume_unique=True, return_indices=True
+    )
+    return ranks, rows_1, rows_2
+
+
+def _check_compatible(table_1, table_2):
+    encoder_1, encoder_2 = table_1["encoder"], table_2["encoder"]
+    if type(encoder_1) is not type(encoder_2) or encoder_1.init != encoder_2.init:
+        raise ValueError("Tables must be over the same states")
+    if getattr(encoder_1, "tree", None) != getattr(encoder_2, "tree", None):
+        raise ValueError("Tables must be over the same states")
+
+
+def diff_policy_tables(table_1, table_2, tree, chunk_size=CHUNK_SIZE):
+    """
+    Compares the best actions and Q values of two policy tables
+    :param table_1, table_2: tables with an encoder, q_values and max_actions
+    :param tree: adjacency list of the environment, for the depth of nodes
+    :param chunk_size: number of states compared at once
+    :return: dictionary with
+                counts: number of states for each relation in RELATIONS
+                by_num_revealed: counts of each relation, mean change in state
+                    value and maximum absolute change in Q value, per number
+                    of revealed nodes in a state
+                by_depth: same, per depth of the deepest revealed node
+                ranks: ranks of the states of each relation other than equal
+    """
+    _check_compatible(table_1, table_2)
+    encoder = table_1["encoder"]
+    depths = node_depths(tree)
+    ranks, rows_1, rows_2 = _aligned_rows(table_1, table_2)
+
+    groups = {
+        "num_revealed": encoder.num_nodes + 1,
+        "depth": int(depths.max()) + 1,
+    }
+    relation_counts = {
+        group: np.zeros((len(RELATIONS), size), dtype=np.int64)
+        for group, size in groups.items()
+    }
+    value_delta_sums = {group: np.zeros(size) for group, size in groups.items()}
+    max_abs_q_deltas = {group: np.zeros(size) for group, size in groups.items()}
+    differing_ranks = {relation: [] for relation in RELATIONS[1:]}
+
+    for start in range(0, len(ranks), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        chunk_rows_1, chunk_rows_2 = rows_1[chunk], rows_2[chunk]
+
+        if "codes" in table_1:
+            codes = np.asarray(table_1["codes"][chunk_rows_1])
+        else:
+            codes = encoder.unrank(ranks[chunk])
+        revealed = codes != 0
+        keys = {
+            "num_revealed": revealed.sum(axis=1),
+            "depth": (revealed * depths).max(axis=1),
+        }
+
+        relation = classify_best_actions(
+            table_1["max_actions"][chunk_rows_1], table_2["max_actions"][chunk_rows_2]
+        )
+        q_values_1 = np.asarray(table_1["q_values"][chunk_rows_1])
+        q_values_2 = np.asarray(table_2["q_values"][chunk_rows_2])
+        # actions available in a state are the same in both tables
+        abs_q_delta = np.fmax.reduce(np.abs(q_values_2 - q_values_1), axis=1)
+        value_delta = np.fmax.reduce(q_values_2, axis=1) - np.fmax.reduce(
+            q_values_1, axis=1
+        )
+
+        for group, size in groups.items():
+            key = keys[group]
+            relation_counts[group] += np.bincount(
+                relation.astype(np.int64) * size + key, minlength=len(RELATIONS) * size
+            ).reshape(len(RELATIONS), size)
+            value_delta_sums[group] += np.bincount(
+                key, weights=value_delta, minlength=size
+            )
+            np.maximum.at(max_abs_q_deltas[group], key, abs_q_delta)
+
+        for relation_idx, relation_name in enumerate(RELATIONS[1:], 1):
+            differing_ranks[relation_name].append(
+                ranks[chunk][relation == relation_idx]
+            )
+
+    summaries = {}
+    for group in groups:
+        summary = pd.DataFrame(relation_counts[group].T, columns=RELATIONS)
+        summary.index.name = group
+        states = summary[list(RELATIONS)].sum(axis=1)
+        summary["states"] = states
+        summary["mean_value_delta"] = value_delta_sums[group] / states.where(states > 0)
+        summary["max_abs_q_delta"] = max_abs_q_deltas[group]
+        summaries[group] = summary[summary["states"] > 0]
+
+    return {
+        "counts": summaries["num_revealed"][list(RELATIONS)].sum(),
+        "by_num_revealed": summaries["num_revealed"],
+        "by_depth": summaries["depth"],
+        "ranks": {
+            relation: np.concatenate(relation_ranks)
+            if relation_ranks
+            else np.array([], dtype=np.int64)
+            for relation, relation_ranks in differing_ranks.items()
+        },
+    }
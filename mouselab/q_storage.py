@@ -0,0 +1,339 @@
+"""Quantized and compressed storage for Q tables.
+
+Q values are stored with a smaller encoding (float32, float16 or fixed
+point), optionally as the difference to the highest Q value of each state,
+which keeps ties exact and shrinks the range the encoding has to cover.
+Rows can be compressed in blocks (zlib, or zstd/lz4 if installed), which
+are decompressed on access, so rows can still be looked up one at a time.
+
+Every encoding reports its maximum absolute error and the number of states
+whose best actions would change, so precision is never lost silently.
+"""
+
+import json
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from mouselab.state_encoding import CHUNK_SIZE
+
+ENCODINGS = {
+    "float64": np.float64,
+    "float32": np.float32,
+    "float16": np.float16,
+    "fixed32": np.int32,
+    "fixed16": np.int16,
+}
+CODECS = (None, "zlib", "zstd", "lz4")
+HEADER_FILE = "q_header.json"
+# tolerance of exact.solve's pi when finding the best actions
+ARGMAX_TOLERANCE = 1e-7
+
+
+def _compress(data, codec, level=None):
+    if codec == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    elif codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(
+            data
+        )
+    elif codec == "lz4":
+        import lz4.frame
+
+        return lz4.frame.compress(data, compression_level=level or 0)
+    raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+
+
+def _decompress(data, codec):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    elif codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "lz4":
+        import lz4.frame
+
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+
+
+def best_action_masks(q_values, tolerance=ARGMAX_TOLERANCE):
+    """Bitmasks of the actions within tolerance of the highest Q value."""
+    q_values = np.asarray(q_values, dtype=np.float64)
+    is_best = q_values >= np.fmax.reduce(q_values, axis=1)[:, None] - tolerance
+    bits = np.uint64(1) << np.arange(q_values.shape[1], dtype=np.uint64)
+    return np.bitwise_or.reduce(np.where(is_best, bits, np.uint64(0)), axis=1)
+
+
+class QuantizedQValues(object):
+    """Q table in a compact encoding, indexed like the float64 array it stores.
+
+    Indexing (with a row, slice or array of rows) returns float64 Q values,
+    so instances can replace q_values in the tables of exact_utils.
+    """
+
+    def __init__(
+        self,
+        data,
+        encoding,
+        row_max=None,
+        resolution=None,
+        max_abs_error=0.0,
+        argmax_changes=0,
+        codec=None,
+        block_rows=CHUNK_SIZE,
+        shape=None,
+        block_offsets=None,
+    ):
+        self.data = data
+        self.encoding = encoding
+        self.dtype = np.dtype(ENCODINGS[encoding])
+        self.row_max = row_max
+        self.resolution = resolution
+        self.max_abs_error = max_abs_error
+        self.argmax_changes = argmax_changes
+        self.codec = codec
+        self.block_rows = block_rows
+        self.shape = tuple(data.shape if shape is None else shape)
+        self.block_offsets = block_offsets
+        self._block_cache = {}
+
+    @classmethod
+    def quantize(
+        cls,
+        q_values,
+        encoding="float32",
+        delta_from_max=False,
+        resolution=None,
+        max_actions=None,
+        chunk_size=CHUNK_SIZE,
+    ):
+        """
+        Quantizes a (number of states, number of actions) array of Q values,
+        with NaN for unavailable actions
+        :param encoding: one of ENCODINGS, fixed point encodings store
+                    integer multiples of resolution
+        :param delta_from_max: whether to store Q values as their difference
+                    to the highest Q value of the state (kept in float64)
+        :param resolution: step of fixed point encodings, by default the
+                    smallest step covering the range of the values
+        :param max_actions: best action bitmasks to check the quantized
+                    values against, by default those of q_values
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(
+                f"Unknown encoding {encoding}, expected one of {list(ENCODINGS)}"
+            )
+        if not hasattr(q_values, "shape"):
+            q_values = np.asarray(q_values, dtype=np.float64)
+        dtype = np.dtype(ENCODINGS[encoding])
+        chunks = [
+            slice(start, start + chunk_size)
+            for start in range(0, len(q_values), chunk_size)
+        ]
+
+        def values_of(chunk):
+            values = np.asarray(q_values[chunk], dtype=np.float64)
+            if delta_from_max:
+                values = values - row_max[chunk, None]
+            return values
+
+        row_max = None
+        if delta_from_max:
+            row_max = np.empty(len(q_values))
+            for chunk in chunks:
+                row_max[chunk] = np.fmax.reduce(np.asarray(q_values[chunk]), axis=1)
+        if encoding.startswith("fixed") and resolution is None:
+            # the smallest integer is reserved for NaN
+            largest = max(
+                (np.nanmax(np.abs(values_of(chunk)), initial=0) for chunk in chunks),
+                default=0,
+            )
+            resolution = float(largest / (np.iinfo(dtype).max - 1)) or 1.0
+
+        quantized = cls(
+            np.empty(q_values.shape, dtype=dtype),
+            encoding,
+            row_max=row_max,
+            resolution=resolution,
+        )
+        for chunk in chunks:
+            quantized.data[chunk] = quantized._encode(values_of(chunk))
+
+            original = np.asarray(q_values[chunk], dtype=np.float64)
+            restored = quantized[chunk]
+            error = np.abs(restored - original)
+            quantized.max_abs_error = max(
+                quantized.max_abs_error, float(np.nanmax(error, initial=0))
+            )
+            if max_actions is None:
+                expected = best_action_masks(original)
+            else:
+                expected = np.asarray(max_actions[chunk], dtype=np.uint64)
+            quantized.argmax_changes += int(
+                np.sum(best_action_masks(restored) != expected)
+            )
+        return quantized
+
+    def _encode(self, values):
+        if not self.encoding.startswith("fixed"):
+            return values.astype(self.dtype)
+        encoded = np.round(values / self.resolution)
+        encoded[np.isnan(values)] = np.iinfo(self.dtype).min
+        return encoded.astype(self.dtype)
+
+    def _decode(self, data):
+        if not self.encoding.startswith("fixed"):
+            return data.astype(np.float64)
+        decoded = data.astype(np.float64) * self.resolution
+        decoded[data == np.iinfo(self.dtype).min] = np.nan
+        return decoded
+
+    def _data_rows(self, rows):
+        if self.codec is None:
+            return self.data[rows]
+        # only decompress the blocks holding the rows asked for
+        rows = np.arange(self.shape[0])[rows]
+        single_row = rows.ndim == 0
+        rows = np.atleast_1d(rows)
+        data = np.empty((*rows.shape, self.shape[1]), dtype=self.dtype)
+        blocks = rows // self.block_rows
+        for block in np.unique(blocks):
+            in_block = blocks == block
+            block_rows = rows[in_block] - block * self.block_rows
+            data[in_block] = self._block(block)[block_rows]
+        return data[0] if single_row else data
+
+    def _block(self, block):
+        if block not in self._block_cache:
+            start, stop = self.block_offsets[block], self.block_offsets[block + 1]
+            self._block_cache = {
+                block: np.frombuffer(
+                    _decompress(bytes(self.data[start:stop]), self.codec),
+                    dtype=self.dtype,
+                ).reshape(-1, self.shape[1])
+            }
+        return self._block_cache[block]
+
+    def __getitem__(self, rows):
+        values = self._decode(self._data_rows(rows))
+        if self.row_max is not None:
+            values += np.asarray(self.row_max[rows])[..., None]
+        return values
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Bytes taken by the stored values."""
+        row_max_bytes = 0 if self.row_max is None else self.row_max.nbytes
+        return self.data.nbytes + row_max_bytes
+
+    def to_float(self):
+        return self[:]
+
+    def compress(self, codec="zlib", level=None, block_rows=CHUNK_SIZE):
+        """
+        Returns a copy with rows compressed in blocks of block_rows
+        (zstd and lz4 need the zstandard and lz4 packages)
+        """
+        if self.codec is not None:
+            raise ValueError("Q values are already compressed")
+        blocks = [
+            _compress(
+                np.ascontiguousarray(self.data[start:start + block_rows]).tobytes(),
+                codec,
+                level=level,
+            )
+            for start in range(0, self.shape[0], block_rows)
+        ]
+        return QuantizedQValues(
+            np.frombuffer(b"".join(blocks), dtype=np.uint8),
+            self.encoding,
+            row_max=self.row_max,
+            resolution=self.resolution,
+            max_abs_error=self.max_abs_error,
+            argmax_changes=self.argmax_changes,
+            codec=codec,
+            block_rows=block_rows,
+            shape=self.shape,
+            block_offsets=np.cumsum([0] + [len(block) for block in blocks]),
+        )
+
+    def save(self, path):
+        """Saves into directory path, e.g. the directory of a policy artifact."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path.joinpath("q_data.npy"), self.data)
+        if self.row_max is not None:
+            np.save(path.joinpath("q_row_max.npy"), self.row_max)
+        if self.block_offsets is not None:
+            np.save(path.joinpath("q_block_offsets.npy"), self.block_offsets)
+
+        header = {
+            "encoding": self.encoding,
+            "delta_from_max": self.row_max is not None,
+            "resolution": self.resolution,
+            "max_abs_error": self.max_abs_error,
+            "argmax_changes": self.argmax_changes,
+            "codec": self.codec,
+            "block_rows": self.block_rows,
+            "shape": list(self.shape),
+        }
+        with open(path.joinpath(HEADER_FILE), "w") as f:
+            json.dump(header, f, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        path = Path(path)
+        with open(path.joinpath(HEADER_FILE)) as f:
+            header = json.load(f)
+
+        def load_array(name, required=True):
+            file = path.joinpath(f"{name}.npy")
+            if required or file.exists():
+                return np.load(file, mmap_mode=mmap_mode)
+
+        return cls(
+            load_array("q_data"),
+            header["encoding"],
+            row_max=load_array("q_row_max", required=header["delta_from_max"]),
+            resolution=header["resolution"],
+            max_abs_error=header["max_abs_error"],
+            argmax_changes=header["argmax_changes"],
+            codec=header["codec"],
+            block_rows=header["block_rows"],
+            shape=header["shape"],
+            block_offsets=load_array("q_block_offsets", required=False),
+        )
+
+
+def compare_encodings(q_values, encodings=None, delta_from_max=(False, True)):
+    """
+    Quantizes q_values with every encoding, to pick the smallest exact enough
+    :return: list of dictionaries with the encoding, whether values are
+                stored as deltas from the maximum, the bytes taken, the
+                maximum absolute error and the number of changed argmax sets
+    """
+    results = []
+    for encoding in ENCODINGS if encodings is None else encodings:
+        for delta in delta_from_max:
+            quantized = QuantizedQValues.quantize(
+                q_values, encoding=encoding, delta_from_max=delta
+            )
+            results.append(
+                {
+                    "encoding": encoding,
+                    "delta_from_max": delta,
+                    "nbytes": quantized.nbytes,
+                    "max_abs_error": quantized.max_abs_error,
+                    "argmax_changes": quantized.argmax_changes,
+                }
+            )
+    return results
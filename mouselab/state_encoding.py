@@ -0,0 +1,374 @@
+"""Integer encoding of belief states of a MouselabEnv with categorical rewards.
+
+Every node of a belief state is either unrevealed (it still holds its prior
+distribution) or revealed as one of the values of that distribution. A state
+is encoded as one small integer per node: 0 for the prior and i + 1 for the
+i-th value of the prior. Nodes with a fixed value (e.g. the start node) only
+have code 0.
+
+Read as digits of a mixed-radix number, the codes of a state give its rank,
+a bijection between all belief states and 0..n_states - 1. This lets us walk
+every belief state without building lists or deduplicating.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from math import comb
+except ImportError:  # Python < 3.8
+
+    def comb(n, k):
+        """Number of ways to choose k of n items."""
+        n, k = int(n), int(k)
+        if k < 0 or k > n:
+            return 0
+        k = min(k, n - k)
+        result = 1
+        for i in range(1, k + 1):
+            result = result * (n - k + i) // i
+        return result
+
+
+# chunks of codes yielded while enumerating states
+CHUNK_SIZE = int(2 ** 16)
+
+
+class StateEncoder(object):
+    """Encodes belief states as arrays of per-node integer codes."""
+
+    def __init__(self, init):
+        """
+        :param init: initial (unrevealed) state, e.g. env.init,
+                    with a categorical distribution or fixed value behind each node
+        """
+        self.init = tuple(init)
+        self.values = []
+        for node in self.init:
+            if hasattr(node, "sample") and not hasattr(node, "vals"):
+                raise ValueError(
+                    "States can only be encoded for categorical distributions"
+                )
+            self.values.append(tuple(node.vals) if hasattr(node, "vals") else ())
+        self._codes = [
+            {value: code + 1 for code, value in enumerate(values)}
+            for values in self.values
+        ]
+
+        self.num_nodes = len(self.init)
+        self.radices = np.array([len(values) + 1 for values in self.values])
+        self.dtype = np.uint8 if self.radices.max() <= 256 else np.int32
+
+        # last node is the least significant digit
+        self.n_states = 1
+        place_values = []
+        for radix in reversed(self.radices.tolist()):
+            place_values.append(self.n_states)
+            self.n_states *= radix
+        self._place_values = place_values[::-1]
+
+    @classmethod
+    def from_env(cls, env):
+        return cls(env.init)
+
+    def encode_node(self, node, entry):
+        if hasattr(entry, "sample") or not self._codes[node]:
+            return 0
+        try:
+            return self._codes[node][entry]
+        except KeyError:
+            raise ValueError(f"{entry} is not a possible value of node {node}")
+
+    def encode(self, state):
+        """Returns array of codes for a belief state."""
+        return np.array(
+            [self.encode_node(node, entry) for node, entry in enumerate(state)],
+            dtype=self.dtype,
+        )
+
+    def encode_many(self, states):
+        """Returns (number of states, number of nodes) array of codes."""
+        codes = np.empty((len(states), self.num_nodes), dtype=self.dtype)
+        for idx, state in enumerate(states):
+            codes[idx] = self.encode(state)
+        return codes
+
+    def decode(self, codes):
+        """Returns belief state (as tuple) for an array of codes."""
+        return tuple(
+            self.values[node][code - 1] if code else self.init[node]
+            for node, code in enumerate(np.asarray(codes).tolist())
+        )
+
+    def decode_many(self, codes):
+        return [self.decode(row) for row in codes]
+
+    def rank(self, codes):
+        """Mixed-radix rank of codes, for a single state or an array of states."""
+        return np.asarray(codes, dtype=np.int64) @ self.place_values
+
+    def unrank(self, ranks):
+        """Inverse of rank, returns array of codes with one row per rank."""
+        ranks = np.asarray(ranks, dtype=np.int64)
+        return (
+            (ranks[..., None] // self.place_values) % self.radices
+        ).astype(self.dtype)
+
+    @property
+    def place_values(self):
+        if self.n_states > np.iinfo(np.int64).max:
+            raise OverflowError("Too many states to rank with 64 bit integers")
+        return np.array(self._place_values, dtype=np.int64)
+
+    def canonicalize(self, codes):
+        """
+        Returns codes of the state stored at the rank of codes, and the
+        permutation mapping actions on codes to actions on that state
+        (the identity, see SymmetricStateEncoder)
+        """
+        return np.asarray(codes, dtype=self.dtype), np.arange(self.num_nodes + 1)
+
+    def iter_codes(self, chunk_size=CHUNK_SIZE, start=0, stop=None):
+        """
+        Yields codes of every belief state (ranks start to stop) in chunks,
+        without generating any duplicates
+        :param chunk_size: maximum number of states in each chunk
+        :return: generator of (chunk size, number of nodes) arrays of codes
+        """
+        stop = self.n_states if stop is None else stop
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            yield self.unrank(np.arange(chunk_start, chunk_stop, dtype=np.int64))
+
+    def iter_states(self, chunk_size=CHUNK_SIZE):
+        """Yields every belief state as tuple."""
+        for codes in self.iter_codes(chunk_size=chunk_size):
+            yield from self.decode_many(codes)
+
+
+class SymmetricStateEncoder(StateEncoder):
+    """Ranks belief states up to swapping isomorphic sibling subtrees.
+
+    Sibling subtrees with the same shape and the same priors are
+    interchangeable, so only one state per equivalence class is ranked: the
+    canonical state, where the children in each group of isomorphic siblings
+    are sorted by the rank of their own subtree. A group of k children, each
+    with m canonical subtree states, is then a multiset of k ranks out of m,
+    ranked with the combinatorial number system. Nodes' own codes and the
+    ranks of their groups of children are combined as a mixed-radix number.
+
+    This is only valid when the value of a state is invariant under these
+    permutations, e.g. not for costs depending on the layout of the nodes.
+    """
+
+    def __init__(self, init, tree):
+        """
+        :param init: initial (unrevealed) state, e.g. env.init
+        :param tree: adjacency list of the tree, e.g. env.tree
+        """
+        super().__init__(init)
+        self.tree = [list(children) for children in tree]
+
+        shape_ids = {}
+        self._shape = [None] * self.num_nodes
+        # children grouped by shape, groups ordered by shape
+        self._groups = [None] * self.num_nodes
+        # number of canonical states of the subtree below a node
+        self._n_subtree_states = [None] * self.num_nodes
+        self._n_group_states = [None] * self.num_nodes
+        for node in reversed(range(self.num_nodes)):
+            children = self.tree[node]
+            if any(child <= node for child in children):
+                raise ValueError("Nodes must be numbered depth-first from the root")
+            shape = (
+                self.init[node],
+                tuple(sorted(self._shape[child] for child in children)),
+            )
+            self._shape[node] = shape_ids.setdefault(shape, len(shape_ids))
+
+            groups = {}
+            for child in children:
+                groups.setdefault(self._shape[child], []).append(child)
+            self._groups[node] = [groups[shape] for shape in sorted(groups)]
+
+            n_states = int(self.radices[node])
+            self._n_group_states[node] = []
+            for group in self._groups[node]:
+                n_group_states = comb(
+                    self._n_subtree_states[group[0]] + len(group) - 1, len(group)
+                )
+                self._n_group_states[node].append(n_group_states)
+                n_states *= n_group_states
+            self._n_subtree_states[node] = n_states
+
+        self.n_states = self._n_subtree_states[0]
+        if self.n_states > np.iinfo(np.int64).max:
+            raise OverflowError("Too many states to rank with 64 bit integers")
+        self._layout = self._subtree_layout(0)
+
+    @classmethod
+    def from_env(cls, env):
+        return cls(env.init, env.tree)
+
+    def _subtree_layout(self, node):
+        """Nodes of the subtree in the order isomorphic subtrees correspond."""
+        layout = [node]
+        for group in self._groups[node]:
+            for child in group:
+                layout.extend(self._subtree_layout(child))
+        return layout
+
+    def _rank_subtree(self, codes, node):
+        """Returns rank of the subtree and its nodes in canonical order."""
+        rank = int(codes[node])
+        order = [node]
+        for group, n_group_states in zip(
+            self._groups[node], self._n_group_states[node]
+        ):
+            children = sorted(
+                (self._rank_subtree(codes, child) for child in group),
+                key=lambda child: child[0],
+            )
+            group_rank = sum(
+                comb(child_rank + idx, idx + 1)
+                for idx, (child_rank, _) in enumerate(children)
+            )
+            rank = rank * n_group_states + group_rank
+            for _, child_order in children:
+                order.extend(child_order)
+        return rank, order
+
+    def _unrank_subtree(self, rank, node, codes):
+        group_ranks = []
+        for n_group_states in reversed(self._n_group_states[node]):
+            rank, group_rank = divmod(rank, n_group_states)
+            group_ranks.append(group_rank)
+        codes[node] = rank
+
+        for group, group_rank in zip(self._groups[node], reversed(group_ranks)):
+            # largest element of the combination first
+            child_ranks = []
+            for idx in reversed(range(1, len(group) + 1)):
+                element = idx - 1
+                while comb(element + 1, idx) <= group_rank:
+                    element += 1
+                group_rank -= comb(element, idx)
+                child_ranks.append(element - (idx - 1))
+            for child, child_rank in zip(group, reversed(child_ranks)):
+                self._unrank_subtree(child_rank, child, codes)
+
+    def canonicalize(self, codes):
+        """
+        Returns the canonical codes of a state, and the permutation mapping
+        actions on the state to actions on the canonical state
+        """
+        codes = np.asarray(codes)
+        _, order = self._rank_subtree(codes, 0)
+        permutation = np.arange(self.num_nodes + 1)
+        permutation[order] = self._layout
+        canonical = np.empty(self.num_nodes, dtype=self.dtype)
+        canonical[permutation[:-1]] = codes
+        return canonical, permutation
+
+    def rank(self, codes):
+        """Rank of the canonical form of codes, for one or an array of states."""
+        codes = np.asarray(codes)
+        if codes.ndim == 1:
+            return self._rank_subtree(codes, 0)[0]
+        return np.array(
+            [self._rank_subtree(row, 0)[0] for row in codes], dtype=np.int64
+        )
+
+    def unrank(self, ranks):
+        """Canonical codes with the given ranks, one row per rank."""
+        ranks = np.asarray(ranks, dtype=np.int64)
+        codes = np.zeros((*ranks.shape, self.num_nodes), dtype=self.dtype)
+        for idx in np.ndindex(ranks.shape):
+            self._unrank_subtree(int(ranks[idx]), 0, codes[idx])
+        return codes
+
+    @property
+    def place_values(self):
+        raise NotImplementedError("Symmetric ranks are not mixed-radix numbers")
+
+
+def _row_keys(codes):
+    """Views each row of codes as a single opaque value, for hashing rows."""
+    codes = np.ascontiguousarray(codes)
+    return codes.view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1])))[
+        :, 0
+    ]
+
+
+def _first_occurrences(codes):
+    """Returns rows of codes without duplicates, in order of first occurrence."""
+    _, indices = np.unique(_row_keys(codes), return_index=True)
+    return codes[np.sort(indices)]
+
+
+def _partition_of(codes, num_partitions):
+    """Deterministic (across runs) partition index for each row of codes."""
+    multipliers = (
+        np.arange(1, codes.shape[1] + 1, dtype=np.uint64) * np.uint64(0x9E3779B1)
+    ) | np.uint64(1)
+    with np.errstate(over="ignore"):
+        hashes = (codes.astype(np.uint64) * multipliers).sum(axis=1)
+        hashes ^= hashes >> np.uint64(29)
+    return (hashes % np.uint64(num_partitions)).astype(np.int64)
+
+
+def deduplicate_codes(chunks, spill_directory=None, num_partitions=64):
+    """
+    Streams chunks of codes (see StateEncoder), dropping repeated states
+    and keeping first occurrences
+    :param chunks: iterable of (chunk size, number of nodes) arrays of codes
+    :param spill_directory: if None, states seen so far are kept in memory,
+                otherwise chunks are partitioned by hash into files in this
+                directory and each partition is deduplicated separately,
+                so that only one partition needs to fit in memory at a time
+    :param num_partitions: number of partitions when spilling to disk
+    :return: generator of arrays of codes without duplicates
+                (when spilling, ordered by partition rather than first occurrence)
+    """
+    if spill_directory is None:
+        seen = set()
+        for codes in chunks:
+            codes = _first_occurrences(np.asarray(codes))
+            keys = _row_keys(codes).tolist()
+            new = np.array([key not in seen for key in keys], dtype=bool)
+            seen.update(keys)
+            if new.any():
+                yield codes[new]
+        return
+
+    spill_directory = Path(spill_directory)
+    spill_directory.mkdir(parents=True, exist_ok=True)
+    partition_files = [
+        spill_directory.joinpath(f"partition_{partition}.codes")
+        for partition in range(num_partitions)
+    ]
+    for partition_file in partition_files:
+        if partition_file.exists():
+            partition_file.unlink()
+
+    dtype, num_nodes = None, None
+    try:
+        for codes in chunks:
+            codes = np.asarray(codes)
+            dtype, num_nodes = codes.dtype, codes.shape[1]
+            partitions = _partition_of(codes, num_partitions)
+            for partition in np.unique(partitions):
+                with open(partition_files[partition], "ab") as partition_file:
+                    codes[partitions == partition].tofile(partition_file)
+
+        for partition_file in partition_files:
+            if not partition_file.exists():
+                continue
+            codes = np.fromfile(partition_file, dtype=dtype).reshape(-1, num_nodes)
+            partition_file.unlink()
+            yield _first_occurrences(codes)
+    finally:
+        for partition_file in partition_files:
+            if partition_file.exists():
+                partition_file.unlink()
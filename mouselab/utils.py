@@ -2,6 +2,7 @@ import heapq
 import itertools as it
 
 import numpy as np
+import pandas as pd
 from IPython.display import clear_output
 from toolz.curried import compose, curry
 
@@ -54,6 +55,78 @@ def softmax(x, temp=1):
     return ex / ex.sum()
 
 
+def _apply_mask(x, mask):
+    x = np.asarray(x, dtype=np.float64)
+    if mask is None:
+        mask = ~np.isnan(x)
+    mask = np.asarray(mask, dtype=bool)
+    # a distribution over no entries is undefined (0 / 0)
+    empty = np.flatnonzero(~mask.any(axis=-1))
+    if len(empty):
+        raise ValueError(f"Every entry of row {empty[0]} is masked")
+    return np.where(mask, x, -np.inf), mask
+
+
+def masked_softmax(x, mask=None, temp=1):
+    """
+    Softmax over the last axis of x, only over the entries where mask is true
+    :param x: array of preferences, e.g. (number of states, number of actions)
+    :param mask: boolean array like x, by default the entries that are not NaN
+    :return: probabilities like x, 0 where mask is false
+    :raises ValueError: if every entry of a row is masked
+    """
+    x, mask = _apply_mask(x, mask)
+    ex = np.exp((x - x.max(axis=-1, keepdims=True)) / temp)
+    return ex / ex.sum(axis=-1, keepdims=True)
+
+
+def masked_argmax(x, mask=None, tolerance=np.finfo(np.float64).eps):
+    """
+    Uniform distribution over the highest entries of the last axis of x
+    :param mask: boolean array like x, by default the entries that are not NaN
+    :param tolerance: entries closer than this to the highest are ties
+    :return: probabilities like x, 0 where mask is false
+    :raises ValueError: if every entry of a row is masked
+    """
+    x, mask = _apply_mask(x, mask)
+    is_max = mask & (x.max(axis=-1, keepdims=True) - x < tolerance)
+    return is_max / is_max.sum(axis=-1, keepdims=True)
+
+
+def paired_differences(scores, baseline, z=1.96):
+    """
+    Differences of paired scores (e.g. of policies on the same episodes)
+    to those of a baseline
+    :param scores: dictionary of equally long arrays of scores, by name
+    :param baseline: name of the scores the others are compared to
+    :param z: z score of the confidence intervals
+    :return: DataFrame indexed by name with the number of pairs, the mean
+                difference, its standard error and confidence interval, and
+                the standard error the difference would have if the scores
+                were not paired (independent episodes)
+    """
+    baseline_scores = np.asarray(scores[baseline], dtype=np.float64)
+    rows = {}
+    for name, name_scores in scores.items():
+        if name == baseline:
+            continue
+        name_scores = np.asarray(name_scores, dtype=np.float64)
+        n = len(name_scores)
+        difference = name_scores - baseline_scores
+        std_error = difference.std(ddof=1) / np.sqrt(n)
+        rows[name] = {
+            "n": n,
+            "mean_difference": difference.mean(),
+            "std_error": std_error,
+            "ci_low": difference.mean() - z * std_error,
+            "ci_high": difference.mean() + z * std_error,
+            "unpaired_std_error": np.sqrt(
+                (name_scores.var(ddof=1) + baseline_scores.var(ddof=1)) / n
+            ),
+        }
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
 class Labeler(object):
     """Assigns unique integer labels."""
 
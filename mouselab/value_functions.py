@@ -1,6 +1,4 @@
 import numpy as np
-from keras.models import Dense, Sequential
-from keras.optimizers import LinearSGD, Nadam
 
 from mouselab.agents import Component
 
@@ -106,6 +104,10 @@ class NeuralQ(ActionValueFunction):
         self.model = self._build_model()
 
     def _build_model(self):
+        from keras.layers import Dense
+        from keras.models import Sequential
+        from keras.optimizers import Nadam
+
         actor = Sequential(
             [
                 Dense(
@@ -134,6 +136,8 @@ class LinearQ(ActionValueFunction):
         self.model = None
 
     def attach(self, agent):
+        from keras.optimizers import LinearSGD
+
         super().attach(agent)
         sx = len(self.features(self.env.reset()))
         sy = self.agent.n_actions
@@ -331,6 +335,8 @@ class LinearV(StateValueFunction):
         self.model = None
 
     def attach(self, agent):
+        from keras.optimizers import LinearSGD
+
         super().attach(agent)
         sx = len(self.features(self.env.reset()))
         sy = 1
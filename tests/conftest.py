@@ -0,0 +1,41 @@
+import pytest
+
+from mouselab.distributions import Categorical
+from mouselab.exact import solve
+from mouselab.exact_utils import construct_pi_table
+from mouselab.mouselab import MouselabEnv
+
+# small enough to solve exactly and enumerate every belief state in a test
+SMALL_BRANCHING = [2, 1]
+SMALL_REWARDS = {0: 0, 1: Categorical([-5, 5]), 2: Categorical([-10, 0, 10])}
+
+
+@pytest.fixture(scope="session")
+def make_small_env():
+    """Builds the small env, with a sampled ground truth, for a given cost."""
+
+    def make(cost=0.5, **kwargs):
+        return MouselabEnv.new_symmetric(
+            SMALL_BRANCHING, SMALL_REWARDS.get, cost=cost, **kwargs
+        )
+
+    return make
+
+
+@pytest.fixture
+def small_env(make_small_env):
+    return make_small_env()
+
+
+@pytest.fixture
+def solved_small_env(small_env):
+    """Small env and its Q, V and pi functions (see exact.solve)."""
+    Q, V, pi, info = solve(small_env)
+    return small_env, Q, V, pi
+
+
+@pytest.fixture
+def small_pi_table(solved_small_env):
+    """Dense pi table of the small env (see construct_pi_table)."""
+    env, Q, V, pi = solved_small_env
+    return construct_pi_table(pi, env)
@@ -0,0 +1,242 @@
+import random
+
+import joblib
+import numpy as np
+import pytest
+
+from mouselab.agents import Agent, Memory, Model, TraceBuffer
+from mouselab.mouselab import MouselabEnv
+from mouselab.policies import RandomPolicy
+
+
+@pytest.fixture
+def envs(make_small_env):
+    template = make_small_env().template
+    np.random.seed(0)
+    yield template.instantiate_many([None] * 15)
+
+
+def _run_many(envs, **kwargs):
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    data = agent.run_many(pbar=False, **kwargs)
+    assert agent.i_episode == len(envs)
+    return data
+
+
+def test_run_many_reproducible(envs):
+    serial = _run_many(envs, seed=1)
+    assert serial["i_episode"] == list(range(len(envs)))
+    assert serial == _run_many(envs, seed=1)
+    # episodes do not all take the same actions
+    assert len({tuple(actions) for actions in serial["actions"]}) > 1
+
+    for n_jobs in [2, 4]:
+        parallel = _run_many(envs, seed=1, n_jobs=n_jobs)
+        assert parallel["actions"] == serial["actions"]
+        assert parallel["return"] == serial["return"]
+        assert parallel["i_episode"] == serial["i_episode"]
+
+    assert _run_many(envs, seed=2)["actions"] != serial["actions"]
+
+
+def test_run_many_leaves_global_rngs(make_small_env):
+    template = make_small_env(sample_term_reward=True).template
+    np.random.seed(0)
+    envs = template.instantiate_many([None] * 15)
+    np.random.seed(3)
+    random.seed(3)
+    expected = np.random.random(), random.random()
+
+    np.random.seed(3)
+    random.seed(3)
+    first = _run_many(envs, seed=1)
+    # episodes draw from generators of their own, seeded by the seed alone
+    assert (np.random.random(), random.random()) == expected
+    assert _run_many(envs, seed=1)["return"] == first["return"]
+
+
+class _CountingPolicy(RandomPolicy):
+    def finish_episode(self, trace):
+        self.num_episodes = getattr(self, "num_episodes", 0) + 1
+
+
+def test_run_many_learning_agent(envs):
+    # updates of shards running on copies of the agent would be lost
+    agent = Agent()
+    agent.register(envs)
+    agent.register(_CountingPolicy())
+    with pytest.raises(ValueError, match="n_jobs=1"):
+        agent.run_many(pbar=False, seed=1, n_jobs=2)
+    with pytest.raises(ValueError, match="n_jobs=1"):
+        agent.run_many(pbar=False, seed=1, parallel=joblib.Parallel(n_jobs=2))
+
+    agent.run_many(pbar=False, seed=1, n_jobs=1)
+    assert agent.policy.num_episodes == len(envs)
+
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    agent.register(Memory(size=100))
+    with pytest.raises(ValueError, match="n_jobs=1"):
+        agent.run_many(pbar=False, seed=1, n_jobs=2)
+
+
+class _CountingParallel(joblib.Parallel):
+    calls = 0
+
+    def __call__(self, iterable):
+        _CountingParallel.calls += 1
+        return super().__call__(iterable)
+
+
+def test_run_many_with_parallel(envs):
+    serial = _run_many(envs, seed=1)
+    # a caller's Parallel (and its backend) runs the shards
+    parallel = _CountingParallel(n_jobs=3, backend="threading")
+    assert _run_many(envs, seed=1, parallel=parallel)["return"] == serial["return"]
+    assert _CountingParallel.calls == 1
+
+
+def test_trace_buffer(envs):
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    data = agent.run_many(pbar=False, seed=1)
+
+    buffer = TraceBuffer.from_env(envs[0], capacity=4)
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    assert agent.run_many(pbar=False, seed=1, trace_buffer=buffer) is buffer
+
+    assert len(buffer) == len(envs)
+    assert buffer.capacity >= buffer.num_steps == sum(map(len, data["actions"]))
+    assert np.array_equal(buffer.returns(), data["return"])
+    for idx in [0, 7, len(envs) - 1]:
+        episode = buffer.episode(idx)
+        assert episode["actions"].tolist() == data["actions"][idx]
+        assert buffer.encoder.decode_many(episode["states"]) == [
+            tuple(state) for state in data["states"][idx][:-1]
+        ]
+
+    df = buffer.to_pandas()
+    assert len(df) == buffer.num_steps
+    assert np.shares_memory(df["reward"].to_numpy(), buffer.rewards)
+    assert df.groupby("episode")["reward"].sum().tolist() == data["return"]
+
+
+def test_trace_buffer_parallel(envs):
+    buffers = []
+    for n_jobs in [None, 3]:
+        agent = Agent()
+        agent.register(envs)
+        agent.register(RandomPolicy())
+        buffers.append(
+            agent.run_many(
+                pbar=False,
+                seed=1,
+                n_jobs=n_jobs,
+                trace_buffer=TraceBuffer.from_env(envs[0]),
+            )
+        )
+    serial, parallel = buffers
+    assert np.array_equal(serial.episode_offsets, parallel.episode_offsets)
+    assert np.array_equal(serial.states, parallel.states)
+    assert np.array_equal(serial.episodes, np.arange(len(envs)).repeat(
+        np.diff(serial.episode_offsets)
+    ))
+
+
+def test_trace_buffer_arrow(envs):
+    pytest.importorskip("pyarrow")
+    buffer = TraceBuffer.from_env(envs[0])
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    agent.run_many(pbar=False, seed=1, trace_buffer=buffer)
+    table = buffer.to_arrow()
+    assert table.num_rows == buffer.num_steps
+    assert table.column("action").to_numpy().tolist() == buffer.actions.tolist()
+
+
+def _trace(rewards, first_state=0):
+    num_steps = len(rewards)
+    return {
+        "states": [[first_state + step] for step in range(num_steps)] + ["final"],
+        "actions": list(range(num_steps)),
+        "rewards": rewards,
+    }
+
+
+def test_memory():
+    memory = Memory(size=6)
+    memory.add(_trace([-1, -1, 5]))
+    assert memory.returns.tolist() == [3, 4, 5]
+    assert memory.dones.tolist() == [False, False, True]
+
+    memory.add(_trace([-2, 4], first_state=10))
+    memory.add(_trace([-1, -1, 3], first_state=20))
+    assert len(memory) == 6
+    # the last episode wraps around, overwriting most of the first one
+    assert memory.states[:, 0].tolist() == [21, 22, 2, 10, 11, 20]
+    assert memory.episode(0)["states"][:, 0].tolist() == [10, 11]
+    assert memory.episode()["returns"].tolist() == [1, 2, 3]
+    assert len(memory.sample_episodes(5)) == 5
+
+    batch = memory.sample(4)
+    assert len(set(batch["states"][:, 0])) == 4
+    for state, reward, ret in zip(
+        batch["states"][:, 0], batch["rewards"], batch["returns"]
+    ):
+        row = memory.states[:, 0].tolist().index(state)
+        assert memory.rewards[row] == reward and memory.returns[row] == ret
+
+
+def test_agent_memory(envs):
+    agent = Agent()
+    agent.register(envs)
+    agent.register(RandomPolicy())
+    memory = Memory(size=20)
+    agent.register(memory)
+    data = agent.run_many(pbar=False, seed=1)
+
+    last_episode = memory.episode()
+    assert last_episode["actions"].tolist() == data["actions"][-1]
+    assert memory.encoder.decode_many(last_episode["states"]) == [
+        tuple(state) for state in data["states"][-1][:-1]
+    ]
+    assert last_episode["returns"][0] == data["return"][-1]
+
+
+def test_agent_memory_normal_priors():
+    # Normal priors can not be encoded, so belief states are stored as objects
+    env = MouselabEnv.new_symmetric_registered("large_increasing")
+    agent = Agent()
+    agent.register(env)
+    agent.register(RandomPolicy(seed=0))
+    memory = Memory(size=100)
+    agent.register(memory)
+    trace = agent.run_episode()
+
+    assert memory.encoder is None
+    assert list(memory.episode()["states"]) == list(trace["states"][:-1])
+    assert memory.sample(3)["states"].shape == (min(3, len(memory)),)
+
+
+def test_model_options(envs):
+    env = envs[0]
+    model = Model(env)
+    state = env.init
+    options = list(model.options(state))
+    assert [a for a, *_ in options] == list(env.actions(state))
+    for a, s1, r, done in options:
+        assert done == (a == env.term_action)
+        if not done:
+            assert s1[a] == env.ground_truth[a]
+            assert r == -0.5
+    # revealed nodes are not options
+    state1 = options[0][1]
+    assert options[0][0] not in [a for a, *_ in model.options(state1)]
+    assert env._state == env.init
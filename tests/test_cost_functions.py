@@ -2,7 +2,15 @@ import itertools
 
 import pytest
 
-from mouselab.cost_functions import distance_graph_cost, linear_depth, side_cost
+from mouselab.cost_functions import (
+    CostContext,
+    backward_search_cost,
+    distance_graph_cost,
+    forward_search_cost,
+    linear_depth,
+    neighbor_search_cost,
+    side_cost,
+)
 from mouselab.distributions import Categorical
 from mouselab.envs.registry import register, registry
 from mouselab.graph_utils import get_structure_properties
@@ -270,3 +278,40 @@ def test_side_cost(experiment_setting, mdp_graph_properties, side_dict):
         constructed_side_costs[node] = env.cost(node)
 
     assert constructed_side_costs == side_dict
+
+
+@pytest.mark.parametrize(
+    "cost_function,clicks,costs",
+    [
+        # nodes upstream of revealed nodes cost more
+        [backward_search_cost(), [], {1: -1, 2: -1, 5: -1}],
+        [backward_search_cost(), [2], {1: -2, 3: -1, 5: -1, 6: -1}],
+        [backward_search_cost(), [3, 7], {1: -1, 2: -2, 6: -2, 9: -1}],
+        # nodes downstream of revealed nodes cost more
+        [forward_search_cost(), [], {1: -1, 2: -1, 5: -1}],
+        [forward_search_cost(include_start=True), [], {1: -2, 2: -1, 5: -2}],
+        [forward_search_cost(), [2], {1: -1, 3: -2, 4: -2, 6: -1}],
+        [neighbor_search_cost(), [1, 6], {2: -2, 3: -1, 7: -2, 8: -2}],
+    ],
+)
+def test_search_cost(cost_function, clicks, costs):
+    env = MouselabEnv.new_symmetric_registered("high_increasing", cost=cost_function)
+    for click in clicks:
+        env.step(click)
+
+    assert {node: env.cost(node) for node in costs} == costs
+    # context and graph implementations agree
+    assert {
+        node: cost_function(node, graph=env.mdp_graph) for node in costs
+    } == costs
+
+
+def test_cost_context_tracks_revealed():
+    env = MouselabEnv.new_symmetric_registered("high_increasing")
+    for click in [2, 12]:
+        env.step(click)
+
+    assert env.cost_context.revealed_nodes() == [0, 2, 12]
+    assert (
+        CostContext.from_graph(env.mdp_graph).revealed == env.cost_context.revealed
+    )
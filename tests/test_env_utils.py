@@ -1,9 +1,43 @@
+import numpy as np
 import pytest
 
-from mouselab.env_utils import get_num_actions
+from mouselab.env_utils import (
+    GroundTruthStates,
+    get_all_possible_states_for_ground_truths,
+    get_num_actions,
+)
 
 
 @pytest.mark.parametrize("branching,result", [[[3, 1, 2], 13]])
 def test_num_actions(branching, result):
     num_actions = get_num_actions(branching)
     assert num_actions == result
+
+
+def test_ground_truth_states(small_env):
+    env = small_env
+    ground_truths = [
+        [0, -5, 0, 5, 10],
+        [0, -5, 0, 5, -10],
+        [0, 5, 10, -5, -10],
+        [0, -5, 0, 5, 10],
+    ]
+
+    states = GroundTruthStates(env, ground_truths)
+    distinct_states = list(states.iter_states(chunk_size=5))
+
+    expected = {
+        tuple(state)
+        for state in get_all_possible_states_for_ground_truths(env, ground_truths)
+    }
+    assert len(distinct_states) == len(set(distinct_states))
+    assert set(distinct_states) == expected
+
+    assert states.num_states == 4 * 2 ** 4
+    assert states.num_distinct_states == len(expected)
+    assert states.num_shared_states == states.num_states - len(expected)
+
+    encoder = states.encoder
+    assert np.array_equal(
+        states.ranks(), np.sort(encoder.rank(encoder.encode_many(distinct_states)))
+    )
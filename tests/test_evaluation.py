@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from mouselab import evaluation
+from mouselab.policies import RandomPolicy, TablePolicy
+from mouselab.policy_artifacts import PolicyTable
+
+
+def test_optimal_policy(solved_small_env, small_pi_table):
+    env, Q, V, pi = solved_small_env
+    with PolicyTable.from_table(small_pi_table) as table:
+        result = evaluation.evaluate_policy_exact(TablePolicy(table), env)
+
+    assert result["util"] == pytest.approx(V(env.init))
+    assert result["util"] == pytest.approx(result["term_reward"] - result["cost"])
+    assert result["cost"] == pytest.approx(0.5 * result["observations"])
+    assert result["observations"] > 0
+
+
+def test_matches_simulation(small_env):
+    env = small_env
+    result = evaluation.evaluate_policy_exact(RandomPolicy(seed=0), env)
+
+    # clicks on the 2 nodes at depth 1 and the 2 nodes at each depth below
+    assert result[["click_rate_depth_1", "click_rate_depth_2"]].sum() * 2 == (
+        pytest.approx(result["observations"])
+    )
+
+    np.random.seed(0)
+    envs = [env.template.instantiate() for _ in range(5000)]
+    simulated = evaluation.evaluate(RandomPolicy(seed=0), envs)
+    standard_error = simulated.std() / np.sqrt(len(simulated))
+    for column in ["util", "observations"]:
+        assert abs(simulated[column].mean() - result[column]) < 4 * standard_error[
+            column
+        ]
+
+
+def test_evaluate_paired(solved_small_env, small_pi_table):
+    env, Q, V, pi = solved_small_env
+    np.random.seed(0)
+    envs = [env.template.instantiate() for _ in range(300)]
+    with PolicyTable.from_table(small_pi_table) as table:
+        results, differences = evaluation.evaluate_paired(
+            {
+                "random": RandomPolicy(),
+                "random_again": RandomPolicy(),
+                "optimal": TablePolicy(table),
+            },
+            envs,
+            seed=1,
+        )
+
+    assert len(results) == 3 * len(envs)
+    # the same policy makes the same choices on every episode
+    assert differences.loc["random_again", "mean_difference"] == 0
+    assert differences.loc["random_again", "std_error"] == 0
+    assert differences.loc["optimal", "mean_difference"] > 0
+    assert (
+        differences.loc["optimal", "std_error"]
+        < differences.loc["optimal", "unpaired_std_error"]
+    )
+
+
+def test_evaluate_sequential(solved_small_env, small_pi_table):
+    env, Q, V, pi = solved_small_env
+    np.random.seed(0)
+    envs = [env.template.instantiate() for _ in range(2000)]
+    with PolicyTable.from_table(small_pi_table) as table:
+        optimal = evaluation.evaluate_sequential(
+            TablePolicy(table), envs, target_std_error=0.3, batch_size=50
+        )
+    assert optimal["stopped"] == "precision"
+    assert optimal["std_error"] <= 0.3
+    assert optimal["n_episodes"] < len(envs)
+    assert optimal["n_episodes"] % 50 == 0
+    assert abs(optimal["util"] - V(env.init)) < 4 * optimal["std_error"]
+
+    # the random policy is clearly worse than the optimal policy
+    worse = evaluation.evaluate_sequential(
+        RandomPolicy(seed=0),
+        envs,
+        target_std_error=0.01,
+        batch_size=50,
+        incumbent=V(env.init),
+    )
+    assert worse["stopped"] == "worse"
+    assert worse["n_episodes"] < len(envs)
+
+    exhausted = evaluation.evaluate_sequential(
+        RandomPolicy(seed=0), envs[:100], target_std_error=0.01, batch_size=50
+    )
+    assert exhausted["stopped"] == "envs"
+    assert exhausted["n_episodes"] == 100
+
+
+def test_bo_policy_batched(small_env, tmp_path, monkeypatch):
+    np.random.seed(0)
+    envs = [small_env.template.instantiate() for _ in range(50)]
+    evaluated = []
+    theta_util = evaluation._theta_util
+
+    def counting_theta_util(theta, envs):
+        evaluated.append(theta)
+        return theta_util(theta, envs)
+
+    # with one job candidates are evaluated in this process
+    monkeypatch.setattr(evaluation, "_theta_util", counting_theta_util)
+    history_file = tmp_path.joinpath("history.jsonl")
+    kwargs = dict(n_points=3, n_jobs=1, history_file=history_file, n_initial_points=3)
+    policy, result = evaluation.bo_policy_batched(
+        envs, n_calls=6, return_result=True, **kwargs
+    )
+    assert len(result.func_vals) == 6
+    assert len(evaluated) <= 6
+    assert -result.fun == pytest.approx(evaluation.get_util(policy, envs))
+
+    # resumes from the history, only evaluating the new candidates
+    evaluated.clear()
+    policy, result = evaluation.bo_policy_batched(
+        envs, n_calls=9, return_result=True, **kwargs
+    )
+    assert len(result.func_vals) == 9
+    assert len(evaluated) <= 3
+    assert len(history_file.read_text().splitlines()) == 9
+
+    # candidates with the same rounded weights are evaluated once, rounding
+    # to tens leaves few distinct candidates
+    evaluated.clear()
+    evaluation.bo_policy_batched(
+        envs, n_calls=6, n_points=3, n_jobs=1, n_initial_points=3, decimals=-1
+    )
+    assert len(evaluated) < 6
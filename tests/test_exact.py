@@ -1,10 +1,27 @@
 import pytest
 
+from mouselab.cost_functions import (
+    backward_search_cost,
+    distance_graph_cost,
+    forward_search_cost,
+)
 from mouselab.distributions import Categorical
-from mouselab.env_utils import get_all_possible_sa_pairs_for_env
+from mouselab.env_utils import (
+    get_all_possible_sa_pairs_for_env,
+    get_all_possible_states_for_env,
+)
 from mouselab.envs.registry import register
-from mouselab.exact_utils import timed_solve_env
-from mouselab.mouselab import MouselabEnv
+from mouselab.exact import solve
+from mouselab.exact_utils import (
+    construct_pi_table,
+    construct_q_table,
+    extract_on_policy_table,
+    lookup_table,
+    on_policy_states,
+    timed_solve_env,
+)
+from mouselab.graph_utils import get_structure_properties
+from mouselab.mouselab import EnvTemplate, MouselabEnv
 
 # set up test cases
 exact_test_case_data = [
@@ -44,3 +61,198 @@ def test_sequence(test_env):
 
     # tests if dictionary keys are same as all possible (state,action) pairs
     assert set(sa_pairs) == set(info["q_dictionary"].keys())
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_pi_table(test_env, symmetric):
+    Q, V, pi, info = timed_solve_env(
+        test_env, verbose=False, save_pi=True, dense=True, symmetric=symmetric
+    )
+
+    for state in get_all_possible_states_for_env(test_env):
+        best_actions, action_values = pi(tuple(state))
+        table_best_actions, table_action_values = lookup_table(
+            info["pi_table"], state
+        )
+        assert set(table_best_actions) == set(best_actions)
+        assert table_action_values == pytest.approx(action_values)
+
+
+def _visited_states(pi, env, ground_truth, state=None):
+    state = env.init if state is None else state
+    visited = {state}
+    for action in pi(state)[0]:
+        if action != env.term_action:
+            next_state = list(state)
+            next_state[action] = ground_truth[action]
+            visited |= _visited_states(pi, env, ground_truth, tuple(next_state))
+    return visited
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_on_policy_table(solved_small_env, symmetric):
+    env, Q, V, pi = solved_small_env
+    ground_truths = [[0, -5, 0, 5, 10], [0, 5, 10, -5, -10], [0, 5, -10, 5, 0]]
+
+    table = extract_on_policy_table(pi, env, ground_truths, symmetric=symmetric)
+
+    visited = set()
+    for ground_truth in ground_truths:
+        visited |= _visited_states(pi, env, ground_truth)
+    for state in visited:
+        best_actions, action_values = pi(state)
+        table_best_actions, table_action_values = lookup_table(table, state)
+        assert set(table_best_actions) == set(best_actions)
+        assert table_action_values == pytest.approx(action_values)
+    encoder = table["encoder"]
+    assert len(table["ranks"]) == len(
+        {int(encoder.rank(encoder.encode(state))) for state in visited}
+    )
+    assert len(table["ranks"]) < encoder.n_states
+
+    # without ground truths, every value a click can reveal is followed
+    any_ground_truth = extract_on_policy_table(pi, env, symmetric=symmetric)
+    assert set(table["ranks"]) <= set(any_ground_truth["ranks"])
+
+
+medium_test_case_properties = get_structure_properties(
+    {
+        "layout": {
+            "0": [0, 0],
+            "1": [0, -1],
+            "2": [1, -1],
+            "3": [-1, -1],
+            "4": [2, -1],
+            "5": [-2, -1],
+        },
+        "initial": "0",
+        "graph": {
+            "0": {"up": [0, "1"]},
+            "1": {"right": [0, "2"], "left": [0, "3"]},
+            "2": {"right": [0, "4"]},
+            "3": {"left": [0, "5"]},
+            "4": {},
+            "5": {},
+        },
+    }
+)
+
+
+def expectimax(template, clicks=(), values=()):
+    """Optimal value found by replaying clicks in fresh envs,
+    so that costs see the true history of the episode"""
+
+    def replay(clicks, values):
+        ground_truth = [0] * len(template.init)
+        for click, value in zip(clicks, values):
+            ground_truth[click] = value
+        env = template.instantiate(ground_truth)
+        reward = 0
+        for click in clicks:
+            _, reward, _, _ = env.step(click)
+        return env, reward
+
+    env, _ = replay(clicks, values)
+    best = env.expected_term_reward(env._state)
+    for action in env.actions(env._state):
+        if action == env.term_action:
+            continue
+        q = 0
+        for value, p in env._state[action]:
+            _, cost = replay((*clicks, action), (*values, value))
+            q += p * (cost + expectimax(template, (*clicks, action), (*values, value)))
+        best = max(best, q)
+    return best
+
+
+@pytest.mark.parametrize(
+    "cost_function",
+    [
+        distance_graph_cost(given_cost=1, distance_multiplier=5),
+        backward_search_cost(added_cost=-0.9),
+        forward_search_cost(added_cost=-0.9),
+    ],
+)
+def test_history_dependent_cost(cost_function):
+    register(**exact_test_case_data[1]["env"])
+    template = EnvTemplate.new_symmetric_registered(
+        "medium_test_case",
+        cost=cost_function,
+        mdp_graph_properties=medium_test_case_properties,
+    )
+    env = template.instantiate()
+    # mutate history of the env, which the solver should not read
+    env.step(5)
+
+    Q, V, pi, info = solve(env)
+    assert V(template.init) == pytest.approx(expectimax(template))
+
+
+def _medium_env(cost_function):
+    register(**exact_test_case_data[1]["env"])
+    return MouselabEnv.new_symmetric_registered(
+        "medium_test_case",
+        cost=cost_function,
+        mdp_graph_properties=medium_test_case_properties,
+    )
+
+
+def test_tables_reject_last_action_costs():
+    env = _medium_env(distance_graph_cost(given_cost=1, distance_multiplier=5))
+    Q, V, pi, info = solve(env)
+    # rows are indexed by belief state only, so they can not hold pi for every
+    # last action
+    with pytest.raises(ValueError):
+        construct_pi_table(pi, env)
+    with pytest.raises(ValueError):
+        construct_q_table(Q, env)
+    with pytest.raises(ValueError):
+        extract_on_policy_table(pi, env)
+
+
+def test_on_policy_states_last_action():
+    env = _medium_env(distance_graph_cost(given_cost=1, distance_multiplier=5))
+    Q, V, pi, info = solve(env)
+
+    def visited_states(state, last_action):
+        visited = {state}
+        for action in pi(state, last_action=last_action)[0]:
+            if action != env.term_action:
+                for value, _ in state[action]:
+                    next_state = state[:action] + (value,) + state[action + 1:]
+                    visited |= visited_states(next_state, action)
+        return visited
+
+    assert on_policy_states(pi, env) == visited_states(env.init, None)
+
+
+def lopsided_cost(node, last_action=None, graph=None, context=None):
+    # clicking the right subtree of medium_test_case is cheaper
+    return -1 if node in (2, 3) else -2
+
+
+lopsided_cost.history = ()
+
+
+@pytest.mark.parametrize(
+    "cost_function,invariant",
+    [
+        [lopsided_cost, False],
+        [backward_search_cost(added_cost=-0.9), True],
+        [forward_search_cost(added_cost=-0.9), True],
+    ],
+)
+def test_symmetric_table_costs(cost_function, invariant):
+    env = _medium_env(cost_function)
+    Q, V, pi, info = solve(env)
+    if not invariant:
+        with pytest.raises(ValueError):
+            construct_pi_table(pi, env, symmetric=True)
+        return
+
+    table = construct_pi_table(pi, env, symmetric=True)
+    for state in get_all_possible_states_for_env(env):
+        best_actions, action_values = pi(tuple(state))
+        table_best_actions, table_action_values = lookup_table(table, state)
+        assert set(table_best_actions) == set(best_actions)
+        assert table_action_values == pytest.approx(action_values)
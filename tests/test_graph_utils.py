@@ -2,7 +2,13 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import pytest
 
-from mouselab.graph_utils import adjacency_list_from_graph, graph_from_adjacency_list
+from mouselab.graph_utils import (
+    adjacency_list_from_graph,
+    annotate_mdp_graph,
+    graph_from_adjacency_list,
+    graph_from_node_attributes,
+    node_attributes_from_adjacency_list,
+)
 
 PLOT = False
 
@@ -39,3 +45,32 @@ def test_adjacency_functions(name, adjacency_list):
 
     # tests if dictionary keys are same as all possible (state,action) pairs
     assert adjacency_list_from_graph(env) == adjacency_list
+
+
+@pytest.mark.parametrize("name,adjacency_list", graph_utils_test_cases)
+def test_node_attributes_match_annotated_graph(name, adjacency_list):
+    annotated_graph = annotate_mdp_graph(graph_from_adjacency_list(adjacency_list))
+    node_attributes = node_attributes_from_adjacency_list(adjacency_list)
+
+    compiled_graph = graph_from_node_attributes(adjacency_list, node_attributes)
+
+    assert dict(compiled_graph.nodes(data=True)) == dict(
+        annotated_graph.nodes(data=True)
+    )
+
+
+@pytest.mark.parametrize("name,adjacency_list", graph_utils_test_cases)
+def test_node_attributes_keep_given_depth(name, adjacency_list):
+    # e.g. a depth counted in clicks rather than steps from the initial node
+    depth = {node: 2 * node for node in range(len(adjacency_list))}
+    properties = {"depth": depth}
+    annotated_graph = annotate_mdp_graph(
+        graph_from_adjacency_list(adjacency_list), dict(properties)
+    )
+    node_attributes = node_attributes_from_adjacency_list(adjacency_list, properties)
+
+    assert node_attributes["depth"].tolist() == list(depth.values())
+    compiled_graph = graph_from_node_attributes(adjacency_list, node_attributes)
+    assert dict(compiled_graph.nodes(data=True)) == dict(
+        annotated_graph.nodes(data=True)
+    )
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mouselab.agents import Agent
+from mouselab.likelihood import ChoiceData
+from mouselab.mouselab_policy import FEATURES, MouselabPolicy
+
+WEIGHTS = {"is_term": -1.0, "term_reward": 0.5, "voi_myopic": 1.0, "depth": -0.5}
+
+
+@pytest.fixture(scope="module")
+def choices(make_small_env):
+    np.random.seed(0)
+    template = make_small_env().template
+    envs = [template.instantiate() for _ in range(30)]
+
+    agent = Agent()
+    policy = MouselabPolicy(WEIGHTS, temp=1, seed=0)
+    rows = []
+    for env in envs:
+        agent.register(env)
+        agent.register(policy)
+        trace = agent.run_episode()
+        for state, action in zip(trace["states"], trace["actions"]):
+            rows.append({"env": env, "state": state, "action": action})
+    yield pd.DataFrame(rows)
+
+
+def test_log_likelihood(choices):
+    data = ChoiceData.from_unrolled(choices)
+    # every episode starts in the same state
+    assert data.num_states < len(choices)
+    assert data.num_choices == len(choices)
+
+    policy = MouselabPolicy(WEIGHTS, temp=1)
+    agent = Agent()
+    expected = 0
+    for _, row in choices.iterrows():
+        agent.register(row.env)
+        agent.register(policy)
+        expected += np.log(policy.action_distribution(row.state)[row.action])
+    assert data.log_likelihood(policy.theta[: len(FEATURES)]) == pytest.approx(
+        expected
+    )
+
+
+def test_gradient(choices):
+    data = ChoiceData.from_unrolled(choices)
+    theta = np.random.default_rng(0).normal(size=len(FEATURES))
+    gradient = data.gradient(theta, temp=2)
+    for i in range(len(theta)):
+        step = np.zeros(len(theta))
+        step[i] = 1e-6
+        numerical = (
+            data.log_likelihood(theta + step, temp=2)
+            - data.log_likelihood(theta - step, temp=2)
+        ) / 2e-6
+        assert gradient[i] == pytest.approx(numerical, rel=1e-4, abs=1e-6)
+
+
+def test_fit(choices):
+    data = ChoiceData.from_unrolled(choices)
+    theta, result = data.fit(fixed={"vpi_full": 0})
+    assert result.success
+    assert theta[FEATURES.index("vpi_full")] == 0
+    assert np.allclose(data.gradient(theta)[FEATURES.index("voi_myopic")], 0, atol=1e-3)
+    assert data.log_likelihood(theta) >= data.log_likelihood(
+        MouselabPolicy(WEIGHTS).theta[: len(FEATURES)]
+    )
+
+
+def test_env_dependent_features(make_small_env):
+    # same tree and belief state, but a feature that depends on the cost
+    envs = [make_small_env(cost=cost) for cost in (0.5, 2)]
+    states = [env.init for env in envs]
+
+    def cost_features(env, state, action):
+        return np.array([env.cost(action) if action != env.term_action else 0.0])
+
+    data = ChoiceData.from_choices(
+        envs, states, [1, 1], feature_function=cost_features, feature_names=["cost"]
+    )
+    assert data.num_states == 2
+    assert data.features[:, 1, 0].tolist() == [-0.5, -2]
+
+    # mouselab features do not depend on the cost, so the choices share a row
+    assert ChoiceData.from_choices(envs, states, [1, 1]).num_states == 1
@@ -1,7 +1,11 @@
+import gc
+import weakref
+
 import pytest
 
+from mouselab.cost_functions import backward_search_cost
 from mouselab.graph_utils import get_structure_properties
-from mouselab.mouselab import MouselabEnv
+from mouselab.mouselab import EnvTemplate, MouselabEnv, expected_term_reward
 
 structure = {
     "layout": {
@@ -94,3 +98,79 @@ def test_depth_calculation(branching, true_depths, mdp_graph_properties):
     )
     depth_dict = {node: data["depth"] for node, data in env.mdp_graph.nodes(data=True)}
     assert depth_dict == true_depths
+
+
+def test_mdp_graph_built_lazily():
+    env = MouselabEnv.new_symmetric_registered(
+        "high_increasing", mdp_graph_properties=get_structure_properties(structure)
+    )
+    env.step(5)
+    assert env._mdp_graph is None
+
+    # revealed property is synced both when building the graph and afterwards
+    env.step(3)
+    graph = env.mdp_graph
+    revealed = [node for node, info in graph.nodes(data=True) if info["revealed"]]
+    assert revealed == [0, 3, 5]
+    env.step(12)
+    assert env.mdp_graph.nodes[12]["revealed"]
+    assert env.mdp_graph.nodes[1]["cluster"] == "up"
+    assert env.mdp_graph.nodes[8]["layout"] == [2, 1]
+
+
+def test_template_instantiate():
+    template = EnvTemplate.new_symmetric_registered("high_increasing", cost=1)
+    ground_truths = [[0, *[4 * (-1) ** i for i in range(12)]], [0] * 13]
+    envs = template.instantiate_many(ground_truths)
+
+    for env, ground_truth in zip(envs, ground_truths):
+        full_env = MouselabEnv.new_symmetric_registered(
+            "high_increasing", ground_truth=ground_truth, cost=1
+        )
+        assert hash(env) == hash(full_env)
+        assert env.subtree == full_env.subtree
+        assert env.path_to(12) == full_env.path_to(12)
+        for action in [1, 3, 6, env.term_action]:
+            assert env.step(action) == full_env.step(action)
+
+    # clicks in one env do not leak into envs sharing the template
+    assert envs[0].cost_context.revealed_nodes() == [0, 1, 3, 6]
+    assert template.instantiate().cost_context.revealed_nodes() == [0]
+
+
+def test_term_reward_cache_shared_across_envs():
+    env = MouselabEnv.new_symmetric_registered("high_increasing")
+    other_env = MouselabEnv.new_symmetric_registered("high_increasing")
+    assert env.structure is other_env.structure
+
+    state = env.step(2)[0]
+    env.expected_term_reward(state)
+    hits = expected_term_reward.cache_info().hits
+    other_env.expected_term_reward(state)
+    assert expected_term_reward.cache_info().hits == hits + 1
+
+    # caches do not keep envs alive
+    env_ref = weakref.ref(env)
+    del env
+    gc.collect()
+    assert env_ref() is None
+
+
+@pytest.mark.parametrize("cost", [1, backward_search_cost()])
+def test_successor(cost):
+    env = MouselabEnv.new_symmetric_registered("high_increasing", cost=cost)
+    stepped_env = MouselabEnv.new_symmetric_registered(
+        "high_increasing", cost=cost, ground_truth=env.ground_truth
+    )
+
+    state, last_action = env.init, None
+    for action in [2, 3, 7, env.term_action]:
+        state1, reward, done = env.successor(state, action, last_action)
+        assert (state1, reward, done, {}) == stepped_env.step(action)
+        state, last_action = state1, action
+
+    # env is not changed
+    assert env._state == env.init
+    assert env.cost_context.revealed_nodes() == [0]
+    with pytest.raises(ValueError):
+        env.successor(stepped_env.init, 0)
@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+
+from mouselab.agents import Agent
+from mouselab.mouselab_policy import MouselabPolicy
+from mouselab.policies import (
+    ActorCritic,
+    GeneralizedAdvantageEstimation,
+    OptimalQ,
+    SoftmaxPolicy,
+)
+
+
+@pytest.fixture
+def env(small_env):
+    yield small_env
+
+
+def preference(state, action):
+    # ties between the first two nodes, terminating is preferred once 2 are known
+    revealed = sum(not hasattr(value, "sample") for value in state[1:])
+    if action == len(state):
+        return 1.0 if revealed >= 2 else 0.0
+    return 0.5 if action in (1, 2) else float(action) / 10
+
+
+def attach(policy, env):
+    agent = Agent()
+    agent.register(env)
+    agent.register(policy)
+    return policy
+
+
+@pytest.mark.parametrize("temp", [1e-9, 1.0])
+def test_softmax_policy(env, temp):
+    policy = attach(SoftmaxPolicy(preference, temp=temp), env)
+    state = env.init
+
+    probabilities = policy.action_distribution(state)
+    possible_actions = list(env.actions(state))
+    q = np.array([preference(state, action) for action in possible_actions])
+    expected = np.zeros(env.action_space.n)
+    expected[possible_actions] = np.exp((q - q.max()) / temp) / np.exp(
+        (q - q.max()) / temp
+    ).sum()
+    assert np.allclose(probabilities, expected)
+    # the root can not be clicked
+    assert probabilities[0] == 0
+
+    q_values, actions = policy.preferences(state)
+    assert list(actions) == possible_actions
+    assert np.allclose(q_values, q)
+
+
+def test_optimal_q(env):
+    policy = attach(OptimalQ(preference, seed=0), env)
+
+    probabilities = policy.action_distribution(env.init)
+    assert np.allclose(probabilities[[1, 2]], 0.5)
+    assert probabilities.sum() == pytest.approx(1)
+    assert policy.act(env.init) in (1, 2)
+
+    state = list(env.init)
+    state[1], state[2] = 5, 0
+    state = tuple(state)
+    probabilities = policy.action_distribution(state)
+    assert probabilities[env.term_action] == 1
+    assert policy.act(state) == env.term_action
+
+
+@pytest.mark.parametrize("policy_class", [SoftmaxPolicy, OptimalQ])
+def test_action_distributions(env, policy_class):
+    policy = attach(policy_class(preference), env)
+    states = [env.init]
+    for action in (1, 3):
+        state = list(states[-1])
+        state[action] = 5
+        states.append(tuple(state))
+
+    distributions = policy.action_distributions(states)
+    assert distributions.shape == (len(states), env.action_space.n)
+    for state, distribution in zip(states, distributions):
+        assert np.allclose(distribution, policy.action_distribution(state))
+        revealed = [not hasattr(value, "sample") for value in state]
+        assert np.all(distribution[:-1][revealed] == 0)
+
+
+@pytest.mark.parametrize(
+    "weights",
+    [
+        {"voi_myopic": 1, "vpi_action": 0.5, "vpi_full": 0.3, "quality_ev": 0.2},
+        {"is_term": -1, "quality_std": 0.1, "depth": -0.4},
+    ],
+)
+def test_mouselab_policy_preferences_all(env, weights):
+    policy = attach(MouselabPolicy(weights), env)
+    state = list(env.init)
+    states = [env.init]
+    for action in (1, 3, 2, 4):
+        state[action] = env.ground_truth[action]
+        states.append(tuple(state))
+
+    for state in states:
+        preferences = policy.preferences_all(state)
+        possible = list(env.actions(state))
+        assert np.flatnonzero(~np.isnan(preferences)).tolist() == possible
+        for action in possible:
+            assert preferences[action] == pytest.approx(
+                policy.preference(state, action)
+            )
+
+
+class _FakeModel(object):
+    """Stands in for a keras model, predicting 0 and recording fit calls."""
+
+    def __init__(self):
+        self.fits = []
+
+    def predict(self, x):
+        return np.zeros((len(x), 1))
+
+    def fit(self, x, y, **kwargs):
+        self.fits.append((x, y))
+
+
+class _FakeActorCritic(ActorCritic):
+    def build_actor(self):
+        return _FakeModel()
+
+
+class _FakeGAE(GeneralizedAdvantageEstimation):
+    def build_actor(self):
+        return _FakeModel()
+
+    def build_critic(self):
+        return _FakeModel()
+
+
+def _feature_trace(num_steps, n_action, first=0):
+    return {
+        "states": [np.full(3, first + step, float) for step in range(num_steps + 1)],
+        "actions": [step % n_action for step in range(num_steps)],
+        "rewards": [-1.0] * (num_steps - 1) + [10.0],
+    }
+
+
+@pytest.mark.parametrize("policy_class", [_FakeActorCritic, _FakeGAE])
+def test_actor_critic_trains_on_whole_episodes(env, policy_class):
+    kwargs = {"critic": _FakeModel()} if policy_class is _FakeActorCritic else {}
+    policy = attach(policy_class(**kwargs), env)
+    batches = []
+    policy.train_batch = batches.append
+    np.random.seed(0)
+
+    for idx in range(policy.batch_size + 3):
+        policy.finish_episode(_feature_trace(2 + idx % 3, policy.n_action, 10 * idx))
+        # batches of sampled episodes are only trained on once there are more
+        # episodes than the batch size
+        num_batches = max(idx + 1 - policy.batch_size, 0)
+        assert len(batches) == num_batches
+    # GAE trains on each episode alone until then, ActorCritic does not train
+    assert len(policy.actor.fits) == (
+        policy.batch_size if policy_class is _FakeGAE else 0
+    )
+
+    for batch in batches:
+        assert len(batch) == policy.batch_size + 1
+        for episode in batch:
+            # every sampled episode is one whole episode, in order
+            first = episode["states"][0, 0]
+            assert first % 10 == 0
+            assert episode["states"][:, 0].tolist() == [
+                first + step for step in range(len(episode["actions"]))
+            ]
+            assert episode["rewards"][-1] == 10
+
+
+@pytest.mark.parametrize("policy_class", [_FakeActorCritic, _FakeGAE])
+def test_actor_critic_advantages_within_episodes(env, policy_class):
+    kwargs = {"critic": _FakeModel()} if policy_class is _FakeActorCritic else {}
+    policy = attach(policy_class(**kwargs), env)
+    memory = policy._memory
+    memory.add(_feature_trace(3, policy.n_action))
+    memory.add(_feature_trace(2, policy.n_action, 10))
+    episodes = [memory.episode(0), memory.episode(1)]
+
+    policy.train_batch(episodes)
+    for episode in episodes:
+        policy.train_batch([episode])
+    (_, together), (_, first), (_, second) = policy.actor.fits
+    # the advantages of an episode do not depend on the episodes after it
+    assert np.allclose(together, np.concatenate([first, second]))
@@ -0,0 +1,179 @@
+import gc
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from mouselab.env_utils import get_all_possible_states_for_env
+from mouselab.exact_utils import (
+    construct_pi_table,
+    iter_q_table,
+    lookup_table,
+    table_encoder,
+    timed_solve_env,
+)
+from mouselab.policy_artifacts import (
+    PolicyTable,
+    PolicyArtifactWriter,
+    load_policy_artifact,
+    save_policy_artifact,
+    write_pi_artifact,
+)
+
+
+@pytest.fixture
+def solved_env(solved_small_env):
+    env, Q, V, pi = solved_small_env
+    yield env, Q, pi
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_policy_artifact_round_trip(solved_env, symmetric, tmp_path):
+    env, Q, pi = solved_env
+    _, _, _, info = timed_solve_env(
+        env, verbose=False, save_pi=True, dense=True, symmetric=symmetric
+    )
+    save_policy_artifact(tmp_path, info["pi_table"], env, metadata={"setting": "test"})
+
+    artifact = load_policy_artifact(tmp_path)
+    assert isinstance(artifact.q_values, np.memmap)
+    assert artifact.metadata == {"setting": "test"}
+    assert len(artifact) == info["pi_table"]["encoder"].n_states
+
+    for state in get_all_possible_states_for_env(env):
+        best_actions, action_values = pi(tuple(state))
+        assert set(artifact[state]["max_actions"]) == set(best_actions)
+        assert artifact[state]["q_values"] == pytest.approx(action_values)
+
+    # iterating yields the states stored, in the order of the rows
+    for state, codes in zip(artifact, artifact.codes):
+        assert np.array_equal(artifact.encoder.encode(state), codes)
+
+
+def test_partial_policy_artifact(solved_env, tmp_path):
+    env, Q, pi = solved_env
+    _, _, _, info = timed_solve_env(env, verbose=False, save_q=True, dense=True)
+    table = info["q_table"]
+    ranks = np.arange(0, table["encoder"].n_states, 3)
+    partial_table = {
+        "encoder": table["encoder"],
+        "ranks": ranks,
+        "q_values": table["q_values"][ranks],
+    }
+    save_policy_artifact(tmp_path, partial_table, env)
+
+    artifact = load_policy_artifact(tmp_path)
+    assert len(artifact) == len(ranks)
+    for state in artifact:
+        assert state in artifact
+        assert artifact[state] == {"q_values": lookup_table(table, state)[1]}
+
+    missing_state = table["encoder"].decode(table["encoder"].unrank(1))
+    assert missing_state not in artifact
+    with pytest.raises(KeyError):
+        artifact[missing_state]
+
+
+def test_newer_format_version(solved_env, tmp_path):
+    env, Q, pi = solved_env
+    _, _, _, info = timed_solve_env(env, verbose=False, save_q=True, dense=True)
+    save_policy_artifact(tmp_path, info["q_table"], env)
+
+    header_file = tmp_path.joinpath("header.json")
+    header = json.loads(header_file.read_text())
+    header["format_version"] += 1
+    header_file.write_text(json.dumps(header))
+
+    with pytest.raises(ValueError):
+        load_policy_artifact(tmp_path)
+
+
+def test_write_pi_artifact(solved_env, tmp_path):
+    env, Q, pi = solved_env
+    table = construct_pi_table(pi, env)
+    write_pi_artifact(tmp_path, pi, env, chunk_size=5)
+
+    artifact = load_policy_artifact(tmp_path)
+    assert artifact.complete
+    assert np.array_equal(artifact.q_values, table["q_values"], equal_nan=True)
+    assert np.array_equal(artifact.max_actions, table["max_actions"])
+
+
+def test_artifact_readable_while_written(solved_env, tmp_path):
+    env, Q, pi = solved_env
+    encoder = table_encoder(env)
+    chunks = iter_q_table(Q, env, encoder, ranks=[1, 4, 6, 7], chunk_size=2)
+
+    with PolicyArtifactWriter(tmp_path, env, encoder, kind="q", partial=True) as writer:
+        writer.append(next(chunks))
+
+        artifact = load_policy_artifact(tmp_path)
+        assert not artifact.complete
+        assert artifact.ranks.tolist() == [1, 4]
+        assert len(artifact.q_values) == 2
+
+        # ranks must increase across chunks
+        with pytest.raises(ValueError):
+            writer.append(next(iter_q_table(Q, env, encoder, ranks=[2])))
+
+        writer.append(next(chunks))
+
+    artifact = load_policy_artifact(tmp_path)
+    assert artifact.complete
+    assert artifact.ranks.tolist() == [1, 4, 6, 7]
+
+
+def _best_actions_in_worker(policy_table, states):
+    return [policy_table.best_actions(state) for state in states]
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_policy_table(solved_env, symmetric):
+    env, Q, pi = solved_env
+    states = [tuple(state) for state in get_all_possible_states_for_env(env)]
+
+    with PolicyTable.from_table(construct_pi_table(pi, env, symmetric)) as table:
+        assert isinstance(table.max_actions, np.memmap)
+        for state in states:
+            best_actions, action_values = pi(state)
+            assert table.best_actions(state) == sorted(best_actions)
+            q_row = table.q_row(state)
+            assert q_row[list(action_values)] == pytest.approx(
+                list(action_values.values())
+            )
+
+        # workers attach to the table's files instead of copying the arrays
+        attached = pickle.loads(pickle.dumps(table))
+        assert attached.directory == table.directory
+        assert not attached.owner
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            worker_best_actions = executor.submit(
+                _best_actions_in_worker, table, states
+            ).result()
+        assert worker_best_actions == [table.best_actions(state) for state in states]
+
+        if not symmetric:
+            encoder = table.encoder
+            codes = encoder.encode_many(states)
+            assert np.array_equal(table.rows_for_codes(codes), encoder.rank(codes))
+
+    assert not table.directory.exists()
+
+
+def test_policy_table_deleted_without_close(solved_env):
+    env, Q, pi = solved_env
+    table = PolicyTable.from_table(construct_pi_table(pi, env))
+    directory = table.directory
+
+    # copies attached to the files do not delete them
+    attached = pickle.loads(pickle.dumps(table))
+    del attached
+    gc.collect()
+    assert directory.exists()
+
+    del table
+    gc.collect()
+    assert not directory.exists()
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from mouselab.exact import solve
+from mouselab.exact_utils import construct_pi_table, lookup_table
+from mouselab.policy_diff import RELATIONS, classify_best_actions, diff_policy_tables
+
+
+@pytest.mark.parametrize(
+    "actions_1,actions_2,relation",
+    [
+        [{1, 2}, {1, 2}, "equal"],
+        [{1, 2}, {2}, "subset"],
+        [{2}, {1, 2}, "superset"],
+        [{1, 2}, {2, 3}, "intersecting"],
+        [{1}, {2, 3}, "disjoint"],
+    ],
+)
+def test_classify_best_actions(actions_1, actions_2, relation):
+    mask_1, mask_2 = [
+        sum(1 << action for action in actions) for actions in (actions_1, actions_2)
+    ]
+    assert RELATIONS[classify_best_actions([mask_1], [mask_2])[0]] == relation
+
+
+def _python_relation(actions_1, actions_2):
+    actions_1, actions_2 = set(actions_1), set(actions_2)
+    if actions_1 == actions_2:
+        return "equal"
+    elif actions_2 < actions_1:
+        return "subset"
+    elif actions_1 < actions_2:
+        return "superset"
+    elif actions_1 & actions_2:
+        return "intersecting"
+    return "disjoint"
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_diff_policy_tables(make_small_env, symmetric):
+    tables = []
+    for cost in [0.5, 3]:
+        env = make_small_env(cost=cost)
+        Q, V, pi, info = solve(env)
+        tables.append(construct_pi_table(pi, env, symmetric=symmetric))
+
+    diff = diff_policy_tables(*tables, env.tree, chunk_size=7)
+
+    encoder = tables[0]["encoder"]
+    expected_counts = dict.fromkeys(RELATIONS, 0)
+    expected_value_delta = 0
+    for rank in range(encoder.n_states):
+        state = encoder.decode(encoder.unrank(rank))
+        (actions_1, q_values_1), (actions_2, q_values_2) = [
+            lookup_table(table, state) for table in tables
+        ]
+        relation = _python_relation(actions_1, actions_2)
+        expected_counts[relation] += 1
+        if relation != "equal":
+            assert rank in diff["ranks"][relation]
+        expected_value_delta += max(q_values_2.values()) - max(q_values_1.values())
+
+    assert diff["counts"].to_dict() == expected_counts
+    assert diff["counts"]["equal"] < encoder.n_states
+    for group in ["by_num_revealed", "by_depth"]:
+        summary = diff[group]
+        assert summary["states"].sum() == encoder.n_states
+        assert (summary["mean_value_delta"] * summary["states"]).sum() == pytest.approx(
+            expected_value_delta
+        )
+    assert diff["by_num_revealed"]["max_abs_q_delta"].max() == pytest.approx(
+        np.nanmax(np.abs(tables[1]["q_values"] - tables[0]["q_values"]))
+    )
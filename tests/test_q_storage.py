@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from mouselab.policy_artifacts import (
+    load_policy_artifact,
+    quantize_policy_artifact,
+    save_policy_artifact,
+)
+from mouselab.q_storage import ENCODINGS, QuantizedQValues
+
+
+@pytest.fixture
+def solved_table(solved_small_env, small_pi_table):
+    env, Q, V, pi = solved_small_env
+    yield env, pi, small_pi_table
+
+
+@pytest.mark.parametrize("delta_from_max", [False, True])
+@pytest.mark.parametrize("encoding", list(ENCODINGS))
+def test_quantize(solved_table, encoding, delta_from_max):
+    env, pi, table = solved_table
+    q_values = table["q_values"]
+    quantized = QuantizedQValues.quantize(
+        q_values,
+        encoding=encoding,
+        delta_from_max=delta_from_max,
+        max_actions=table["max_actions"],
+        chunk_size=10,
+    )
+
+    restored = quantized.to_float()
+    assert np.array_equal(np.isnan(restored), np.isnan(q_values))
+    assert quantized.max_abs_error == pytest.approx(
+        np.nanmax(np.abs(restored - q_values)), abs=1e-12
+    )
+    if encoding == "float64":
+        assert quantized.max_abs_error == 0
+    if delta_from_max:
+        # ties with the best action stay exact
+        assert quantized.argmax_changes == 0
+
+
+def test_argmax_changes_reported():
+    quantized = QuantizedQValues.quantize([[1000.0, 1000.1]], encoding="float16")
+    assert quantized.argmax_changes == 1
+
+    quantized = QuantizedQValues.quantize(
+        [[1000.0, 1000.1]], encoding="float16", delta_from_max=True
+    )
+    assert quantized.argmax_changes == 0
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd", "lz4"])
+def test_compress(solved_table, codec, tmp_path):
+    if codec != "zlib":
+        pytest.importorskip({"zstd": "zstandard", "lz4": "lz4"}[codec])
+    env, pi, table = solved_table
+    quantized = QuantizedQValues.quantize(
+        table["q_values"], encoding="fixed16", delta_from_max=True
+    )
+    compressed = quantized.compress(codec, block_rows=50)
+    assert compressed.nbytes < quantized.nbytes
+
+    compressed.save(tmp_path)
+    loaded = QuantizedQValues.load(tmp_path)
+    rows = np.array([0, 3, 120, 51, 49, len(table["q_values"]) - 1])
+    assert np.array_equal(loaded[rows], quantized[rows], equal_nan=True)
+    assert np.array_equal(loaded[120], quantized[120], equal_nan=True)
+    assert np.array_equal(loaded.to_float(), quantized.to_float(), equal_nan=True)
+
+
+def test_quantize_policy_artifact(solved_table, tmp_path):
+    env, pi, table = solved_table
+    save_policy_artifact(tmp_path, table, env)
+    quantized = quantize_policy_artifact(
+        tmp_path, encoding="float16", delta_from_max=True, codec="zlib"
+    )
+    assert not tmp_path.joinpath("q_values.npy").exists()
+
+    artifact = load_policy_artifact(tmp_path)
+    assert artifact.header["q_storage"]["max_abs_error"] == quantized.max_abs_error
+    for rank in range(0, table["encoder"].n_states, 7):
+        state = table["encoder"].decode(table["encoder"].unrank(rank))
+        best_actions, action_values = pi(state)
+        assert set(artifact[state]["max_actions"]) == set(best_actions)
+        assert artifact[state]["q_values"] == pytest.approx(
+            action_values, abs=quantized.max_abs_error
+        )
+
+    with pytest.raises(ValueError):
+        quantize_policy_artifact(tmp_path)
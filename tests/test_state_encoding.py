@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+
+from mouselab.distributions import Categorical
+from mouselab.env_utils import (
+    deduplicate_states,
+    deduplicate_states_gen,
+    get_all_possible_ground_truths,
+    get_all_possible_states_for_env,
+    get_all_possible_states_for_ground_truths,
+)
+from mouselab.mouselab import MouselabEnv
+from mouselab.state_encoding import (
+    StateEncoder,
+    SymmetricStateEncoder,
+    deduplicate_codes,
+)
+
+encoding_test_cases = [
+    [[1, 2], {0: 0, 1: Categorical([-500]), 2: Categorical([-60, 60])}],
+    [[2, 1], {0: 0, 1: Categorical([-10, 0, 10]), 2: Categorical([-5, 5])}],
+]
+
+
+@pytest.fixture(params=encoding_test_cases)
+def categorical_env(request):
+    branching, rewards = request.param
+    yield MouselabEnv.new_symmetric(branching, rewards.get)
+
+
+def test_round_trip(categorical_env):
+    encoder = StateEncoder.from_env(categorical_env)
+    ranks = np.arange(encoder.n_states)
+    codes = encoder.unrank(ranks)
+
+    assert np.array_equal(encoder.rank(codes), ranks)
+    for code in codes:
+        state = encoder.decode(code)
+        assert np.array_equal(encoder.encode(state), code)
+
+
+def test_states_match_deduplicated_states(categorical_env):
+    states = get_all_possible_states_for_env(categorical_env)
+    states = [tuple(state) for state in states]
+    assert len(states) == len(set(states))
+
+    old_states = deduplicate_states(
+        get_all_possible_states_for_ground_truths(
+            categorical_env, get_all_possible_ground_truths(categorical_env)
+        ),
+        verbose=False,
+    )
+    assert set(states) == {tuple(state) for state in old_states}
+
+
+def test_chunked_enumeration(categorical_env):
+    encoder = StateEncoder.from_env(categorical_env)
+    chunks = list(encoder.iter_codes(chunk_size=4))
+
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    assert np.array_equal(
+        np.vstack(chunks), encoder.unrank(np.arange(encoder.n_states))
+    )
+
+
+def test_symmetric_ranking():
+    env = MouselabEnv.new_symmetric(
+        [2, 1, 2],
+        {
+            0: 0,
+            1: Categorical([-1, 1]),
+            2: Categorical([-2, 2]),
+            3: Categorical([-3, 0, 3]),
+        }.get,
+    )
+    encoder = StateEncoder.from_env(env)
+    symmetric_encoder = SymmetricStateEncoder.from_env(env)
+
+    canonical_codes = symmetric_encoder.unrank(np.arange(symmetric_encoder.n_states))
+    assert np.array_equal(
+        symmetric_encoder.rank(canonical_codes), np.arange(symmetric_encoder.n_states)
+    )
+
+    # every state maps to a canonical state, isomorphic states share it
+    ranks = symmetric_encoder.rank(encoder.unrank(np.arange(encoder.n_states)))
+    assert set(ranks.tolist()) == set(range(symmetric_encoder.n_states))
+
+    # nodes 1-4 and 5-8 are isomorphic branches, 3 and 4 are isomorphic leaves
+    state = list(env.init)
+    state[1], state[3], state[5] = 1, 0, -1
+    swapped = list(env.init)
+    swapped[5], swapped[8], swapped[1] = 1, 0, -1
+    codes = encoder.encode(state)
+    assert symmetric_encoder.rank(codes) == symmetric_encoder.rank(
+        encoder.encode(swapped)
+    )
+
+    canonical, permutation = symmetric_encoder.canonicalize(codes)
+    assert np.array_equal(
+        canonical, symmetric_encoder.unrank(symmetric_encoder.rank(codes))
+    )
+    assert np.array_equal(canonical[permutation[:-1]], codes)
+    assert permutation[-1] == env.term_action
+
+
+def test_unknown_value():
+    encoder = StateEncoder([0, Categorical([-1, 1])])
+    with pytest.raises(ValueError):
+        encoder.encode([0, 2])
+
+
+def test_deduplicate_states_revealed_sentinel():
+    prior = Categorical([-1, 0, 1])
+    states = [[0, prior], [0, 0], [0, prior], [0, 0]]
+
+    assert deduplicate_states(states, verbose=False).tolist() == [
+        [0, prior],
+        [0, 0],
+    ]
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_deduplicate_codes(spill, tmp_path):
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, 3, size=(500, 4)).astype(np.uint8)
+    chunks = np.array_split(codes, 7)
+
+    deduplicated = np.vstack(
+        list(
+            deduplicate_codes(
+                chunks,
+                spill_directory=tmp_path if spill else None,
+                num_partitions=5,
+            )
+        )
+    )
+
+    assert len(deduplicated) == len(np.unique(codes, axis=0))
+    assert {tuple(row) for row in deduplicated} == {tuple(row) for row in codes}
+    if not spill:
+        # first occurrences are kept in order
+        _, indices = np.unique(codes, axis=0, return_index=True)
+        assert np.array_equal(deduplicated, codes[np.sort(indices)])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_deduplicate_states_gen(categorical_env, tmp_path):
+    states = get_all_possible_states_for_ground_truths(
+        categorical_env, get_all_possible_ground_truths(categorical_env)
+    )
+    expected = {tuple(state) for state in deduplicate_states(states, verbose=False)}
+
+    for spill_directory in [None, tmp_path]:
+        deduplicated = [
+            tuple(state)
+            for state in deduplicate_states_gen(
+                iter(states),
+                categorical_env,
+                chunk_size=7,
+                spill_directory=spill_directory,
+            )
+        ]
+        assert len(deduplicated) == len(expected)
+        assert set(deduplicated) == expected
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from mouselab.utils import masked_argmax, masked_softmax, paired_differences
+
+
+def test_paired_differences():
+    rng = np.random.default_rng(0)
+    shared = rng.normal(0, 10, size=1000)
+    scores = {
+        "baseline": shared,
+        "better": shared + 1 + rng.normal(0, 1, size=1000),
+    }
+    differences = paired_differences(scores, "baseline")
+
+    assert list(differences.index) == ["better"]
+    row = differences.loc["better"]
+    assert row["n"] == 1000
+    assert row["mean_difference"] == pytest.approx(1, abs=0.1)
+    assert row["ci_low"] < row["mean_difference"] < row["ci_high"]
+    # pairing removes the variance shared by both scores
+    assert row["std_error"] * 5 < row["unpaired_std_error"]
+
+
+@pytest.mark.parametrize("distribution", [masked_softmax, masked_argmax])
+def test_masked_distributions(distribution):
+    x = np.array([[1.0, np.nan, 3.0], [np.nan, 2.0, np.nan]])
+    probabilities = distribution(x)
+    assert np.allclose(probabilities.sum(axis=1), 1)
+    assert np.all(probabilities[np.isnan(x)] == 0)
+
+    # every action of the second row is masked
+    x[1, 1] = np.nan
+    with pytest.raises(ValueError, match="row 1"):
+        distribution(x)
+    with pytest.raises(ValueError):
+        distribution(np.ones(3), mask=np.zeros(3, dtype=bool))